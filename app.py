@@ -4,7 +4,9 @@ from sanic import Sanic
 
 from env import *
 from src.utils.sanic_utils import catch_signals, register_custom_error_handler
-from src.api import health_bp, api_bp, static_bp
+from src.api import health_bp, metrics_bp, api_bp, static_bp
+from src.token_provider import renew_tokens_periodically
+from src.sync import sync_workflows_periodically
 
 logging.basicConfig()
 logging.getLogger().setLevel(logging.INFO)
@@ -18,6 +20,7 @@ app.config.API_PRODUCES_CONTENT_TYPES = ['application/json']
 
 # API routes
 app.blueprint(health_bp)
+app.blueprint(metrics_bp)
 app.blueprint(api_bp)
 app.blueprint(static_bp)
 
@@ -27,6 +30,12 @@ register_custom_error_handler(app)
 # Terminate the app gracefully
 app.add_task(catch_signals(app))
 
+# Renew installation tokens before they expire
+app.add_task(renew_tokens_periodically())
+
+# Warm up caches and keep configured orgs in sync
+app.add_task(sync_workflows_periodically())
+
 # Use keep alive to match Chrome's AJAX requests
 app.config.KEEP_ALIVE_TIMEOUT = 180
 
@@ -35,7 +44,7 @@ if __name__ == '__main__':
     ssl = {'cert': SSL_CERT_PATH, 'key': SSL_KEY_PATH} if SSL_CERT_PATH and SSL_KEY_PATH else None
     try:
         logging.info(f"{APP_NAME} started: v{app.config.API_VERSION}", extra={"version": app.config.API_VERSION})
-        app.run(host=LISTEN_HOST, port=LISTEN_PORT, ssl=ssl)
+        app.run(host=LISTEN_HOST, port=LISTEN_PORT, ssl=ssl, workers=WORKERS)
     except KeyboardInterrupt:
         logging.info(f"Got KeyboardInterrupt. {APP_NAME} terminated successfully.")
         exit(0)
@@ -0,0 +1,472 @@
+"""
+Local stand-in for the GitHub API, backed by bare git repositories laid out as `<root>/<org>/<repo>.git`.
+
+Implements what the assistant uses: org memberships, org/user/installation repo listings, org installations, the
+installation token provider, the compare API and GraphQL `ref`/`object` queries and `createCommitOnBranch` mutations,
+with configurable latency, pagination, primary and secondary rate limits and error injection.
+
+    python -m bench.fake_github --root /tmp/fake-github --generate --repos 50 --branches 20 --latency 0.05
+
+Then point the assistant at it with the environment printed on startup. Git itself is served over
+`file://` (or `git daemon` with `--git-daemon`), as the fake server doesn't speak the git HTTP protocol.
+"""
+import os
+import re
+import json
+import base64
+import hashlib
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import zlib
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from aiohttp import web
+
+
+@dataclass(kw_only=True)
+class FakeGitHubConfig:
+    root: Path
+    # Added to every response, uniformly distributed in [latency - jitter, latency + jitter]
+    latency: float = field(default=0.0)
+    jitter: float = field(default=0.0)
+    max_per_page: int = field(default=100)
+    # Primary rate limit: requests per token per window
+    rate_limit: int = field(default=5000)
+    rate_limit_window: float = field(default=3600.0)
+    # Secondary rate limit: concurrent requests per token
+    secondary_limit: int = field(default=100)
+    secondary_retry_after: int = field(default=1)
+    # Share of requests failing with one of `error_statuses`
+    error_rate: float = field(default=0.0)
+    error_statuses: List[int] = field(default_factory=lambda: [502])
+    token_lifetime: int = field(default=3600)
+
+
+class FakeGitHub:
+    def __init__(self, config: FakeGitHubConfig):
+        self.config = config
+        self._windows: Dict[str, Tuple[float, int]] = {}
+        self._in_flight: Dict[str, int] = {}
+        self._repo_locks: Dict[Path, asyncio.Lock] = {}
+        self._tokens_issued = 0
+        self.stats = {"requests": 0, "rate_limited": 0, "secondary_rate_limited": 0, "injected_errors": 0,
+                      "commits": 0, "head_mismatches": 0}
+
+    #
+    # Repositories
+    def orgs(self) -> List[str]:
+        if not self.config.root.is_dir():
+            return []
+        return sorted(p.name for p in self.config.root.iterdir() if p.is_dir() and not p.name.startswith("."))
+
+    def repos(self, org: str) -> List[Dict]:
+        org_path = self.config.root / org
+        if not org_path.is_dir():
+            return []
+        return [{
+            "id": zlib.crc32(f"{org}/{p.stem}".encode()),
+            "name": p.stem,
+            "full_name": f"{org}/{p.stem}",
+            "private": True,
+            "owner": {"login": org, "id": zlib.crc32(org.encode())},
+            "default_branch": self.default_branch(p),
+        } for p in sorted(org_path.glob("*.git"))]
+
+    @staticmethod
+    def default_branch(bare: Path) -> str:
+        head = (bare / "HEAD").read_text().strip()
+        return head.removeprefix("ref: refs/heads/")
+
+    def bare_path(self, repo: str) -> Optional[Path]:
+        path = self.config.root / f"{repo}.git"
+        return path if "/" in repo and ".." not in repo and path.is_dir() else None
+
+    async def git(self, bare: Path, *args: str, stdin: bytes = None, env: Dict[str, str] = None) -> str:
+        proc = await asyncio.create_subprocess_exec(
+            "git", "-C", str(bare), *args, stdin=asyncio.subprocess.PIPE if stdin is not None else None,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, env=(os.environ | env) if env else None)
+        out, err = await proc.communicate(stdin)
+        if proc.returncode != 0:
+            raise RuntimeError(f"git {' '.join(args)} failed: {err.decode().strip()}")
+        return out.decode().strip()
+
+    async def resolve(self, bare: Path, rev: str) -> Optional[str]:
+        try:
+            return await self.git(bare, "rev-parse", "--verify", "-q", f"{rev}^{{commit}}")
+        except RuntimeError:
+            return None
+
+    #
+    # Middleware
+    @web.middleware
+    async def middleware(self, request: web.Request, handler):
+        self.stats["requests"] += 1
+        if self.config.latency or self.config.jitter:
+            await asyncio.sleep(max(self.config.latency + random.uniform(-self.config.jitter, self.config.jitter), 0))
+        if request.path.startswith("/_fake/"):
+            return await handler(request)
+
+        if self.config.error_rate and random.random() < self.config.error_rate:
+            self.stats["injected_errors"] += 1
+            status = random.choice(self.config.error_statuses)
+            return web.json_response({"message": "Injected error"}, status=status)
+
+        token = request.headers.get("Authorization", "anonymous")
+        now = time.time()
+        window_start, used = self._windows.get(token, (now, 0))
+        if now - window_start >= self.config.rate_limit_window:
+            window_start, used = now, 0
+        reset_at = int(window_start + self.config.rate_limit_window)
+        rate_headers = {
+            "X-RateLimit-Limit": str(self.config.rate_limit),
+            "X-RateLimit-Remaining": str(max(self.config.rate_limit - used - 1, 0)),
+            "X-RateLimit-Reset": str(reset_at),
+            "X-RateLimit-Resource": "graphql" if request.path == "/graphql" else "core",
+        }
+        if used >= self.config.rate_limit:
+            self.stats["rate_limited"] += 1
+            return web.json_response(
+                {"message": "API rate limit exceeded"}, status=403,
+                headers=rate_headers | {"X-RateLimit-Remaining": "0"})
+        self._windows[token] = (window_start, used + 1)
+
+        if self._in_flight.get(token, 0) >= self.config.secondary_limit:
+            self.stats["secondary_rate_limited"] += 1
+            return web.json_response(
+                {"message": "You have exceeded a secondary rate limit. Please wait a few minutes before you try "
+                            "again."}, status=403, headers={"Retry-After": str(self.config.secondary_retry_after)})
+        self._in_flight[token] = self._in_flight.get(token, 0) + 1
+        try:
+            response = await handler(request)
+        finally:
+            self._in_flight[token] -= 1
+        response.headers.update(rate_headers)
+        return response
+
+    def paginate(self, request: web.Request, items: List) -> Tuple[List, Dict[str, str]]:
+        try:
+            per_page = min(max(int(request.query.get("per_page", 30)), 1), self.config.max_per_page)
+            page = max(int(request.query.get("page", 1)), 1)
+        except ValueError:
+            raise web.HTTPBadRequest()
+        last_page = max((len(items) + per_page - 1) // per_page, 1)
+        links = []
+        if page < last_page:
+            links.append(f'<{request.url.update_query(page=page + 1)}>; rel="next"')
+        links.append(f'<{request.url.update_query(page=last_page)}>; rel="last"')
+        return items[(page - 1) * per_page:page * per_page], {"Link": ", ".join(links)}
+
+    #
+    # REST
+    async def user_orgs(self, request: web.Request) -> web.Response:
+        page, headers = self.paginate(request, [{"organization": {"login": org}} for org in self.orgs()])
+        return web.json_response(page, headers=headers)
+
+    async def org_repos(self, request: web.Request) -> web.Response:
+        org = request.match_info["org"]
+        if org not in self.orgs():
+            return web.json_response({"message": "Not Found"}, status=404)
+        page, headers = self.paginate(request, self.repos(org))
+        return web.json_response(page, headers=headers)
+
+    async def user_repos(self, request: web.Request) -> web.Response:
+        page, headers = self.paginate(request, [repo for org in self.orgs() for repo in self.repos(org)])
+        return web.json_response(page, headers=headers)
+
+    async def installation_repos(self, request: web.Request) -> web.Response:
+        all_repos = [repo for org in self.orgs() for repo in self.repos(org)]
+        page, headers = self.paginate(request, all_repos)
+        return web.json_response({"total_count": len(all_repos), "repositories": page}, headers=headers)
+
+    @staticmethod
+    def installation(org: str) -> Dict:
+        return {"id": int(hashlib.sha1(org.encode()).hexdigest()[:7], 16), "account": {"login": org}}
+
+    async def org_installation(self, request: web.Request) -> web.Response:
+        org = request.match_info["org"]
+        if org not in self.orgs():
+            return web.json_response({"message": "Not Found"}, status=404)
+        return web.json_response(self.installation(org))
+
+    async def app_installations(self, request: web.Request) -> web.Response:
+        page, headers = self.paginate(request, [self.installation(org) for org in self.orgs()])
+        return web.json_response(page, headers=headers)
+
+    async def app_jwt(self, request: web.Request) -> web.Response:
+        expires_at = datetime.fromtimestamp(time.time() + 600, tz=timezone.utc)
+        return web.json_response({"token": "fake.app.jwt", "expires_at": expires_at.strftime("%Y-%m-%dT%H:%M:%SZ")})
+
+    async def installation_token(self, request: web.Request) -> web.Response:
+        self._tokens_issued += 1
+        expires_at = datetime.fromtimestamp(time.time() + self.config.token_lifetime, tz=timezone.utc)
+        return web.json_response({
+            "access_token": f"ghs_fake{self._tokens_issued:032d}",
+            "expires_at": expires_at.strftime("%Y-%m-%dT%H:%M:%SZ"),
+        })
+
+    async def compare(self, request: web.Request) -> web.Response:
+        bare = self.bare_path(f"{request.match_info['owner']}/{request.match_info['repo']}")
+        base_ref, _, head_ref = request.match_info["basehead"].partition("...")
+        base = await self.resolve(bare, base_ref) if bare else None
+        head = await self.resolve(bare, head_ref) if bare else None
+        if not base or not head:
+            return web.json_response({"message": "Not Found"}, status=404)
+
+        behind, ahead = map(int, (await self.git(bare, "rev-list", "--left-right", "--count", f"{base}...{head}"))
+                            .split())
+        status = "identical" if not ahead and not behind else "ahead" if not behind \
+            else "behind" if not ahead else "diverged"
+        statuses = {"A": "added", "M": "modified", "D": "removed", "R": "renamed"}
+        files = []
+        for line in (await self.git(bare, "diff", "--name-status", "-M", base, head)).splitlines():
+            parts = line.split("\t")
+            entry = {"filename": parts[-1], "status": statuses.get(parts[0][0], "changed")}
+            if parts[0].startswith("R"):
+                entry["previous_filename"] = parts[1]
+            files.append(entry)
+        return web.json_response({
+            "status": status, "ahead_by": ahead, "behind_by": behind, "total_commits": ahead,
+            # GitHub truncates the file list at 300 entries
+            "files": files[:300],
+        })
+
+    #
+    # GraphQL
+    async def graphql(self, request: web.Request) -> web.Response:
+        payload = await request.json()
+        query, variables = payload.get("query", ""), payload.get("variables") or {}
+        data, errors = {}, []
+
+        if query.lstrip().startswith("mutation"):
+            mutations = re.findall(r"(?:(\w+)\s*:\s*)?createCommitOnBranch\s*\(\s*input\s*:\s*\$(\w+)\s*\)", query)
+            for alias, var in mutations:
+                alias = alias or "createCommitOnBranch"
+                try:
+                    data[alias] = {"commit": await self.create_commit_on_branch(variables[var])}
+                except GraphQLFailure as e:
+                    data[alias] = None
+                    errors.append({"type": e.kind, "path": [alias], "message": str(e)})
+        else:
+            for alias, body in iter_blocks(query, "repository"):
+                args = re.match(r"\s*\(\s*owner\s*:\s*\$(\w+)\s*,\s*name\s*:\s*\$(\w+)\s*\)", body)
+                if not args:
+                    continue
+                repo = f"{variables.get(args.group(1))}/{variables.get(args.group(2))}"
+                bare = self.bare_path(repo)
+                if not bare:
+                    data[alias] = None
+                    errors.append({"type": "NOT_FOUND", "path": [alias],
+                                   "message": f"Could not resolve to a Repository with the name '{repo}'."})
+                    continue
+                data[alias] = await self.resolve_repository_fields(bare, body, variables)
+
+        result = {"data": data}
+        if errors:
+            result["errors"] = errors
+        return web.json_response(result)
+
+    async def resolve_repository_fields(self, bare: Path, body: str, variables: Dict) -> Dict:
+        fields = {}
+        for alias, name in re.findall(r"(\w+)\s*:\s*ref\s*\(\s*qualifiedName\s*:\s*\$(\w+)\s*\)", body):
+            oid = await self.resolve(bare, variables.get(name, ""))
+            fields[alias] = {"target": {"oid": oid}} if oid else None
+        for alias, name in re.findall(r"(\w+)\s*:\s*object\s*\(\s*expression\s*:\s*\$(\w+)\s*\)", body):
+            fields[alias] = await self.resolve_object(bare, variables.get(name, ""))
+        if re.search(r"\bdefaultBranchRef\b", body) or re.search(r"\brefs\s*\(", body):
+            fields |= await self.resolve_branch_refs(bare, body, variables)
+        return fields
+
+    async def resolve_branch_refs(self, bare: Path, body: str, variables: Dict) -> Dict:
+        """
+        `defaultBranchRef` and `refs(refPrefix: "refs/heads/", first: N, after: $cursor)`, in alphabetical order
+        whatever `orderBy` says, like GitHub, which only orders tags by commit date. Cursors are plain offsets.
+        """
+        def _node(line: str) -> Dict:
+            name, oid, committed_date = line.split(" ")
+            return {"name": name, "target": {"oid": oid, "committedDate": committed_date}}
+
+        output = await self.git(bare, "for-each-ref", "--sort=refname",
+                                "--format=%(refname:lstrip=2) %(objectname) %(committerdate:iso-strict)", "refs/heads/")
+        nodes = [_node(line) for line in output.splitlines()]
+        fields = {}
+        if re.search(r"\bdefaultBranchRef\b", body):
+            default_branch = self.default_branch(bare)
+            fields["defaultBranchRef"] = next((node for node in nodes if node["name"] == default_branch), None)
+        refs_args = re.search(r"\brefs\s*\(([^)]*)\)", body)
+        if refs_args:
+            first = re.search(r"first\s*:\s*(\d+)", refs_args.group(1))
+            after = re.search(r"after\s*:\s*\$(\w+)", refs_args.group(1))
+            first = int(first.group(1)) if first else 100
+            offset = int(variables.get(after.group(1)) or 0) if after else 0
+            fields["refs"] = {
+                "pageInfo": {"hasNextPage": offset + first < len(nodes), "endCursor": str(offset + first)},
+                "nodes": nodes[offset:offset + first],
+            }
+        return fields
+
+    async def resolve_object(self, bare: Path, expression: str) -> Optional[Dict]:
+        """
+        `object(expression: "branch:path")`: a Blob with `text`, or a Tree with `entries`.
+        """
+        try:
+            oid = await self.git(bare, "rev-parse", "--verify", "-q", expression)
+            kind = await self.git(bare, "cat-file", "-t", oid)
+        except RuntimeError:
+            return None
+        if kind == "blob":
+            text = await self.git(bare, "cat-file", "blob", oid)
+            return {"__typename": "Blob", "oid": oid, "text": text, "byteSize": len(text.encode())}
+        if kind == "tree":
+            entries = []
+            for line in (await self.git(bare, "ls-tree", oid)).splitlines():
+                meta, name = line.split("\t", 1)
+                mode, entry_type, entry_oid = meta.split()
+                entries.append({"name": name, "type": entry_type, "mode": int(mode, 8), "oid": entry_oid})
+            return {"__typename": "Tree", "oid": oid, "entries": entries}
+        return {"__typename": kind.capitalize(), "oid": oid}
+
+    async def create_commit_on_branch(self, commit_input: Dict) -> Dict:
+        repo = commit_input["branch"]["repositoryNameWithOwner"]
+        branch = commit_input["branch"]["branchName"]
+        bare = self.bare_path(repo)
+        if not bare:
+            raise GraphQLFailure("NOT_FOUND", f"Could not resolve to a Repository with the name '{repo}'.")
+
+        async with self._repo_locks.setdefault(bare, asyncio.Lock()):
+            head = await self.resolve(bare, f"refs/heads/{branch}")
+            if not head:
+                raise GraphQLFailure("NOT_FOUND", f"A ref named \"refs/heads/{branch}\" does not exist.")
+            if head != commit_input.get("expectedHeadOid"):
+                self.stats["head_mismatches"] += 1
+                raise GraphQLFailure(
+                    "STALE_DATA", f"Expected head oid did not match: branch `{branch}` is at {head}.")
+
+            changes = commit_input.get("fileChanges") or {}
+            with tempfile.NamedTemporaryFile(prefix="fake-github-index-") as index:
+                env = {"GIT_INDEX_FILE": index.name, "GIT_AUTHOR_NAME": "Fake GitHub",
+                       "GIT_AUTHOR_EMAIL": "noreply@example.com", "GIT_COMMITTER_NAME": "Fake GitHub",
+                       "GIT_COMMITTER_EMAIL": "noreply@example.com"}
+                await self.git(bare, "read-tree", head, env=env)
+                for addition in changes.get("additions", []):
+                    blob = await self.git(bare, "hash-object", "-w", "--stdin",
+                                          stdin=base64.b64decode(addition["contents"]))
+                    await self.git(bare, "update-index", "--add", "--cacheinfo",
+                                   f"100644,{blob},{addition['path']}", env=env)
+                for deletion in changes.get("deletions", []):
+                    await self.git(bare, "update-index", "--force-remove", deletion["path"], env=env)
+                tree = await self.git(bare, "write-tree", env=env)
+
+            message = commit_input.get("message") or {}
+            text = "\n\n".join(part for part in [message.get("headline"), message.get("body")] if part)
+            oid = await self.git(bare, "commit-tree", tree, "-p", head, "-m", text or "Commit", env=env)
+            await self.git(bare, "update-ref", f"refs/heads/{branch}", oid, head)
+        self.stats["commits"] += 1
+        return {"oid": oid, "url": f"https://github.com/{repo}/commit/{oid}"}
+
+    #
+    # Introspection
+    async def get_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.stats | {"tokens_issued": self._tokens_issued})
+
+    def create_app(self) -> web.Application:
+        app = web.Application(middlewares=[self.middleware], client_max_size=64 * 1024 ** 2)
+        app.add_routes([
+            web.get("/user/memberships/orgs", self.user_orgs),
+            web.get("/user/repos", self.user_repos),
+            web.get("/orgs/{org}/repos", self.org_repos),
+            web.get("/installation/repositories", self.installation_repos),
+            web.get("/orgs/{org}/installation", self.org_installation),
+            web.get("/app/installations", self.app_installations),
+            web.get("/get-app-jwt", self.app_jwt),
+            web.get("/get-installation-token", self.installation_token),
+            web.get("/repos/{owner}/{repo}/compare/{basehead}", self.compare),
+            web.post("/graphql", self.graphql),
+            web.get("/_fake/stats", self.get_stats),
+        ])
+        return app
+
+
+class GraphQLFailure(Exception):
+    def __init__(self, kind: str, message: str):
+        super().__init__(message)
+        self.kind = kind
+
+
+def iter_blocks(query: str, field_name: str) -> List[Tuple[str, str]]:
+    """
+    (alias, text from the field arguments to its closing brace) of every `alias: field_name(...) { ... }`.
+    """
+    blocks = []
+    for match in re.finditer(rf"(?:(\w+)\s*:\s*)?{field_name}\b", query):
+        depth, start = 0, match.end()
+        for i in range(start, len(query)):
+            if query[i] == "{":
+                depth += 1
+            elif query[i] == "}":
+                depth -= 1
+                if depth == 0:
+                    blocks.append((match.group(1) or field_name, query[start:i + 1]))
+                    break
+    return blocks
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--root", type=Path, required=True, help="Directory with `<org>/<repo>.git` bare repos")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8787)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--max-per-page", type=int, default=100)
+    parser.add_argument("--rate-limit", type=int, default=5000, help="Requests per token per window")
+    parser.add_argument("--rate-limit-window", type=float, default=3600.0)
+    parser.add_argument("--secondary-limit", type=int, default=100, help="Concurrent requests per token")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-statuses", default="502", help="Comma separated statuses of injected errors")
+    parser.add_argument("--token-lifetime", type=int, default=3600)
+    parser.add_argument("--git-daemon", action="store_true", help="Serve the repos with `git daemon`")
+    parser.add_argument("--generate", action="store_true", help="Generate a synthetic org into --root first")
+    parser.add_argument("--repos", type=int, default=10)
+    parser.add_argument("--branches", type=int, default=5)
+    parser.add_argument("--workflows", type=int, default=5)
+    parser.add_argument("--duplication", type=float, default=0.5)
+    args = parser.parse_args()
+
+    from bench.run import BENCH_ORG, generate_org, start_git_daemon
+
+    if args.generate:
+        generate_org(args.root, args.repos, args.branches, args.workflows, args.duplication, seed=1)
+
+    daemon, git_url = None, f"file://{args.root.resolve()}"
+    if args.git_daemon:
+        daemon, git_url = start_git_daemon(args.root.resolve())
+
+    config = FakeGitHubConfig(
+        root=args.root, latency=args.latency, jitter=args.jitter, max_per_page=args.max_per_page,
+        rate_limit=args.rate_limit, rate_limit_window=args.rate_limit_window, secondary_limit=args.secondary_limit,
+        error_rate=args.error_rate, error_statuses=[int(s) for s in args.error_statuses.split(",") if s.strip()],
+        token_lifetime=args.token_lifetime)
+    base_url = f"http://{args.host}:{args.port}"
+    print(json.dumps({
+        "GITHUB_API_URL": base_url,
+        "GITHUB_GRAPHQL_ENDPOINT": f"{base_url}/graphql",
+        "GITHUB_GIT_URL": git_url,
+        "GITHUB_INSTALLATION_TOKEN_PROVIDER": base_url,
+        "GITHUB_INSTALLATION_TOKEN_PROVIDER_SECRET": "fake",
+        "SYNC_ORGS": BENCH_ORG if args.generate else "",
+    }, indent=2), flush=True)
+    try:
+        web.run_app(FakeGitHub(config).create_app(), host=args.host, port=args.port, print=None)
+    finally:
+        if daemon:
+            daemon.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,285 @@
+"""
+End-to-end benchmark of the fetch -> scan -> rewrite -> commit flow against synthetic local git remotes.
+
+Generates an org of N repos x M branches x K workflow files as bare repositories, serves them over `file://`
+or `git daemon`, and runs the real `src.utils.git` / `src.utils.github` code paths against them. The JSON
+report can be compared between commits:
+
+    python -m bench.run --repos 20 --branches 10 --workflows 5 --output before.json
+    python -m bench.run --repos 20 --branches 10 --workflows 5 --output after.json --compare before.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import socket
+import asyncio
+import argparse
+import resource
+import platform
+import tempfile
+import statistics
+import subprocess
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+BENCH_ORG = "bench-org"
+BENCH_TOKEN = "github_pat_bench"
+BENCH_TIMESTAMP = 1700000000
+LABELS = ["ubuntu-latest", "ubuntu-22.04", "ubuntu-20.04"]
+REPLACEMENT = "puzl-ubuntu-latest"
+
+
+def workflow_yaml(name: str, label: str, variant: Optional[str]) -> str:
+    header = f"# variant {variant}\n" if variant else ""
+    return (
+        f"{header}name: {name}\n"
+        f"on:\n  push:\n    branches: [main]\n  pull_request:\n"
+        f"jobs:\n"
+        f"  build:\n    runs-on: {label}\n    steps:\n      - uses: actions/checkout@v4\n      - run: make build\n"
+        f"  test:\n    runs-on: [{label}, self-hosted]\n    steps:\n      - uses: actions/checkout@v4\n"
+        f"      - run: make test\n"
+    )
+
+
+def fast_import_stream(branches: int, workflows: int, duplication: float, rng: random.Random) -> bytes:
+    """
+    A `git fast-import` stream with a `main` branch and `branches - 1` branches on top of it.
+    With probability `duplication`, a branch keeps the workflow files of `main` byte for byte.
+    """
+    out = []
+
+    def _data(content: str) -> None:
+        raw = content.encode()
+        out.append(f"data {len(raw)}\n".encode() + raw + b"\n")
+
+    for b in range(branches):
+        name = "main" if b == 0 else f"feature/bench-{b}"
+        out.append(f"commit refs/heads/{name}\nmark :{b + 1}\n".encode())
+        out.append(f"committer Bench <bench@example.com> {BENCH_TIMESTAMP + b} +0000\n".encode())
+        _data(f"Bench commit for {name}")
+        if b > 0:
+            out.append(b"from :1\n")
+        duplicate = b > 0 and rng.random() < duplication
+        if b == 0 or not duplicate:
+            for k in range(workflows):
+                out.append(f"M 100644 inline .github/workflows/workflow-{k}.yml\n".encode())
+                _data(workflow_yaml(f"Workflow {k}", rng.choice(LABELS), None if b == 0 else name))
+        if b == 0:
+            out.append(b"M 100644 inline README.md\n")
+            _data("Benchmark repository\n")
+    return b"".join(out)
+
+
+def generate_org(remote_root: Path, repos: int, branches: int, workflows: int, duplication: float, seed: int) \
+        -> List[str]:
+    rng = random.Random(seed)
+    names = []
+    for r in range(repos):
+        name = f"repo-{r}"
+        bare = remote_root / BENCH_ORG / f"{name}.git"
+        subprocess.run(["git", "init", "-q", "--bare", "-b", "main", str(bare)], check=True)
+        for key, value in [("uploadpack.allowFilter", "true"), ("uploadpack.allowAnySHA1InWant", "true"),
+                           ("daemon.receivepack", "true")]:
+            subprocess.run(["git", "-C", str(bare), "config", key, value], check=True)
+        subprocess.run(["git", "-C", str(bare), "fast-import", "--quiet"],
+                       input=fast_import_stream(branches, workflows, duplication, rng), check=True)
+        names.append(name)
+    return names
+
+
+def start_git_daemon(remote_root: Path) -> Tuple[subprocess.Popen, str]:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    daemon = subprocess.Popen([
+        "git", "daemon", "--reuseaddr", "--export-all", "--enable=receive-pack", "--listen=127.0.0.1",
+        f"--port={port}", f"--base-path={remote_root}", str(remote_root)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(50):
+        with socket.socket() as s:
+            if s.connect_ex(("127.0.0.1", port)) == 0:
+                break
+        time.sleep(0.1)
+    return daemon, f"git://127.0.0.1:{port}"
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+
+    def _at(q: float) -> float:
+        return round(ordered[min(int(q * len(ordered)), len(ordered) - 1)], 4)
+
+    return {"count": len(ordered), "mean": round(statistics.fmean(ordered), 4), "p50": _at(0.5), "p90": _at(0.9),
+            "p99": _at(0.99), "max": round(ordered[-1], 4)}
+
+
+async def timed(latencies: List[float], aw):
+    started_at = time.monotonic()
+    try:
+        return await aw
+    finally:
+        latencies.append(time.monotonic() - started_at)
+
+
+async def run_flow(repo_names: List[str]) -> Dict:
+    # Imported here, so env.py picks up the settings of this run
+    from src.models import GitBranch, Token
+    from src.common import WORKFLOW_DIR, replace_runs_on_labels
+    from src.utils.github import github_get_all_branches, github_clone_shallow, find_all_workflow_files, \
+        github_commit_and_push, write_workflows
+    from src.utils.metrics import GIT_COMMANDS
+    from env import REPO_STORAGE_PATH, COMMIT_EMAIL, COMMIT_AUTHOR
+
+    token = Token(value=BENCH_TOKEN, org=BENCH_ORG)
+    stages: Dict[str, Dict] = {}
+
+    def _stage(name: str, started_at: float, items: int, latencies: List[float] = None) -> None:
+        elapsed = time.monotonic() - started_at
+        stages[name] = {"seconds": round(elapsed, 4), "items": items,
+                        "per_second": round(items / elapsed, 2) if elapsed else None,
+                        "latency": percentiles(latencies or [])}
+
+    started_at, latencies = time.monotonic(), []
+    listed = await asyncio.gather(*[
+        timed(latencies, github_get_all_branches(f"{BENCH_ORG}/{name}", token)) for name in repo_names])
+    branches: List[GitBranch] = [branch for repo_branches in listed for branch in repo_branches]
+    _stage("list_branches", started_at, len(repo_names), latencies)
+
+    started_at, latencies = time.monotonic(), []
+    await asyncio.gather(*[
+        timed(latencies, github_clone_shallow(b.repo, b.name, WORKFLOW_DIR, token, b.local_destination))
+        for b in branches])
+    _stage("clone", started_at, len(branches), latencies)
+
+    started_at = time.monotonic()
+    workflows = await find_all_workflow_files(REPO_STORAGE_PATH / BENCH_ORG)
+    _stage("scan", started_at, len(workflows))
+
+    started_at = time.monotonic()
+    changed = []
+    for wf in workflows:
+        updated = replace_runs_on_labels(wf.content, LABELS, REPLACEMENT)
+        if updated != wf.content:
+            wf.content = updated
+            changed.append(wf)
+    errors = [e for e in await write_workflows(changed) if e]
+    if errors:
+        raise errors[0]
+    _stage("rewrite", started_at, len(changed))
+
+    started_at, latencies = time.monotonic(), []
+    to_commit = {wf.branch_full_path: wf for wf in changed}
+    results = await asyncio.gather(*[
+        timed(latencies, github_commit_and_push(
+            wf.repo, wf.branch, token, wf.branch_full_path, "Bench rewrite", COMMIT_EMAIL, COMMIT_AUTHOR))
+        for wf in to_commit.values()], return_exceptions=True)
+    _stage("commit", started_at, len(to_commit), latencies)
+
+    return {
+        "stages": stages,
+        "branches": len(branches),
+        "workflows": len(workflows),
+        "commit_errors": [str(res) for res in results if isinstance(res, Exception)][:10],
+        # Compound shell scripts are counted once, under their first git subcommand
+        "git_subprocesses": {command: int(n) for command, n in sorted(GIT_COMMANDS.by_label("command").items())},
+    }
+
+
+def tree_revision() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=Path(__file__).parent, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def compare(report: Dict, baseline: Dict) -> Dict:
+    """
+    Relative change of stage times and throughput against a baseline report. Negative `seconds` is faster.
+    """
+    delta = {}
+    for name, stage in report["stages"].items():
+        base = baseline.get("stages", {}).get(name)
+        if not base or not base["seconds"]:
+            continue
+        delta[name] = {"seconds": round(stage["seconds"] / base["seconds"] - 1, 3)}
+        if stage["latency"].get("p99") and base["latency"].get("p99"):
+            delta[name]["p99"] = round(stage["latency"]["p99"] / base["latency"]["p99"] - 1, 3)
+    return {"baseline_revision": baseline.get("revision"), "stages": delta}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repos", type=int, default=10)
+    parser.add_argument("--branches", type=int, default=5, help="Branches per repo, including `main`")
+    parser.add_argument("--workflows", type=int, default=5, help="Workflow files per branch")
+    parser.add_argument("--duplication", type=float, default=0.5,
+                        help="Share of branches whose workflow files are identical to `main`")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--transport", choices=["file", "daemon"], default="file")
+    parser.add_argument("--shell-concurrency", type=int, help="Overrides SHELL_CONCURRENCY_LIMIT")
+    parser.add_argument("--workdir", type=Path, help="Keep the fixtures and checkouts here instead of a temp dir")
+    parser.add_argument("--output", type=Path, help="Write the JSON report here instead of stdout")
+    parser.add_argument("--compare", type=Path, help="Baseline JSON report to compare with")
+    args = parser.parse_args()
+
+    workdir = args.workdir or Path(tempfile.mkdtemp(prefix="gwa-bench-"))
+    remote_root, storage = workdir / "remote", workdir / "storage"
+    shutil.rmtree(remote_root, ignore_errors=True)
+    shutil.rmtree(storage, ignore_errors=True)
+
+    started_at = time.monotonic()
+    repo_names = generate_org(remote_root, args.repos, args.branches, args.workflows, args.duplication, args.seed)
+    generate_seconds = time.monotonic() - started_at
+
+    daemon = None
+    if args.transport == "daemon":
+        daemon, git_url = start_git_daemon(remote_root)
+    else:
+        git_url = f"file://{remote_root}"
+
+    os.environ.update({"REPO_STORAGE": str(storage), "GITHUB_GIT_URL": git_url,
+                       "GITHUB_PERSONAL_ACCESS_TOKEN": BENCH_TOKEN})
+    if args.shell_concurrency:
+        os.environ["SHELL_CONCURRENCY_LIMIT"] = str(args.shell_concurrency)
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+    try:
+        started_at = time.monotonic()
+        flow = asyncio.run(run_flow(repo_names))
+        total_seconds = time.monotonic() - started_at
+    finally:
+        if daemon:
+            daemon.terminate()
+            daemon.wait()
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "revision": tree_revision(),
+        "python": platform.python_version(),
+        "params": {k: v for k, v in vars(args).items() if k in (
+            "repos", "branches", "workflows", "duplication", "seed", "transport", "shell_concurrency")},
+        "generate_seconds": round(generate_seconds, 4),
+        "total_seconds": round(total_seconds, 4),
+        # ru_maxrss is in KiB on Linux
+        "peak_rss_mib": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "peak_child_rss_mib": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+    } | flow
+    if args.compare:
+        report["compare"] = compare(report, json.loads(args.compare.read_text()))
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        args.output.write_text(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
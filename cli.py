@@ -0,0 +1,245 @@
+"""
+Headless fetch, rewrite and commit of workflow files, without the web UI.
+
+    python cli.py fetch my-org
+    python cli.py migrate my-org --label ubuntu-latest --label ubuntu-22.04 --replacement puzl-ubuntu-latest --dry-run
+    python cli.py migrate my-org --repo my-repo --label ubuntu-latest --replacement puzl-ubuntu-latest --json
+    python cli.py export my-org -o my-org.snapshot.json.gz
+    python cli.py import my-org.snapshot.json.gz
+
+The same settings as for the server are read from the environment, e.g. GITHUB_PERSONAL_ACCESS_TOKEN
+or the GitHub App credentials, and REPO_STORAGE. With `--json`, progress is written to stdout
+as one JSON object per line.
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+from typing import Dict, List, Optional
+
+
+class Progress:
+    """
+    Progress events, as human-readable lines or as NDJSON.
+    """
+    def __init__(self, as_json: bool):
+        self.as_json = as_json
+
+    def emit(self, event: str, message: str, **fields) -> None:
+        if self.as_json:
+            print(json.dumps({"event": event, "time": round(time.time(), 3)} | fields), flush=True)
+        else:
+            print(message, flush=True)
+
+
+def branch_policy(args: argparse.Namespace):
+    from src.common import BranchPolicy
+
+    if not (args.default_only or args.include or args.exclude or args.recent_days is not None
+            or args.max_branches is not None):
+        return None
+    return BranchPolicy(default_only=args.default_only, include=args.include or [], exclude=args.exclude or [],
+                        recent_days=args.recent_days, max_per_repo=args.max_branches)
+
+
+async def fetch(orgs: List[str], repo_name: Optional[str], policy, progress: Progress) -> bool:
+    from src.utils.github import github_clone_all_workflows
+    from src.token_provider import get_github_token
+
+    ok = True
+    for org_name in orgs:
+        token = await get_github_token(org_name)
+        if not token.value:
+            progress.emit("error", f"{org_name}: no GitHub token available", org=org_name, error="unauthorized")
+            ok = False
+            continue
+        started_at = time.monotonic()
+        try:
+            branches = await github_clone_all_workflows(token, org_name, repo_name, policy)
+        except ValueError as e:
+            progress.emit("error", f"{org_name}: {e}", org=org_name, error=str(e))
+            ok = False
+            continue
+        incomplete = [branch for branch in branches if branch.error]
+        progress.emit(
+            "fetched", f"{org_name}: {len(branches) - len(incomplete)} branches fetched, "
+                       f"{len(incomplete)} not fetched in time ({time.monotonic() - started_at:.1f}s)",
+            org=org_name, repo=repo_name, branches=len(branches), incomplete=len(incomplete),
+            seconds=round(time.monotonic() - started_at, 3))
+        ok = ok and not incomplete
+    return ok
+
+
+async def migrate(orgs: List[str], repo_name: Optional[str], labels: List[str], replacement: str, message: str,
+                  dry_run: bool, show_diff: bool, progress: Progress) -> bool:
+    from src.utils.github import find_workflow_changes_by_rule, diff_workflow_changes, github_materialize_checkouts, \
+        write_workflows
+    from src.token_provider import get_github_token
+    from src.commits import commit_workflows
+    from env import REPO_STORAGE_PATH
+
+    paths = [REPO_STORAGE_PATH / org_name / repo_name if repo_name else REPO_STORAGE_PATH / org_name
+             for org_name in orgs]
+    changes = await find_workflow_changes_by_rule(paths, labels, replacement)
+    diffs = await diff_workflow_changes([(wf, wf.content, updated) for wf, updated in changes])
+
+    stats: Dict[str, Dict[str, int]] = {}
+    for d in diffs:
+        branch_stats = stats.setdefault(f"{d.repo}/{d.branch}", {"files": 0, "additions": 0, "deletions": 0})
+        branch_stats["files"] += 1
+        branch_stats["additions"] += d.additions
+        branch_stats["deletions"] += d.deletions
+        progress.emit("change", d.diff.rstrip("\n") if show_diff else f"  {d.path} (+{d.additions} -{d.deletions})",
+                      path=d.path, repo=d.repo, branch=d.branch, additions=d.additions, deletions=d.deletions,
+                      **({"diff": d.diff} if show_diff else {}))
+    progress.emit("plan", f"{len(diffs)} workflow files to change in {len(stats)} branches",
+                  files=len(diffs), branches=stats)
+    if dry_run or not changes:
+        return True
+
+    workflows = []
+    for wf, updated in changes:
+        wf.content = updated
+        workflows.append(wf)
+    tokens = {org_name: await get_github_token(org_name) for org_name in set(wf.org for wf in workflows)}
+    await github_materialize_checkouts(workflows, tokens)
+    write_results = await write_workflows(workflows)
+    failed_writes = {wf.branch_full_path for wf, res in zip(workflows, write_results) if isinstance(res, Exception)}
+    for wf, res in zip(workflows, write_results):
+        if isinstance(res, Exception):
+            progress.emit("error", f"{wf.path}: could not write file changes: {res}", path=str(wf.path),
+                          error=str(res))
+    # A branch is only committed when all of its files are written
+    workflows = [wf for wf in workflows if wf.branch_full_path not in failed_writes]
+
+    results = await commit_workflows(workflows, tokens, message) if workflows else {}
+    ok = not failed_writes
+    for branch_path, res in results.items():
+        branch = str(branch_path.relative_to(REPO_STORAGE_PATH))
+        if isinstance(res, Exception):
+            ok = False
+            progress.emit("committed", f"{branch}: commit failed: {res}", branch=branch, success=False,
+                          error=str(res))
+        else:
+            progress.emit("committed", f"{branch}: committed", branch=branch, success=True)
+    committed = len([res for res in results.values() if not isinstance(res, Exception)])
+    progress.emit("summary", f"{committed} of {len(results) + len(failed_writes)} branches committed",
+                  committed=committed, failed=len(results) + len(failed_writes) - committed)
+    return ok
+
+
+async def export(org_name: str, output: Optional[str], progress: Progress) -> bool:
+    from src.snapshots import export_snapshot
+    from src.utils.github import warm_branch_heads
+    from env import REPO_STORAGE_PATH
+
+    if not (REPO_STORAGE_PATH / org_name).is_dir():
+        progress.emit("error", f"{org_name}: nothing fetched", org=org_name, error="not found")
+        return False
+    await warm_branch_heads(REPO_STORAGE_PATH / org_name)
+    data = await export_snapshot(org_name)
+    output = output or f"{org_name}.snapshot.json.gz"
+    with open(output, "wb") as f:
+        f.write(data)
+    progress.emit("exported", f"{org_name}: snapshot written to {output} ({len(data)} bytes)", org=org_name,
+                  path=output, bytes=len(data))
+    return True
+
+
+async def import_(paths: List[str], progress: Progress) -> bool:
+    from src.snapshots import import_snapshot
+
+    ok = True
+    for path in paths:
+        try:
+            with open(path, "rb") as f:
+                summary = await import_snapshot(f.read())
+        except (OSError, ValueError) as e:
+            progress.emit("error", f"{path}: {e}", path=path, error=str(e))
+            ok = False
+            continue
+        progress.emit("imported", f"{summary['org']}: {summary['restored']} branches restored, "
+                                  f"{summary['skipped']} skipped, {summary['failed']} failed from {path}",
+                      path=path, **summary)
+        ok = ok and not summary["failed"]
+    return ok
+
+
+async def run(args: argparse.Namespace) -> bool:
+    from src.utils.concurrency import deadline
+
+    progress = Progress(args.json)
+    if args.command == "export":
+        return await export(args.org, args.output, progress)
+    if args.command == "import":
+        return await import_(args.files, progress)
+    with deadline(args.deadline):
+        if args.command == "fetch" or not args.no_fetch:
+            if not await fetch(args.orgs, args.repo, branch_policy(args), progress) and args.command == "fetch":
+                return False
+        if args.command == "fetch":
+            return True
+        return await migrate(args.orgs, args.repo, args.label, args.replacement, args.message, args.dry_run,
+                             args.show_diff, progress)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("orgs", nargs="+", metavar="ORG")
+    common.add_argument("--repo", help="Only this repository of the org")
+    common.add_argument("--json", action="store_true", help="Write progress to stdout as NDJSON")
+    common.add_argument("--concurrency", type=int, help="Overrides SHELL_CONCURRENCY_LIMIT")
+    common.add_argument("--deadline", type=float, help="Give up on whatever is not done after this many seconds")
+    policy = common.add_argument_group("branch selection")
+    policy.add_argument("--default-only", action="store_true", help="Only fetch the default branch of each repo")
+    policy.add_argument("--include", action="append", metavar="GLOB", help="Only fetch matching branches")
+    policy.add_argument("--exclude", action="append", metavar="GLOB", help="Skip matching branches")
+    policy.add_argument("--recent-days", type=float, help="Only fetch branches committed to in the last N days")
+    policy.add_argument("--max-branches", type=int, help="Fetch at most N branches per repo, most recent first")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    commands.add_parser("fetch", parents=[common], help="Clone or refresh the workflow files of the orgs")
+
+    migrate_parser = commands.add_parser(
+        "migrate", parents=[common], help="Replace `runs-on` labels in all fetched workflows and commit the changes")
+    migrate_parser.add_argument("--label", action="append", required=True, help="Label to replace, repeatable")
+    migrate_parser.add_argument("--replacement", required=True, help="Label to put instead")
+    migrate_parser.add_argument("--message", help="Commit message")
+    migrate_parser.add_argument("--no-fetch", action="store_true", help="Use the local checkouts as they are")
+    migrate_parser.add_argument("--dry-run", action="store_true", help="Only print the changes")
+    migrate_parser.add_argument("--show-diff", action="store_true", help="Print unified diffs of the changes")
+    migrate_parser.add_argument("--commit-concurrency", type=int, help="Overrides COMMIT_CONCURRENCY_LIMIT")
+
+    export_parser = commands.add_parser(
+        "export", help="Write the fetched workflows, branch heads and labels of an org to a snapshot file")
+    export_parser.add_argument("org", metavar="ORG")
+    export_parser.add_argument("-o", "--output", help="Snapshot file, ORG.snapshot.json.gz by default")
+    export_parser.add_argument("--json", action="store_true", help="Write progress to stdout as NDJSON")
+
+    import_parser = commands.add_parser(
+        "import", help="Restore the branches of orgs from snapshot files, without fetching from GitHub")
+    import_parser.add_argument("files", nargs="+", metavar="FILE")
+    import_parser.add_argument("--json", action="store_true", help="Write progress to stdout as NDJSON")
+    args = parser.parse_args()
+
+    # Set before env.py is imported
+    if getattr(args, "concurrency", None):
+        os.environ["SHELL_CONCURRENCY_LIMIT"] = str(args.concurrency)
+    if getattr(args, "commit_concurrency", None):
+        os.environ["COMMIT_CONCURRENCY_LIMIT"] = str(args.commit_concurrency)
+    if args.command == "migrate" and not args.message:
+        from src.commits import COMMIT_MESSAGE
+        args.message = COMMIT_MESSAGE
+
+    try:
+        ok = asyncio.run(run(args))
+    except KeyboardInterrupt:
+        ok = False
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
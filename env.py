@@ -11,14 +11,72 @@ LISTEN_PORT = int(os.getenv("LISTEN_PORT", 17007))
 # Setting up git environment
 REPO_STORAGE = os.getenv("REPO_STORAGE", "/tmp")
 REPO_STORAGE_PATH = Path(REPO_STORAGE)
-SHELL_CONCURRENCY_LIMIT = int(os.getenv("SHELL_CONCURRENCY_LIMIT", 100))
-FS_CONCURRENCY_LIMIT = int(os.getenv("FS_CONCURRENCY_LIMIT", 50))
+# Default time budget in seconds for fetch and commit requests, 0 means no deadline
+REQUEST_DEADLINE = float(os.getenv("REQUEST_DEADLINE", 0))
+# Locks and caches shared between workers
+SHARED_STATE_PATH = REPO_STORAGE_PATH / ".shared"
+# `checkout` keeps a sparse checkout of every fetched branch. `objects` keeps the fetched branches of a repo
+# in a single bare object store and reads workflows from it; branches are only checked out to be edited.
+WORKFLOW_READ_MODE = os.getenv("WORKFLOW_READ_MODE", "checkout")
+OBJECT_STORE_PATH = REPO_STORAGE_PATH / ".objects"
+
+#
+# Number of server worker processes. Concurrency limits are set per instance and split between workers.
+WORKERS = int(os.getenv("WORKERS", 1))
+SHELL_CONCURRENCY_LIMIT = max(int(os.getenv("SHELL_CONCURRENCY_LIMIT", 100)) // WORKERS, 1)
+FS_CONCURRENCY_LIMIT = max(int(os.getenv("FS_CONCURRENCY_LIMIT", 50)) // WORKERS, 1)
+# Git processes, files and upstream connections share a budget of file descriptors per worker: RLIMIT_NOFILE
+# less this reserve for incoming connections and whatever else is opened outside the budget
+FD_RESERVE = int(os.getenv("FD_RESERVE", 256))
+# Raise the soft RLIMIT_NOFILE up to the hard limit on startup
+RAISE_NOFILE_LIMIT = os.getenv("RAISE_NOFILE_LIMIT", "true").lower() == "true"
+
+#
+# Commit scheduling
+COMMIT_CONCURRENCY_LIMIT = max(int(os.getenv("COMMIT_CONCURRENCY_LIMIT", 20)) // WORKERS, 1)
+COMMIT_REPO_CONCURRENCY_LIMIT = int(os.getenv("COMMIT_REPO_CONCURRENCY_LIMIT", 4))
+COMMIT_TOKEN_CONCURRENCY_LIMIT = max(int(os.getenv("COMMIT_TOKEN_CONCURRENCY_LIMIT", 10)) // WORKERS, 1)
+# Max pushes or GraphQL commits of a branch when its remote head moves on in the meantime
+COMMIT_MAX_ATTEMPTS = int(os.getenv("COMMIT_MAX_ATTEMPTS", 3))
+# `branch` pushes every branch separately, `repository` pushes all branches of a repo with a single `git push`
+GIT_PUSH_MODE = os.getenv("GIT_PUSH_MODE", "branch")
+GIT_PUSH_ATOMIC = os.getenv("GIT_PUSH_ATOMIC", "false").lower() == "true"
+PUSH_STAGING_PATH = REPO_STORAGE_PATH / ".push"
+# Max number of branch commits sent in a single GraphQL document when using installation tokens. Branches of several
+# repositories of an organization share a document, up to COMMIT_REPO_CONCURRENCY_LIMIT branches per repository.
+GRAPHQL_COMMIT_BATCH_SIZE = int(os.getenv("GRAPHQL_COMMIT_BATCH_SIZE", 10))
+
+#
+# Background sync
+SYNC_ORGS = [org.strip() for org in os.getenv("SYNC_ORGS", "").split(",") if org.strip()]
+SYNC_INTERVAL = int(os.getenv("SYNC_INTERVAL", 900))
+SYNC_JITTER = float(os.getenv("SYNC_JITTER", 0.1))
+SYNC_CONCURRENCY_LIMIT = int(os.getenv("SYNC_CONCURRENCY_LIMIT", 10))
+# Warm up the branch heads catalog and the workflow index from the checkouts on disk when the app starts,
+# for SYNC_ORGS if set, or for every org directory in REPO_STORAGE otherwise
+WARM_CACHES_ON_STARTUP = os.getenv("WARM_CACHES_ON_STARTUP", "false").lower() == "true"
+# Org snapshots, see `python cli.py export`, restored while warming up for the orgs which have nothing fetched yet
+RESTORE_SNAPSHOTS = [path.strip() for path in os.getenv("RESTORE_SNAPSHOTS", "").split(",") if path.strip()]
+
+#
+# Responses
+# Number of serialized and compressed workflow listings kept in memory
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", 64))
+
+#
+# Diagnostics
+# Bearer token required by /api/admin endpoints (traces, profiling, resources and snapshots).
+# While it's empty, these endpoints are disabled.
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+MAX_PROFILE_SECONDS = float(os.getenv("MAX_PROFILE_SECONDS", 60))
 
 #
 # GitHub API
 GITHUB_API_ENDPOINT = os.getenv("GITHUB_API_ENDPOINT", "api.github.com")
 GITHUB_API_URL = os.getenv("GITHUB_API_URL", f"https://{GITHUB_API_ENDPOINT}")
 GITHUB_GRAPHQL_ENDPOINT = os.getenv("GITHUB_GRAPHQL_ENDPOINT", f"{GITHUB_API_ENDPOINT}/graphql")
+# Base URL of git remotes. Non-HTTP URLs like `file:///srv/git` are used as is, without credentials.
+GITHUB_GIT_URL = os.getenv("GITHUB_GIT_URL", "https://github.com").rstrip("/")
 PREDEFINED_RUNS_ON_LABELS = [
     label.strip() for label in os.getenv(
         "PREDEFINED_RUNS_ON_LABELS",
@@ -26,6 +84,9 @@ PREDEFINED_RUNS_ON_LABELS = [
     if label.strip()
 ]
 
+# Secret of the GitHub webhook sending push, create and delete events to /api/webhooks/github
+GITHUB_WEBHOOK_SECRET = os.getenv("GITHUB_WEBHOOK_SECRET")
+
 #
 # For self-hosted flow
 GITHUB_PERSONAL_ACCESS_TOKEN = os.getenv("GITHUB_PERSONAL_ACCESS_TOKEN")
@@ -36,6 +97,8 @@ COMMIT_EMAIL = os.getenv("COMMIT_EMAIL", "198101009+puzl-cloud[bot]@users.norepl
 # For application flow
 GITHUB_INSTALLATION_TOKEN_PROVIDER = os.getenv("GITHUB_INSTALLATION_TOKEN_PROVIDER")
 GITHUB_INSTALLATION_TOKEN_PROVIDER_SECRET = os.getenv("GITHUB_INSTALLATION_TOKEN_PROVIDER_SECRET")
+# Installation tokens expiring within this number of seconds are renewed in the background
+TOKEN_RENEW_MARGIN = int(os.getenv("TOKEN_RENEW_MARGIN", 600))
 
 assert GITHUB_INSTALLATION_TOKEN_PROVIDER or GITHUB_PERSONAL_ACCESS_TOKEN, \
     "You must provide either a Personal Access Token https://docs.github.com/en/authentication/keeping-your-account-and-data-secure/managing-your-personal-access-tokens#creating-a-fine-grained-personal-access-token"
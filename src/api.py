@@ -1,6 +1,11 @@
+import re
+import hmac
+import json
+import time
 import logging
 import asyncio
 import itertools
+import functools
 from typing import Awaitable
 from dataclasses import asdict
 from http.client import responses
@@ -9,10 +14,23 @@ from sanic import SanicException, BadRequest, NotFound, Unauthorized
 from sanic.blueprints import Blueprint
 from sanic.response import json as sanic_json
 from sanic.response import file as sanic_file
+from sanic.response import text as sanic_text
+from sanic.response import raw as sanic_raw
+from sanic.response import HTTPResponse
 
 from .utils.github import *
 from .utils.files import *
-from .token_provider import get_github_token
+from .utils.scheduler import commit_scheduler
+from .utils.concurrency import single_flight, deadline, gather_within_deadline, DeadlineExceeded
+from .token_provider import get_github_token, token_manager
+from .index import workflow_index
+from .utils.metrics import HTTP_REQUESTS, HTTP_REQUEST_DURATION, HTTP_RESPONSE_BYTES, render_metrics
+from .utils.tracing import start_trace, span, recent_traces, profile_cpu, profile_memory
+from .utils.responses import EncodedBodyCache, available_encodings
+from .utils.resources import governor
+from .models import storage_path
+from .commits import commit_branch, commit_workflows
+from .snapshots import export_snapshot, import_snapshot
 
 
 health_bp = Blueprint("health", "/health")
@@ -22,6 +40,14 @@ health_bp = Blueprint("health", "/health")
 async def health(request):
     return sanic_json({"status": True})
 
+
+metrics_bp = Blueprint("metrics", "/metrics")
+
+
+@metrics_bp.get("/", strict_slashes=False)
+async def metrics(request):
+    return sanic_text(render_metrics(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
 #
 # UI
 static_bp = Blueprint("static", url_prefix="")
@@ -35,6 +61,9 @@ org_workflows_bp = Blueprint(
     "org_workflows", url_prefix=f"{API_PREFIX}/orgs/<org_name>/workflows", strict_slashes=False)
 org_workflow_fetch_bp = Blueprint(
     "org_workflow_fetch", url_prefix=f"{API_PREFIX}/orgs/<org_name>/fetch-workflows", strict_slashes=False)
+org_label_usage_bp = Blueprint(
+    "org_label_usage", url_prefix=f"{API_PREFIX}/orgs/<org_name>/label-usage", strict_slashes=False)
+org_search_bp = Blueprint("org_search", url_prefix=f"{API_PREFIX}/orgs/<org_name>/search", strict_slashes=False)
 
 repos_bp = Blueprint("repos", url_prefix=f"{API_PREFIX}/orgs/<org_name>/repos", strict_slashes=False)
 repo_workflows_bp = Blueprint(
@@ -42,13 +71,56 @@ repo_workflows_bp = Blueprint(
 repo_workflow_fetch_bp = Blueprint(
     "repo_workflow_fetch", url_prefix=f"{API_PREFIX}/orgs/<org_name>/repos/<repo_name>/fetch-workflows",
     strict_slashes=False)
+repo_label_usage_bp = Blueprint(
+    "repo_label_usage", url_prefix=f"{API_PREFIX}/orgs/<org_name>/repos/<repo_name>/label-usage",
+    strict_slashes=False)
+repo_search_bp = Blueprint(
+    "repo_search", url_prefix=f"{API_PREFIX}/orgs/<org_name>/repos/<repo_name>/search", strict_slashes=False)
 
 workflows_bp = Blueprint("workflows", url_prefix=f"{API_PREFIX}/workflows", strict_slashes=False)
 runs_on_labels_bp = Blueprint("runs_on_labels", url_prefix=f"{API_PREFIX}/runs-on-labels", strict_slashes=False)
+token_cache_bp = Blueprint("token_cache", url_prefix=f"{API_PREFIX}/token-cache", strict_slashes=False)
+webhooks_bp = Blueprint("webhooks", url_prefix=f"{API_PREFIX}/webhooks", strict_slashes=False)
+admin_bp = Blueprint("admin", url_prefix=f"{API_PREFIX}/admin", strict_slashes=False)
 
 # Create /api group
 api_bp = Blueprint.group(orgs_bp, repos_bp, org_workflows_bp, repo_workflows_bp, org_workflow_fetch_bp,
-                         repo_workflow_fetch_bp, workflows_bp, runs_on_labels_bp)
+                         repo_workflow_fetch_bp, org_label_usage_bp, repo_label_usage_bp, org_search_bp,
+                         repo_search_bp, workflows_bp, runs_on_labels_bp, token_cache_bp, webhooks_bp, admin_bp)
+
+
+def traced(name: str):
+    """
+    Trace the handler: stage spans recorded while it runs are returned in the `Server-Timing` header
+    and kept for `GET /api/admin/traces`.
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(request, *args, **kwargs):
+            with start_trace(name, path=request.path) as trace:
+                response = await handler(request, *args, **kwargs)
+            if response is not None:
+                response.headers["Server-Timing"] = trace.server_timing()
+                response.headers["X-Trace-Id"] = trace.trace_id
+            return response
+        return wrapper
+    return decorator
+
+
+@api_bp.middleware("request")
+async def start_request_timer(request):
+    request.ctx.started_at = time.monotonic()
+
+
+@api_bp.middleware("response")
+async def record_request_metrics(request, response):
+    route = request.route.path if request.route else "unmatched"
+    status = str(response.status) if response else "none"
+    HTTP_REQUESTS.inc(method=request.method, route=route, status=status)
+    if hasattr(request.ctx, "started_at"):
+        HTTP_REQUEST_DURATION.observe(time.monotonic() - request.ctx.started_at, method=request.method, route=route)
+    if response is not None and response.body:
+        HTTP_RESPONSE_BYTES.inc(len(response.body), route=route)
 
 
 @runs_on_labels_bp.get("/", strict_slashes=False)
@@ -56,8 +128,131 @@ async def runs_on_labels(request):
     return sanic_json({"labels": PREDEFINED_RUNS_ON_LABELS})
 
 
+@admin_bp.middleware("request")
+async def check_admin_token(request):
+    # Without a token the admin endpoints don't exist
+    if not ADMIN_TOKEN:
+        raise NotFound()
+    if not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {ADMIN_TOKEN}"):
+        raise Unauthorized("Invalid admin token.")
+
+
+def profile_params(request) -> Tuple[float, int]:
+    try:
+        seconds = min(max(float(request.args.get("seconds", 10)), 0.1), MAX_PROFILE_SECONDS)
+        limit = min(max(int(request.args.get("limit", 50)), 1), 1000)
+    except ValueError:
+        raise BadRequest("Invalid profile parameters.")
+    return seconds, limit
+
+
+@admin_bp.get("/traces", strict_slashes=False)
+async def traces(request):
+    """
+    Recent request traces as OTLP/JSON, newest first, e.g. to post to an OTLP collector's `/v1/traces`.
+    """
+    trace_id = request.args.get("trace_id")
+    selected = [t for t in reversed(recent_traces) if not trace_id or t.trace_id == trace_id]
+    if trace_id and not selected:
+        raise NotFound()
+    return sanic_json({"resourceSpans": [rs for t in selected for rs in t.to_otlp()["resourceSpans"]]})
+
+
+@admin_bp.post("/profile/cpu", strict_slashes=False)
+async def cpu_profile(request):
+    seconds, limit = profile_params(request)
+    try:
+        report = await profile_cpu(seconds, limit, request.args.get("sort", "cumulative"))
+    except RuntimeError as e:
+        raise SanicException(str(e), status_code=409)
+    except ValueError as e:
+        raise BadRequest(str(e))
+    return sanic_text(report)
+
+
+@admin_bp.post("/profile/memory", strict_slashes=False)
+async def memory_profile(request):
+    seconds, limit = profile_params(request)
+    group_by = request.args.get("group_by", "lineno")
+    if group_by not in ("lineno", "filename", "traceback"):
+        raise BadRequest("Invalid group_by. Expected `lineno`, `filename` or `traceback`.")
+    try:
+        return sanic_json(await profile_memory(seconds, limit, group_by))
+    except RuntimeError as e:
+        raise SanicException(str(e), status_code=409)
+
+
+@admin_bp.get("/resources", strict_slashes=False)
+async def resources(request):
+    """
+    File descriptor budget of this worker and how it is shared between git processes, files and connections.
+    """
+    return sanic_json(governor.stats())
+
+
+@admin_bp.get("/snapshots/<org_name>", strict_slashes=False)
+async def get_snapshot(request, org_name: str):
+    """
+    The fetched workflows, branch heads and `runs-on` labels of an org as a gzipped JSON snapshot.
+    """
+    if not is_tracked_locally(org_name):
+        raise NotFound()
+    return sanic_raw(await export_snapshot(org_name), content_type="application/gzip", headers={
+        "Content-Disposition": f'attachment; filename="{org_name}.snapshot.json.gz"'})
+
+
+@admin_bp.put("/snapshots/<org_name>", strict_slashes=False)
+async def put_snapshot(request, org_name: str):
+    """
+    Restore the branches of an org from a snapshot taken with `GET /api/admin/snapshots/<org_name>`.
+    """
+    try:
+        summary = await import_snapshot(request.body, org_name)
+    except ValueError as e:
+        raise BadRequest(str(e))
+    return sanic_json(summary)
+
+
+@token_cache_bp.get("/", strict_slashes=False)
+async def token_cache(request):
+    return sanic_json(token_manager.stats())
+
+
+@webhooks_bp.post("/github", strict_slashes=False)
+async def github_webhook(request):
+    if not verify_webhook_signature(GITHUB_WEBHOOK_SECRET, request.body, request.headers.get("X-Hub-Signature-256")):
+        raise Unauthorized("Invalid webhook signature.")
+
+    event = request.headers.get("X-GitHub-Event", "")
+    if event == "ping":
+        return sanic_json({"status": "pong"})
+    action = plan_webhook_event(event, request.json or {}, is_tracked_locally)
+    if not action:
+        return sanic_json({"action": None})
+
+    async def _apply() -> None:
+        org, repo_name = action.repo.split("/", 1)
+        try:
+            token = await get_github_token(org)
+            await github_apply_webhook_action(action, token)
+        except Exception as e:
+            logging.error(f"Could not apply webhook action {action}: {e}")
+        await workflow_index.invalidate(org, repo_name)
+
+    # GitHub expects a response within seconds, so refetch in the background
+    request.app.add_task(_apply())
+    logging.info(f"Webhook `{event}` for `{action.repo}` branch `{action.branch}`: {action.kind}")
+    return sanic_json({"action": asdict(action)}, status=202)
+
+
 @orgs_bp.get("/", strict_slashes=False)
 async def orgs(request):
+    if not GITHUB_PERSONAL_ACCESS_TOKEN:
+        try:
+            return sanic_json(await token_manager.installed_orgs())
+        except RESTAPIError as e:
+            raise SanicException(status_code=e.status, message=responses[e.status])
+
     token = await get_github_token()
     if not token.value:
         raise Unauthorized()
@@ -85,35 +280,229 @@ async def repos(request, org_name: str):
 
 @org_workflow_fetch_bp.get("/", strict_slashes=False)
 @repo_workflow_fetch_bp.get("/", strict_slashes=False)
+@traced("fetch_workflows")
 async def fetch_workflows(request, org_name: str, repo_name: str = None):
     token = await get_github_token(org_name)
     if not token.value:
         raise Unauthorized()
+    policy = fetch_policy(request)
     try:
-        fetched_branches = await github_clone_all_workflows(token, org_name, repo_name)
+        with deadline(request_deadline(request)):
+            fetched_branches = await single_flight(
+                (org_name, repo_name, "fetch", repr(policy)),
+                lambda: github_clone_all_workflows(token, org_name, repo_name, policy))
     except ValueError:
         raise NotFound()
-    logging.info(f"{len(fetched_branches)} branches were fetched from `{org_name}/{repo_name if repo_name else ''}`")
-    return sanic_json([asdict(branch) for branch in fetched_branches])
+    await workflow_index.invalidate(org_name, repo_name)
+    incomplete = len([branch for branch in fetched_branches if branch.error])
+    logging.info(f"{len(fetched_branches) - incomplete} branches were fetched from "
+                 f"`{org_name}/{repo_name if repo_name else ''}`, {incomplete} were not fetched in time")
+    with span("serialize"):
+        return sanic_json([asdict(branch) for branch in fetched_branches],
+                          headers={"X-Partial-Result": str(bool(incomplete)).lower()})
+
+
+def request_deadline(request) -> Optional[float]:
+    try:
+        return float(request.args.get("deadline", REQUEST_DEADLINE)) or None
+    except ValueError:
+        raise BadRequest("Invalid deadline. Expected a number of seconds.")
+
+
+def fetch_policy(request) -> Optional[BranchPolicy]:
+    """
+    Branch selection from the `default_only`, `include`, `exclude`, `recent_days` and `max_branches` query args.
+    """
+    args = request.args
+    if not any(name in args for name in ("default_only", "include", "exclude", "recent_days", "max_branches")):
+        return None
+    try:
+        return BranchPolicy(
+            default_only=args.get("default_only", "false").lower() == "true",
+            include=args.getlist("include", []),
+            exclude=args.getlist("exclude", []),
+            recent_days=float(args["recent_days"][0]) if "recent_days" in args else None,
+            max_per_repo=max(int(args["max_branches"][0]), 1) if "max_branches" in args else None,
+        )
+    except ValueError:
+        raise BadRequest("Invalid fetch policy.")
 
 
 @org_workflows_bp.get("/", strict_slashes=False)
 @repo_workflows_bp.get("/", strict_slashes=False)
+@traced("get_workflows")
 async def get_workflows(request, org_name: str, repo_name: str = None):
     token = await get_github_token(org_name)
     if not token.value:
         raise Unauthorized()
-    path = REPO_STORAGE_PATH / org_name
-    if repo_name:
-        path = path / repo_name
-    all_workflows = await find_all_workflow_files(in_path=path)
+    with span("index"):
+        all_workflows = await workflow_index.get(org_name, repo_name)
     logging.info(f"{len(all_workflows)} workflows found in `{org_name}/{repo_name if repo_name else ''}`")
-    return sanic_json([wf.serialize() for wf in all_workflows])
 
+    version = workflow_index.version(org_name)
+    encoding = negotiate_encoding(request.headers.get("Accept-Encoding"), available_encodings())
+    # Each coding is a different representation, so it gets its own strong validator. The tag names the negotiated
+    # coding rather than the applied one: bodies too small to compress are sent as is, but always so for a given
+    # version and coding, so the tag is known before the body is built.
+    etag = f'"{version}-{encoding}"'
+    headers = {"ETag": etag, "Vary": "Accept-Encoding", "Cache-Control": "no-cache"}
+    if etag_matches(request.headers.get("If-None-Match"), etag):
+        return HTTPResponse(status=304, headers=headers)
+
+    async def _serialize() -> bytes:
+        # Index order depends on the order entries were added in, which differs between workers
+        return await asyncio.to_thread(lambda: json.dumps(
+            [wf.serialize() for wf in sorted(all_workflows, key=lambda wf: wf.path)], separators=(",", ":")).encode())
+
+    body, encoding = await workflows_body_cache.get((org_name, repo_name), version, encoding, _serialize)
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return sanic_raw(body, headers=headers, content_type="application/json")
+
+
+@org_label_usage_bp.get("/", strict_slashes=False)
+@repo_label_usage_bp.get("/", strict_slashes=False)
+async def get_label_usage(request, org_name: str, repo_name: str = None):
+    """
+    `runs-on` label usage of the fetched workflows: workflows and jobs per label, with the top repos using
+    each label, or its top branches for a single repo. `label` narrows the result down to the given labels.
+    """
+    token = await get_github_token(org_name)
+    if not token.value:
+        raise Unauthorized()
+    try:
+        top = min(max(int(request.args.get("top", 10)), 1), 1000)
+    except ValueError:
+        raise BadRequest("Invalid top parameter.")
+    labels = request.args.getlist("label")
+
+    usage = await workflow_index.label_usage(org_name, f"{org_name}/{repo_name}" if repo_name else None, top)
+    if labels:
+        usage = [u for u in usage if u["label"] in labels]
+    return sanic_json({"org": org_name, "repo": repo_name, "version": workflow_index.version(org_name),
+                       "labels": usage})
+
+
+@org_search_bp.get("/", strict_slashes=False)
+@repo_search_bp.get("/", strict_slashes=False)
+async def search_workflows(request, org_name: str, repo_name: str = None):
+    """
+    Full-text search over the fetched workflows. `q` is matched as a substring, or as a regular expression
+    with `regex=true`, line by line; `branch` narrows the search down to a single branch.
+    """
+    token = await get_github_token(org_name)
+    if not token.value:
+        raise Unauthorized()
+    query = request.args.get("q", "")
+    if not query or len(query) > 1000:
+        raise BadRequest("Invalid q parameter. Expected 1 to 1000 characters.")
+    try:
+        context = min(max(int(request.args.get("context", 2)), 0), 10)
+        limit = min(max(int(request.args.get("limit", 100)), 1), 1000)
+    except ValueError:
+        raise BadRequest("Invalid context or limit parameter.")
+
+    try:
+        result = await workflow_index.search(
+            org_name, query, regex=request.args.get("regex", "false").lower() == "true",
+            ignore_case=request.args.get("ignore_case", "false").lower() == "true",
+            repo=f"{org_name}/{repo_name}" if repo_name else None, branch=request.args.get("branch"),
+            context=context, limit=limit)
+    except re.error as e:
+        raise BadRequest(f"Invalid regular expression: {e}")
+    return sanic_json({"org": org_name, "repo": repo_name, "version": workflow_index.version(org_name)} | result)
+
+
+@workflows_bp.post("/diff", strict_slashes=False)
+async def diff_workflows(request):
+    """
+    Preview pending changes as unified diffs against the local checkout. The payload is either
+    `{"workflows": [{"path": ..., "content": <base64>}, ...]}` or a replacement rule
+    `{"rule": {"labels": [...], "replacement": "..."}, "paths": ["org/repo/branch", "org/repo", "org", ...]}`.
+    """
+    data = request.json
+    if not isinstance(data, dict):
+        raise BadRequest("Invalid payload. Expected a JSON object.")
+
+    try:
+        page = max(int(request.args.get("page", 1)), 1)
+        per_page = min(max(int(request.args.get("per_page", 100)), 1), 1000)
+        context = min(max(int(request.args.get("context", 3)), 0), 100)
+    except ValueError:
+        raise BadRequest("Invalid pagination parameters.")
+
+    if "rule" in data:
+        rule, paths = data["rule"], data.get("paths")
+        if not isinstance(rule, dict) or not isinstance(rule.get("labels"), list) \
+                or not isinstance(rule.get("replacement"), str) or not isinstance(paths, list) or not paths:
+            raise BadRequest("Invalid payload. Expected a rule with labels and replacement, and a list of paths.")
+        try:
+            paths = [storage_path(p) for p in paths]
+        except (TypeError, ValueError) as e:
+            raise BadRequest(f"Invalid path: {e}")
+        all_orgs = list(set([Path(p).parts[0] for p in paths]))
+        changes = [
+            (wf, wf.content, updated) for wf, updated in await find_workflow_changes_by_rule(
+                [REPO_STORAGE_PATH / p for p in paths], rule["labels"], rule["replacement"])
+        ]
+    else:
+        try:
+            workflows = [GitHubWorkflow.deserialize(wf) for wf in data.get("workflows", [])]
+        except Exception:
+            raise BadRequest("Invalid payload. Expected path and base64 encoded content of each workflow file.")
+        all_orgs = list(set([wf.org for wf in workflows]))
+        originals = await read_original_workflows(workflows)
+        changes = [(wf, originals[i], wf.content) for i, wf in enumerate(workflows)]
+
+    tokens = await asyncio.gather(*[get_github_token(org_name) for org_name in all_orgs])
+    if not [t for t in tokens if t.value]:
+        raise Unauthorized()
+
+    diffs = await diff_workflow_changes(changes, context)
+    stats: Dict[str, Dict[str, Dict[str, int]]] = {}
+    for d in diffs:
+        branch_stats = stats.setdefault(d.repo, {}).setdefault(d.branch, {"files": 0, "additions": 0, "deletions": 0})
+        branch_stats["files"] += 1
+        branch_stats["additions"] += d.additions
+        branch_stats["deletions"] += d.deletions
+
+    logging.info(f"{len(diffs)} workflow changes previewed for {len(stats)} repos")
+    return sanic_json({
+        "total": len(diffs),
+        "page": page,
+        "per_page": per_page,
+        "stats": stats,
+        "diffs": [asdict(d) for d in diffs[(page - 1) * per_page:page * per_page]],
+    })
+
+
+async def invalidate_workflows(workflows: List[GitHubWorkflow]) -> None:
+    for repo in set(wf.repo for wf in workflows):
+        await workflow_index.invalidate(*repo.split("/", 1))
+
+
+workflows_body_cache = EncodedBodyCache(max_entries=RESPONSE_CACHE_SIZE)
+
+
+@workflows_bp.get("/commit-queue", strict_slashes=False)
+async def commit_queue(request):
+    return sanic_json(commit_scheduler.stats())
 
-@workflows_bp.put("/", strict_slashes=False)
+
+@workflows_bp.put("/", strict_slashes=False, stream=True)
+@traced("put_workflows")
 async def put_workflows(request):
-    data = request.json
+    with deadline(request_deadline(request)):
+        if request.content_type and "ndjson" in request.content_type:
+            return await put_workflows_stream(request)
+        return await put_workflows_json(request)
+
+
+async def put_workflows_json(request):
+
+    with span("receive"):
+        await request.receive_body()
+        data = request.json
     if not isinstance(data, list):
         raise BadRequest("Invalid payload. Expected a JSON array.")
 
@@ -122,39 +511,30 @@ async def put_workflows(request):
     except Exception:
         raise BadRequest("Invalid payload. Expected path and base64 encoded content of each workflow file.")
 
-    write_results = await asyncio.gather(*[write_file(wf) for wf in workflows], return_exceptions=True)
-    return_results = {}
-    for i, res in enumerate(write_results):
-        if isinstance(res, Exception):
-            logging.error(res)
-            return_results[str(workflows[i].path)] = {"error": f"Could not write file changes. Error: {res}"}
-
     all_orgs = list(set([wf.org for wf in workflows]))
     tokens = await asyncio.gather(*[get_github_token(org_name) for org_name in all_orgs])
     if not [t for t in tokens if t.value]:
         raise Unauthorized()
     tokens = {t.org: t for t in tokens}
 
-    push_tasks: Dict[Path, Awaitable] = {}
-    commit_msg = "Bulk workflow update via GitHub Workflow Assistant by puzl.cloud [skip ci]"
-    for wf in workflows:
-        if wf.branch_full_path in push_tasks:
-            continue
+    with span("checkout"):
+        await github_materialize_checkouts(workflows, tokens)
+    with span("write", files=len(workflows)):
+        write_results = await write_workflows(workflows)
+    await invalidate_workflows(workflows)
+    return_results = {}
+    for i, res in enumerate(write_results):
+        if isinstance(res, Exception):
+            logging.error(res)
+            return_results[str(workflows[i].path)] = {"error": f"Could not write file changes. Error: {res}"}
 
-        token = tokens[wf.org]
-        if token.is_installation:
-            push_tasks[wf.branch_full_path] = github_commit_graphql(
-                repo=wf.repo, branch=wf.branch, token=token, local_repo=wf.branch_full_path, message=commit_msg)
-        else:
-            push_tasks[wf.branch_full_path] = github_commit_and_push(
-                repo=wf.repo, branch=wf.branch, token=token, local_repo=wf.branch_full_path, message=commit_msg,
-                email=COMMIT_EMAIL, author=COMMIT_AUTHOR
-            )
-
-    commit_results = await asyncio.gather(*push_tasks.values(), return_exceptions=True)
-    all_branch_paths = list(push_tasks.keys())
-    for i, res in enumerate(commit_results):
-        res_key = str(all_branch_paths[i])
+    with span("commit", branches=len(set(wf.branch_full_path for wf in workflows))):
+        branch_results = await commit_workflows(workflows, tokens)
+    # Commits may refetch checkouts
+    await invalidate_workflows(workflows)
+
+    for branch_path, res in branch_results.items():
+        res_key = str(branch_path)
         if isinstance(res, Exception):
             logging.error(res)
             return_results[res_key] = {"error": f"Could not commit workflow changes. Error: {res}"}
@@ -162,3 +542,114 @@ async def put_workflows(request):
             return_results[res_key] = {"success": True}
 
     return sanic_json(return_results)
+
+
+async def put_workflows_stream(request):
+    """
+    NDJSON flavour of `PUT /api/workflows`. Each request line is either a workflow file
+    `{"path": ..., "content": <base64>}`, written as soon as it arrives, or a branch completion marker
+    `{"commit": "org/repo/branch"}`, which starts committing that branch once its files are written.
+    Branches without a marker are committed at the end of the body. Each response line is a single-key
+    object `{<path>: {"success": true} | {"error": ...}}`, so merging all lines gives the same result
+    as the JSON array flavour of this endpoint. Invalid request lines are reported as `{"line <n>": {"error": ...}}`,
+    numbered from 1.
+    """
+    response = await request.respond(content_type="application/x-ndjson")
+    send_lock = asyncio.Lock()
+
+    async def _send(key: str, result: Dict) -> None:
+        if "error" in result:
+            logging.error(result["error"])
+        async with send_lock:
+            await response.send(json.dumps({key: result}) + "\n")
+
+    tokens: Dict[str, Awaitable] = {}
+    checkouts: Dict[Path, Awaitable] = {}
+    branch_writes: Dict[Path, List[asyncio.Task]] = {}
+    branch_workflows: Dict[Path, GitHubWorkflow] = {}
+    commit_tasks: Dict[Path, asyncio.Task] = {}
+
+    async def _checkout(wf: GitHubWorkflow) -> None:
+        await github_materialize_checkouts([wf], {wf.org: await tokens[wf.org]})
+
+    async def _write(wf: GitHubWorkflow) -> None:
+        try:
+            await checkouts[wf.branch_full_path]
+            error, = await write_workflows([wf])
+            if error:
+                raise error
+            await invalidate_workflows([wf])
+        except Exception as e:
+            await _send(str(wf.path), {"error": f"Could not write file changes. Error: {e}"})
+            raise
+
+    async def _commit(branch_path: Path) -> None:
+        wf = branch_workflows[branch_path]
+        await asyncio.gather(*branch_writes.pop(branch_path, []), return_exceptions=True)
+        try:
+            token = await tokens[wf.org]
+            if not token.value:
+                raise PermissionError(f"No GitHub token available for `{wf.org}`")
+            await commit_branch(wf, token)
+            await invalidate_workflows([wf])
+        except Exception as e:
+            await _send(str(branch_path), {"error": f"Could not commit workflow changes. Error: {e}"})
+        else:
+            await _send(str(branch_path), {"success": True})
+
+    def _schedule_commit(branch_path: Path) -> None:
+        if branch_path in branch_workflows and branch_path not in commit_tasks:
+            commit_tasks[branch_path] = asyncio.create_task(_commit(branch_path))
+
+    async def _process_line(line: bytes, line_number: int) -> None:
+        if not line.strip():
+            return
+        try:
+            item = json.loads(line)
+            if "commit" in item:
+                _schedule_commit(REPO_STORAGE_PATH / storage_path(item["commit"]))
+                return
+            wf = GitHubWorkflow.deserialize(item)
+        except Exception:
+            await _send(f"line {line_number}", {
+                "error": "Invalid payload line. Expected path and base64 encoded content of a workflow file, "
+                         "or a commit marker."})
+            return
+
+        if wf.branch_full_path in commit_tasks:
+            await _send(str(wf.path), {"error": "Branch has already been committed."})
+            return
+        if wf.org not in tokens:
+            tokens[wf.org] = asyncio.ensure_future(get_github_token(wf.org))
+        branch_workflows.setdefault(wf.branch_full_path, wf)
+        if wf.branch_full_path not in checkouts:
+            checkouts[wf.branch_full_path] = asyncio.ensure_future(_checkout(wf))
+        branch_writes.setdefault(wf.branch_full_path, []).append(asyncio.create_task(_write(wf)))
+
+    try:
+        # Only the unfinished last line is kept, and only the newly received bytes are searched for line ends
+        buffer, line_number = bytearray(), 0
+        while True:
+            body = await request.stream.read()
+            if body is None:
+                break
+            start, consumed = len(buffer), 0
+            buffer += body
+            while (end := buffer.find(b"\n", start)) != -1:
+                line_number += 1
+                await _process_line(bytes(buffer[consumed:end]), line_number)
+                consumed = start = end + 1
+            del buffer[:consumed]
+        await _process_line(bytes(buffer), line_number + 1)
+
+        for branch_path in list(branch_workflows):
+            _schedule_commit(branch_path)
+        commit_results = await gather_within_deadline(*commit_tasks.values())
+        for branch_path, res in zip(commit_tasks, commit_results):
+            if isinstance(res, DeadlineExceeded):
+                await _send(str(branch_path), {"error": f"Could not commit workflow changes. Error: {res}"})
+        await response.eof()
+    finally:
+        # The client may have gone away: don't keep writing and committing on its behalf
+        for task in itertools.chain(commit_tasks.values(), checkouts.values(), *branch_writes.values()):
+            task.cancel()
@@ -0,0 +1,121 @@
+from pathlib import Path
+from typing import Awaitable, Dict, List, Optional, Tuple
+
+from env import *
+from src.models import GitHubWorkflow, Token
+from src.utils.github import github_commit_graphql, github_commit_and_push, github_commit_and_push_many, \
+    github_commit_graphql_many
+from src.utils.scheduler import commit_scheduler
+from src.utils.concurrency import gather_within_deadline
+
+
+COMMIT_MESSAGE = "Bulk workflow update via GitHub Workflow Assistant by puzl.cloud [skip ci]"
+
+
+def commit_branch(wf: GitHubWorkflow, token: Token, message: str = COMMIT_MESSAGE) -> Awaitable:
+    def _commit() -> Awaitable:
+        if token.is_installation:
+            return github_commit_graphql(
+                repo=wf.repo, branch=wf.branch, token=token, local_repo=wf.branch_full_path, message=message)
+        return github_commit_and_push(
+            repo=wf.repo, branch=wf.branch, token=token, local_repo=wf.branch_full_path, message=message,
+            email=COMMIT_EMAIL, author=COMMIT_AUTHOR
+        )
+
+    return commit_scheduler.submit(wf.org, wf.repo, wf.branch_full_path, token, _commit)
+
+
+async def commit_repository(workflows: List[GitHubWorkflow], token: Token, message: str = COMMIT_MESSAGE) \
+        -> Dict[Path, Optional[Exception]]:
+    """
+    Commit all the given branches of a single repository and push them with one `git push`.
+    """
+    repo_workflow = workflows[0]
+    branches = {wf.branch: wf.branch_full_path for wf in workflows}
+
+    def _commit() -> Awaitable:
+        return github_commit_and_push_many(
+            repo=repo_workflow.repo, branches=branches, token=token, message=message, email=COMMIT_EMAIL,
+            author=COMMIT_AUTHOR, atomic=GIT_PUSH_ATOMIC)
+
+    results = await commit_scheduler.submit_group(
+        repo_workflow.org, {wf.branch_full_path: wf.repo for wf in workflows}, token, _commit)
+    return {branches[branch]: res for branch, res in results.items()}
+
+
+async def commit_graphql_batch(workflows: List[GitHubWorkflow], token: Token, message: str = COMMIT_MESSAGE) \
+        -> Dict[Path, Optional[Exception]]:
+    """
+    Commit the given branches, of one or more repositories of an organization, with a batched GraphQL mutation.
+    """
+    def _commit() -> Awaitable:
+        return github_commit_graphql_many(
+            token, [(wf.repo, wf.branch, wf.branch_full_path) for wf in workflows], message)
+
+    return await commit_scheduler.submit_group(
+        workflows[0].org, {wf.branch_full_path: wf.repo for wf in workflows}, token, _commit)
+
+
+def graphql_batches(workflows: List[GitHubWorkflow], batch_size: int = GRAPHQL_COMMIT_BATCH_SIZE,
+                    repo_limit: int = COMMIT_REPO_CONCURRENCY_LIMIT) -> List[List[GitHubWorkflow]]:
+    """
+    Pack the branches of an organization into batches of up to `batch_size` commits, across repositories,
+    with at most `repo_limit` branches of a repository per batch.
+    """
+    by_repo: Dict[str, List[GitHubWorkflow]] = {}
+    for wf in workflows:
+        by_repo.setdefault(wf.repo, []).append(wf)
+
+    batches: List[List[GitHubWorkflow]] = []
+    for repo_workflows in by_repo.values():
+        piece_size = min(batch_size, repo_limit)
+        for offset in range(0, len(repo_workflows), piece_size):
+            piece = repo_workflows[offset:offset + piece_size]
+            # First fit: a repository's pieces land in different batches, as each batch takes at most one of them
+            batch = next((batch for batch in batches if len(batch) + len(piece) <= batch_size
+                          and all(wf.repo != piece[0].repo for wf in batch)), None)
+            if batch is None:
+                batches.append(piece)
+            else:
+                batch.extend(piece)
+    return batches
+
+
+async def commit_workflows(workflows: List[GitHubWorkflow], tokens: Dict[str, Token], message: str = COMMIT_MESSAGE) \
+        -> Dict[Path, Optional[Exception]]:
+    """
+    Commit the already written workflows, packing branches into batched GraphQL commits across the repositories
+    of an organization, or grouping them by repository for multi-branch pushes, as configured.
+    Returns an error (or None) per branch checkout.
+    """
+    push_tasks: Dict[Path, Awaitable] = {}
+    groups: Dict[Tuple[str, str], Dict[Path, GitHubWorkflow]] = {}
+    for wf in workflows:
+        token = tokens[wf.org]
+        if token.is_installation and GRAPHQL_COMMIT_BATCH_SIZE > 1:
+            groups.setdefault(("graphql", wf.org), {}).setdefault(wf.branch_full_path, wf)
+        elif GIT_PUSH_MODE == "repository" and not token.is_installation:
+            groups.setdefault(("push", wf.repo), {}).setdefault(wf.branch_full_path, wf)
+        elif wf.branch_full_path not in push_tasks:
+            push_tasks[wf.branch_full_path] = commit_branch(wf, token, message)
+
+    group_tasks, group_branches = [], []
+    for (kind, _), branches in groups.items():
+        group_workflows = list(branches.values())
+        token = tokens[group_workflows[0].org]
+        if kind == "graphql":
+            for batch in graphql_batches(group_workflows):
+                group_tasks.append(commit_graphql_batch(batch, token, message))
+                group_branches.append([wf.branch_full_path for wf in batch])
+        else:
+            group_tasks.append(commit_repository(group_workflows, token, message))
+            group_branches.append(list(branches))
+
+    all_results = await gather_within_deadline(*push_tasks.values(), *group_tasks)
+    commit_results, group_results = all_results[:len(push_tasks)], all_results[len(push_tasks):]
+
+    branch_results: Dict[Path, Optional[Exception]] = dict(zip(push_tasks.keys(), commit_results))
+    for branches, res in zip(group_branches, group_results):
+        for branch_path in branches:
+            branch_results[branch_path] = res if isinstance(res, Exception) else res[branch_path]
+    return branch_results
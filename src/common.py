@@ -1,14 +1,52 @@
+import gzip
+import json
 import textwrap
+import difflib
+import fnmatch
+import hashlib
+import hmac
 import re
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Set
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
 
 WORKFLOW_DIR = ".github/workflows"
+SNAPSHOT_FORMAT = "gwa-snapshot"
+SNAPSHOT_VERSION = 1
+
+# The regex parser of `re` is private, so regex searches fall back to a full scan where it is not available
+try:
+    import re._parser as sre_parse
+    from re._constants import LITERAL, SUBPATTERN, MAX_REPEAT, MIN_REPEAT
+    # Possessive repeats are new in Python 3.11
+    _REPEATS = (MAX_REPEAT, MIN_REPEAT) + ((re._constants.POSSESSIVE_REPEAT,)
+                                          if hasattr(re._constants, "POSSESSIVE_REPEAT") else ())
+except (ImportError, AttributeError):
+    sre_parse = None
 
 
 def extract_runs_on_labels(workflow_yaml: str) -> Set[str]:
-    labels = set()
-    lines = textwrap.dedent(workflow_yaml).splitlines()
+    return set(label for labels in extract_runs_on_labels_by_job(workflow_yaml).values() for label in labels)
+
+
+def count_runs_on_labels(workflow_yaml: str) -> Dict[str, int]:
+    """
+    Number of jobs using each `runs-on` label of the workflow.
+    """
+    counts: Dict[str, int] = {}
+    for labels in extract_runs_on_labels_by_job(workflow_yaml).values():
+        for label in set(labels):
+            counts[label] = counts.get(label, 0) + 1
+    return counts
+
+
+def _runs_on_lines(lines: List[str]) -> Dict[int, str]:
+    """
+    Indexes of the `runs-on:` lines of the jobs of a workflow, with the names of their jobs.
+    `runs-on:` keys outside of `jobs:`, e.g. of `workflow_call` inputs, are not included.
+    """
+    found: Dict[int, str] = {}
+    job = None
     in_jobs = False
     jobs_indent = 0
     in_job = False
@@ -36,6 +74,7 @@ def extract_runs_on_labels(workflow_yaml: str) -> Set[str]:
         if indent == jobs_indent + 2 and re.match(r'^\s+[\w-]+:\s*$', line):
             in_job = True
             job_indent = indent
+            job = stripped.split(':', 1)[0]
             continue
 
         # Exit job block only on non-blank lines at or above job indent
@@ -44,34 +83,138 @@ def extract_runs_on_labels(workflow_yaml: str) -> Set[str]:
 
         # Within job, detect runs-on
         if in_job and stripped.startswith('runs-on:') and indent > job_indent:
-            # Strip inline comment from the entire value
-            raw = stripped.split('runs-on:', 1)[1].split('#', 1)[0].strip()
-
-            # Inline list (flow sequence)
-            if raw.startswith('[') and raw.endswith(']'):
-                content = raw[1:-1]
-                for part in content.split(','):
-                    item = part.strip().strip('\'"')
+            found[i] = job
+    return found
+
+
+def extract_runs_on_labels_by_job(workflow_yaml: str) -> Dict[str, List[str]]:
+    jobs: Dict[str, List[str]] = {}
+    lines = textwrap.dedent(workflow_yaml).splitlines()
+
+    for i, job in _runs_on_lines(lines).items():
+        line = lines[i]
+        stripped = line.lstrip()
+        indent = len(line) - len(stripped)
+        # Strip inline comment from the entire value
+        raw = stripped.split('runs-on:', 1)[1].split('#', 1)[0].strip()
+        labels = jobs.setdefault(job, [])
+
+        # Inline list (flow sequence)
+        if raw.startswith('[') and raw.endswith(']'):
+            content = raw[1:-1]
+            for part in content.split(','):
+                item = part.strip().strip('\'"')
+                if item:
+                    labels.append(item)
+
+        # Single value
+        elif raw:
+            part = raw.strip('\'"')
+            labels.append(part)
+
+        # Multi-line list
+        else:
+            for sub in lines[i+1:]:
+                sub_stripped = sub.lstrip()
+                sub_indent = len(sub) - len(sub_stripped)
+                if sub_indent <= indent:
+                    break
+                if sub_stripped.startswith('-'):
+                    item = sub_stripped[1:].split('#', 1)[0].strip().strip('\'"')
                     if item:
-                        labels.add(item)
-
-            # Single value
-            elif raw:
-                part = raw.strip('\'"')
-                labels.add(part)
-
-            # Multi-line list
-            else:
-                for sub in lines[i+1:]:
-                    sub_stripped = sub.lstrip()
-                    sub_indent = len(sub) - len(sub_stripped)
-                    if sub_indent <= indent:
-                        break
-                    if sub_stripped.startswith('-'):
-                        item = sub_stripped[1:].split('#', 1)[0].strip().strip('\'"')
-                        if item:
-                            labels.add(item)
-    return labels
+                        labels.append(item)
+    return jobs
+
+
+def replace_runs_on_labels_in_list(labels: List[str], labels_to_replace: Set[str], replacement: str) -> List[str]:
+    # Same semantics as the UI: the replacement takes the position of the first matched label
+    result, replaced = [], False
+    for label in labels:
+        if label in labels_to_replace:
+            if not replaced:
+                result.append(replacement)
+                replaced = True
+        else:
+            result.append(label)
+    return result
+
+
+def replace_runs_on_labels(workflow_yaml: str, labels_to_replace: Iterable[str], replacement: str) -> str:
+    labels_to_replace = set(labels_to_replace)
+    lines = workflow_yaml.splitlines(keepends=True)
+    # Only the lines the labels are extracted from
+    runs_on_lines = _runs_on_lines(lines)
+    result: List[str] = []
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        stripped = line.lstrip()
+        indent = len(line) - len(stripped)
+        i += 1
+        if i - 1 not in runs_on_lines:
+            result.append(line)
+            continue
+
+        value_with_comment = stripped.split('runs-on:', 1)[1].rstrip('\r\n')
+        raw, _, comment = value_with_comment.partition('#')
+        raw = raw.strip()
+        comment = f" #{comment}" if comment else ""
+        eol = line[len(line.rstrip('\r\n')):]
+
+        # Inline list (flow sequence)
+        if raw.startswith('[') and raw.endswith(']'):
+            items = [part.strip().strip('\'"') for part in raw[1:-1].split(',') if part.strip()]
+            if not labels_to_replace.intersection(items):
+                result.append(line)
+                continue
+            new_items = replace_runs_on_labels_in_list(items, labels_to_replace, replacement)
+            result.append(f"{line[:indent]}runs-on: [{', '.join(new_items)}]{comment}{eol}")
+
+        # Single value
+        elif raw:
+            if raw.strip('\'"') not in labels_to_replace:
+                result.append(line)
+                continue
+            result.append(f"{line[:indent]}runs-on: {replacement}{comment}{eol}")
+
+        # Multi-line list
+        else:
+            result.append(line)
+            replaced = False
+            while i < len(lines):
+                sub = lines[i]
+                sub_stripped = sub.lstrip()
+                sub_indent = len(sub) - len(sub_stripped)
+                if sub_stripped.strip() and sub_indent <= indent:
+                    break
+                i += 1
+                if not sub_stripped.startswith('-'):
+                    result.append(sub)
+                    continue
+                item_raw, _, item_comment = sub_stripped[1:].rstrip('\r\n').partition('#')
+                if item_raw.strip().strip('\'"') not in labels_to_replace:
+                    result.append(sub)
+                    continue
+                if replaced:
+                    continue
+                replaced = True
+                item_comment = f" #{item_comment}" if item_comment else ""
+                sub_eol = sub[len(sub.rstrip('\r\n')):]
+                result.append(f"{sub[:sub_indent]}- {replacement}{item_comment}{sub_eol}")
+    return "".join(result)
+
+
+def unified_workflow_diff(path: str, original: str, updated: str, context: int = 3) -> Tuple[str, int, int]:
+    """
+    Return a unified diff between two versions of a file along with the number of added and deleted lines.
+    """
+    diff_lines = list(difflib.unified_diff(
+        original.splitlines(keepends=True), updated.splitlines(keepends=True),
+        fromfile=f"a/{path}", tofile=f"b/{path}", n=context))
+    additions = sum(1 for line in diff_lines if line.startswith('+') and not line.startswith('+++'))
+    deletions = sum(1 for line in diff_lines if line.startswith('-') and not line.startswith('---'))
+    diff = "".join(line if line.endswith('\n') else line + '\n\\ No newline at end of file\n' for line in diff_lines)
+    return diff, additions, deletions
 
 
 def git_branch_by_full_path(path: Path | str, base_dir: Path | str, repo_content_prefix: Path | str = None) -> str:
@@ -88,3 +231,265 @@ def git_branch_by_full_path(path: Path | str, base_dir: Path | str, repo_content
     # drop the first two segments (org/name)
     parts_after_org = (branch_with_repo or relative_path).parts[2:]
     return str(Path(*parts_after_org)) if parts_after_org else "."
+
+
+@dataclass(kw_only=True)
+class BranchPolicy:
+    """
+    Which branches of a repo to fetch. The default branch is kept by all the rules except `exclude`.
+    """
+    default_only: bool = field(default=False)
+    # fnmatch-style globs on branch names
+    include: List[str] = field(default_factory=list)
+    exclude: List[str] = field(default_factory=list)
+    # Only branches with a head commit in the last `recent_days` days
+    recent_days: Optional[float] = field(default=None)
+    # Most recently committed branches first
+    max_per_repo: Optional[int] = field(default=None)
+
+    @property
+    def needs_commit_dates(self) -> bool:
+        return self.recent_days is not None or self.max_per_repo is not None
+
+
+def select_branches(branches: Iterable[str], default_branch: Optional[str], policy: BranchPolicy,
+                    committed_at: Dict[str, float] = None, now: float = None) -> List[str]:
+    """
+    Branch names to fetch according to `policy`. `committed_at` maps branch names to the timestamps
+    of their head commits; branches without one are never dropped as stale.
+    """
+    committed_at = committed_at or {}
+
+    def _matches(name: str, patterns: List[str]) -> bool:
+        return any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns)
+
+    selected = []
+    for name in branches:
+        if _matches(name, policy.exclude):
+            continue
+        if name != default_branch:
+            if policy.default_only:
+                continue
+            if policy.include and not _matches(name, policy.include):
+                continue
+            if policy.recent_days is not None and now is not None and name in committed_at \
+                    and committed_at[name] < now - policy.recent_days * 86400:
+                continue
+        selected.append(name)
+
+    # Default branch first, then the most recently committed ones
+    selected.sort(key=lambda name: (name != default_branch, -committed_at.get(name, float("-inf")), name))
+    if policy.max_per_repo is not None:
+        selected = selected[:policy.max_per_repo]
+    return selected
+
+
+@dataclass(kw_only=True)
+class WebhookAction:
+    # `refetch` the branch checkout, `drop` it, or only `update_head` in the heads catalog
+    kind: str
+    repo: str
+    branch: str
+    head: Optional[str] = None
+
+
+def verify_webhook_signature(secret: str, body: bytes, signature_header: Optional[str]) -> bool:
+    if not secret or not signature_header or not signature_header.startswith("sha256="):
+        return False
+    expected = hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature_header.split("=", 1)[1])
+
+
+def plan_webhook_event(event: str, payload: Dict, is_tracked: Callable[[str, Optional[str]], bool],
+                       max_listed_commits: int = 20) -> Optional[WebhookAction]:
+    """
+    Decide what a GitHub `push`, `create` or `delete` event means for the local checkouts.
+    `is_tracked(repo, branch)` tells whether a branch (or, with branch=None, a repo) has been fetched locally.
+    """
+    repo = (payload.get("repository") or {}).get("full_name")
+    if not repo:
+        return None
+
+    if event in ("create", "delete"):
+        if payload.get("ref_type") != "branch" or not payload.get("ref"):
+            return None
+        branch = payload["ref"]
+        if event == "create" and is_tracked(repo, None):
+            return WebhookAction(kind="refetch", repo=repo, branch=branch)
+        if event == "delete" and is_tracked(repo, branch):
+            return WebhookAction(kind="drop", repo=repo, branch=branch)
+        return None
+
+    if event != "push" or not payload.get("ref", "").startswith("refs/heads/"):
+        return None
+    branch = payload["ref"][len("refs/heads/"):]
+    if payload.get("deleted"):
+        return WebhookAction(kind="drop", repo=repo, branch=branch) if is_tracked(repo, branch) else None
+
+    head = payload.get("after")
+    if not is_tracked(repo, branch):
+        created = payload.get("created") and is_tracked(repo, None)
+        return WebhookAction(kind="refetch", repo=repo, branch=branch, head=head) if created else None
+
+    commits = payload.get("commits") or []
+    # Payloads list at most 20 commits, and a forced push may have changed anything
+    touched = payload.get("forced") or len(commits) >= max_listed_commits or any(
+        path.startswith(f"{WORKFLOW_DIR}/")
+        for commit in commits for key in ("added", "modified", "removed") for path in commit.get(key, []))
+    return WebhookAction(kind="refetch" if touched else "update_head", repo=repo, branch=branch, head=head)
+
+
+def negotiate_encoding(accept_encoding: Optional[str], available: Iterable[str]) -> str:
+    """
+    Pick a content coding from `available` (in order of preference) acceptable per the `Accept-Encoding`
+    header, or `identity`.
+    """
+    accepted: Dict[str, float] = {}
+    for item in (accept_encoding or "").split(","):
+        coding, *params = [part.strip() for part in item.split(";")]
+        if not coding:
+            continue
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[coding.lower()] = q
+
+    best, best_q = "identity", 0.0
+    for coding in available:
+        q = accepted.get(coding, accepted.get("*", 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """
+    Weak comparison of an `If-None-Match` header against an entity tag, as required for GET requests.
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+
+    def _opaque(tag: str) -> str:
+        tag = tag.strip()
+        return tag[2:] if tag.startswith("W/") else tag
+
+    return _opaque(etag) in [_opaque(tag) for tag in if_none_match.split(",")]
+
+
+def text_trigrams(text: str) -> Set[str]:
+    """
+    Case-folded three-character substrings of `text`, the keys of the search index.
+    """
+    text = text.lower()
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def regex_literals(pattern: str) -> List[str]:
+    """
+    Literal strings every match of `pattern` contains, e.g. `actions/checkout@v` for `actions/checkout@v[34]`.
+    Alternations and optional parts contribute nothing, so the result may well be empty.
+    It is always empty if the regex parser of `re` is not available.
+    """
+    if sre_parse is None:
+        return []
+    literals, run = [], []
+
+    def _flush() -> None:
+        if run:
+            literals.append("".join(run))
+            run.clear()
+
+    def _walk(items) -> None:
+        for op, av in items:
+            if op is LITERAL:
+                run.append(chr(av))
+                continue
+            _flush()
+            if op is SUBPATTERN:
+                _walk(av[-1])
+            elif op in _REPEATS and av[0] >= 1:
+                _walk(av[2])
+            _flush()
+
+    try:
+        _walk(sre_parse.parse(pattern))
+    except (TypeError, ValueError, IndexError):
+        # The parse tree is private too, and may change shape between Python versions
+        return []
+    _flush()
+    return literals
+
+
+def search_lines(text: str, matches: Callable[[str], bool], context: int = 2, limit: int = 50) -> List[Dict]:
+    """
+    Up to `limit` lines of `text` for which `matches` holds, numbered from 1, with `context` lines around them.
+    """
+    lines = text.splitlines()
+    found = []
+    for i, line in enumerate(lines):
+        if not matches(line):
+            continue
+        found.append({"line": i + 1, "text": line, "before": lines[max(i - context, 0):i],
+                      "after": lines[i + 1:i + 1 + context]})
+        if len(found) >= limit:
+            break
+    return found
+
+
+def pack_snapshot(snapshot: Dict) -> bytes:
+    """
+    Gzipped JSON of an org snapshot, as read by `unpack_snapshot`.
+    """
+    document = {"format": SNAPSHOT_FORMAT, "version": SNAPSHOT_VERSION} | snapshot
+    return gzip.compress(json.dumps(document, separators=(",", ":")).encode(), compresslevel=9, mtime=0)
+
+
+def _is_relative_path(path, max_parts: int = None, hidden: bool = False) -> bool:
+    if not isinstance(path, str) or not path or "\0" in path:
+        return False
+    parts = path.split("/")
+    if max_parts and len(parts) > max_parts:
+        return False
+    return all(part not in ("", ".", "..") and (hidden or not part.startswith(".")) for part in parts)
+
+
+def unpack_snapshot(data: bytes) -> Dict:
+    """
+    Read an org snapshot: the `org`, file `contents` and their `runs-on` `labels` by content digest, and
+    the `branches`, each with its `repo`, `branch`, `head` and `files` as {path in branch: content digest}.
+    Raises ValueError for anything else, including paths which would lead out of the branch directories.
+    """
+    try:
+        snapshot = json.loads(gzip.decompress(data))
+    except (OSError, EOFError, ValueError) as e:
+        raise ValueError(f"Not a snapshot: {e}")
+    if not isinstance(snapshot, dict) or snapshot.get("format") != SNAPSHOT_FORMAT:
+        raise ValueError("Not a snapshot")
+    if snapshot.get("version") != SNAPSHOT_VERSION:
+        raise ValueError(f"Unsupported snapshot version `{snapshot.get('version')}`")
+    if not _is_relative_path(snapshot.get("org"), max_parts=1):
+        raise ValueError("Invalid snapshot org")
+    contents, labels, branches = snapshot.get("contents"), snapshot.get("labels", {}), snapshot.get("branches")
+    if not isinstance(contents, dict) or not isinstance(labels, dict) or not isinstance(branches, list):
+        raise ValueError("Invalid snapshot contents")
+    if not all(isinstance(content, str) for content in contents.values()) \
+            or not all(isinstance(counts, dict) for counts in labels.values()):
+        raise ValueError("Invalid snapshot contents")
+    for branch in branches:
+        if not isinstance(branch, dict) or not _is_relative_path(branch.get("repo"), max_parts=1) \
+                or not _is_relative_path(branch.get("branch")):
+            raise ValueError(f"Invalid snapshot branch `{branch}`")
+        if not isinstance(branch.get("head"), (str, type(None))) or not isinstance(branch.get("files"), dict):
+            raise ValueError(f"Invalid snapshot branch `{branch['repo']}/{branch['branch']}`")
+        for path, digest in branch["files"].items():
+            if not _is_relative_path(path, hidden=True) or not path.startswith(f"{WORKFLOW_DIR}/") \
+                    or digest not in contents:
+                raise ValueError(f"Invalid snapshot file `{path}` of `{branch['repo']}/{branch['branch']}`")
+    return snapshot
@@ -0,0 +1,390 @@
+import re
+import uuid
+import heapq
+import itertools
+import asyncio
+import hashlib
+import functools
+import logging
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from env import *
+from src.models import GitHubWorkflow
+from src.common import count_runs_on_labels, text_trigrams, regex_literals, search_lines
+from src.utils.files import async_safe_file_op
+from src.utils.resources import FD_COSTS
+from src.utils.github import load_workflow_file, scan_object_workflows
+from src.utils.concurrency import single_flight
+from src.utils.tracing import span
+
+
+@dataclass(kw_only=True)
+class IndexEntry:
+    # (mtime_ns, size) of the file when it was parsed, or ("blob", oid) for files read from an object store
+    signature: Tuple
+    workflow: Optional[GitHubWorkflow]
+    # Jobs per `runs-on` label
+    labels: Dict[str, int] = field(default_factory=dict)
+
+
+class LabelUsage:
+    """
+    `runs-on` label usage of an org as [workflows, jobs] counts per label: in total, per repo and per branch.
+    Kept up to date by adding and subtracting the label counts of the index entries which change,
+    so reading it never requires a scan of the workflows.
+    """
+    def __init__(self):
+        self.totals: Dict[str, List[int]] = {}
+        self.repos: Dict[str, Dict[str, List[int]]] = {}
+        self.branches: Dict[str, Dict[str, Dict[str, List[int]]]] = {}
+
+    def apply(self, workflow: GitHubWorkflow, labels: Dict[str, int], sign: int) -> None:
+        for label, jobs in labels.items():
+            repos = self.repos.setdefault(label, {})
+            branches = self.branches.setdefault(label, {}).setdefault(workflow.repo, {})
+            for counts in (self.totals.setdefault(label, [0, 0]), repos.setdefault(workflow.repo, [0, 0]),
+                           branches.setdefault(workflow.branch, [0, 0])):
+                counts[0] += sign
+                counts[1] += sign * jobs
+            if not branches[workflow.branch][0]:
+                del branches[workflow.branch]
+            if not repos[workflow.repo][0]:
+                del repos[workflow.repo]
+                del self.branches[label][workflow.repo]
+            if not self.totals[label][0]:
+                del self.totals[label], self.repos[label], self.branches[label]
+
+    def report(self, repo: str = None, top: int = 10) -> List[Dict]:
+        """
+        Usage per label, most used first, with the `top` repos using it, or its `top` branches
+        when restricted to a single `repo`.
+        """
+        def _top(counts: Dict[str, List[int]], key: str) -> List[Dict]:
+            return [{key: name, "workflows": workflows, "jobs": jobs}
+                    for name, (workflows, jobs) in heapq.nlargest(top, counts.items(), key=lambda i: i[1][::-1])]
+
+        usage = []
+        for label, (workflows, jobs) in self.totals.items():
+            if repo is None:
+                usage.append({
+                    "label": label, "workflows": workflows, "jobs": jobs, "repos": len(self.repos[label]),
+                    "branches": sum(len(branches) for branches in self.branches[label].values()),
+                    "top_repos": _top(self.repos[label], "repo"),
+                })
+            elif repo in self.repos[label]:
+                workflows, jobs = self.repos[label][repo]
+                branches = self.branches[label][repo]
+                usage.append({
+                    "label": label, "workflows": workflows, "jobs": jobs, "repos": 1, "branches": len(branches),
+                    "top_branches": _top(branches, "branch"),
+                })
+        return sorted(usage, key=lambda u: (-u["jobs"], -u["workflows"], u["label"]))
+
+
+class SearchIndex:
+    """
+    Trigram index over the workflow contents of an org. Identical contents, e.g. the same file on many branches,
+    are indexed once. A query is only checked against the contents holding every trigram of its literals.
+    """
+    def __init__(self):
+        self._ids: Dict[str, int] = {}
+        self._contents: Dict[int, str] = {}
+        self._workflows: Dict[int, Dict[Path, GitHubWorkflow]] = {}
+        self._postings: Dict[str, Set[int]] = {}
+        self._paths: Dict[Path, int] = {}
+        self._orphans: Set[int] = set()
+        self._next_id = itertools.count()
+
+    def is_indexed(self, content: str) -> bool:
+        return content in self._ids
+
+    def add(self, path: Path, workflow: GitHubWorkflow, trigrams: Optional[Set[str]]) -> None:
+        """
+        Index `workflow`; `trigrams` of its content are only needed if the content is not indexed yet.
+        """
+        content_id = self._ids.get(workflow.content)
+        if content_id is None:
+            content_id = next(self._next_id)
+            self._ids[workflow.content] = content_id
+            self._contents[content_id] = workflow.content
+            self._workflows[content_id] = {}
+            for trigram in trigrams:
+                self._postings.setdefault(trigram, set()).add(content_id)
+        self._workflows[content_id][path] = workflow
+        self._paths[path] = content_id
+
+    def discard(self, path: Path) -> None:
+        content_id = self._paths.pop(path, None)
+        if content_id is None:
+            return
+        self._workflows[content_id].pop(path, None)
+        if not self._workflows[content_id]:
+            self._orphans.add(content_id)
+
+    def orphans(self) -> List[str]:
+        """
+        Contents no workflow refers to anymore, to be dropped with their trigrams.
+        """
+        self._orphans = {content_id for content_id in self._orphans if not self._workflows.get(content_id, True)}
+        return [self._contents[content_id] for content_id in self._orphans]
+
+    def drop(self, contents: Dict[str, Set[str]]) -> None:
+        for content, trigrams in contents.items():
+            content_id = self._ids.get(content)
+            if content_id is None or self._workflows[content_id]:
+                continue
+            for trigram in trigrams:
+                postings = self._postings.get(trigram)
+                if postings is not None:
+                    postings.discard(content_id)
+                    if not postings:
+                        del self._postings[trigram]
+            del self._ids[content], self._contents[content_id], self._workflows[content_id]
+            self._orphans.discard(content_id)
+
+    def candidates(self, literals: List[str], keep: Callable[[GitHubWorkflow], bool]) \
+            -> List[Tuple[str, List[GitHubWorkflow]]]:
+        """
+        Contents which may match a query containing all of `literals`, with their workflows passing `keep`.
+        """
+        required = set().union(*[text_trigrams(literal) for literal in literals])
+        if required:
+            postings = sorted((self._postings.get(trigram, set()) for trigram in required), key=len)
+            content_ids = set(postings[0]).intersection(*postings[1:])
+        else:
+            content_ids = self._contents.keys()
+        candidates = []
+        for content_id in content_ids:
+            workflows = [wf for wf in self._workflows[content_id].values() if keep(wf)]
+            if workflows:
+                candidates.append((self._contents[content_id], workflows))
+        return candidates
+
+    def stats(self) -> Dict:
+        return {"contents": len(self._contents), "workflows": sum(len(w) for w in self._workflows.values()),
+                "trigrams": len(self._postings)}
+
+
+class WorkflowIndex:
+    """
+    In-memory index of parsed workflow files per org. Parts of an org are marked stale whenever the checkouts
+    change (fetch, write, commit), and only files whose mtime or size (or blob id, for branches kept
+    in object stores) changed are re-read on the next access.
+    With `shared_path`, invalidations are published as a per-org generation file, so other workers
+    sharing the same storage notice them too.
+    """
+    def __init__(self, root: Path, shared_path: Path = None):
+        self.root = root
+        self.shared_path = shared_path
+        self._entries: Dict[str, Dict[Path, IndexEntry]] = {}
+        self._stale: Dict[str, Set[Optional[str]]] = {}
+        self._versions: Dict[str, str] = {}
+        self._generations: Dict[str, Optional[str]] = {}
+        self._label_usage: Dict[str, LabelUsage] = {}
+        self._search: Dict[str, SearchIndex] = {}
+        self._seeds: Dict[str, Dict[Path, IndexEntry]] = {}
+
+    async def invalidate(self, org: str, repo: str = None) -> None:
+        self._stale.setdefault(org, set()).add(repo)
+        if self.shared_path:
+            self._generations[org] = await async_safe_file_op(functools.partial(self._publish_generation, org))
+
+    async def seed(self, org: str, entries: Dict[Path, IndexEntry]) -> None:
+        """
+        Start the index of an org which is not indexed yet from `entries` known to match the files on disk,
+        e.g. restored from a snapshot, instead of parsing them. The next refresh still checks their signatures
+        and picks up whatever else the org has.
+        """
+        self._seeds[org] = entries
+        await self.invalidate(org)
+
+    def _generation_path(self, org: str) -> Path:
+        return self.shared_path / "index" / org
+
+    def _publish_generation(self, org: str) -> str:
+        generation = uuid.uuid4().hex
+        path = self._generation_path(org)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f".{org}.{generation}")
+        tmp_path.write_text(generation)
+        tmp_path.replace(path)
+        return generation
+
+    def _read_generation(self, org: str) -> Optional[str]:
+        try:
+            return self._generation_path(org).read_text()
+        except FileNotFoundError:
+            return None
+
+    async def _check_generation(self, org: str) -> None:
+        # Another worker changed the checkouts of this org since we last looked
+        generation = await async_safe_file_op(functools.partial(self._read_generation, org))
+        if generation != self._generations.get(org):
+            self._generations[org] = generation
+            if org in self._entries:
+                self._stale.setdefault(org, set()).add(None)
+
+    def version(self, org: str) -> Optional[str]:
+        """
+        Digest of the paths and signatures of the org's indexed files. Workers sharing the storage
+        get the same version for the same files.
+        """
+        return self._versions.get(org)
+
+    async def get(self, org: str, repo: str = None) -> List[GitHubWorkflow]:
+        if self.shared_path:
+            await self._check_generation(org)
+        while org not in self._entries or self._stale.get(org):
+            await single_flight(("index", org), lambda: self._refresh(org))
+        return [
+            entry.workflow for path, entry in self._entries[org].items()
+            if entry.workflow and (repo is None or path.parts[1] == repo)
+        ]
+
+    async def entries(self, org: str) -> Dict[Path, IndexEntry]:
+        await self.get(org)
+        return dict(self._entries[org])
+
+    async def label_usage(self, org: str, repo: str = None, top: int = 10) -> List[Dict]:
+        await self.get(org)
+        return self._label_usage[org].report(repo, top)
+
+    async def search(self, org: str, query: str, regex: bool = False, ignore_case: bool = False, repo: str = None,
+                     branch: str = None, context: int = 2, limit: int = 100) -> Dict:
+        """
+        Lines of the org's workflows containing `query`, or matching it as a regular expression, with `context`
+        lines around them. Only the contents holding the trigrams of the query are read.
+        Raises `re.error` for an invalid pattern.
+        """
+        if regex:
+            pattern = re.compile(query, re.IGNORECASE if ignore_case else 0)
+            literals, matches = regex_literals(query), lambda line: pattern.search(line) is not None
+        elif ignore_case:
+            folded = query.lower()
+            literals, matches = [query], lambda line: folded in line.lower()
+        else:
+            literals, matches = [query], lambda line: query in line
+        await self.get(org)
+        candidates = self._search[org].candidates(
+            literals, lambda wf: (repo is None or wf.repo == repo) and (branch is None or wf.branch == branch))
+
+        def _search() -> List[Dict]:
+            results = []
+            for content, workflows in candidates:
+                lines = search_lines(content, matches, context)
+                results += [{"path": str(wf.path), "repo": wf.repo, "branch": wf.branch, "matches": lines}
+                            for wf in workflows if lines]
+            return sorted(results, key=lambda r: r["path"])
+
+        with span("search", candidates=len(candidates)):
+            results = await asyncio.to_thread(_search)
+        return {"files": len(results), "truncated": len(results) > limit, "results": results[:limit],
+                "index": self._search[org].stats() | {"candidates": len(candidates)}}
+
+    async def stored_orgs(self) -> List[str]:
+        """
+        Orgs with a directory under the root.
+        """
+        def _list_orgs() -> List[str]:
+            if not self.root.is_dir():
+                return []
+            return [p.name for p in self.root.iterdir() if p.is_dir() and not p.name.startswith(".")]
+
+        return await async_safe_file_op(_list_orgs, fds=FD_COSTS["scan"])
+
+    async def warm(self, orgs: List[str] = None) -> List[str]:
+        """
+        Index `orgs`, or every org with a directory under the root, which has something on disk.
+        """
+        stored = await self.stored_orgs()
+        orgs = [org for org in orgs if org in stored] if orgs is not None else stored
+        await asyncio.gather(*[self.get(org) for org in orgs])
+        return orgs
+
+    async def _apply_seed(self, org: str, entries: Dict[Path, IndexEntry]) -> None:
+        contents = {entry.workflow.content for entry in entries.values() if entry.workflow}
+        trigrams = await asyncio.to_thread(lambda: {content: text_trigrams(content) for content in contents})
+        usage, search = LabelUsage(), SearchIndex()
+        for path, entry in entries.items():
+            if entry.workflow:
+                usage.apply(entry.workflow, entry.labels, 1)
+                search.add(path, entry.workflow, trigrams[entry.workflow.content])
+        self._entries[org], self._label_usage[org], self._search[org] = dict(entries), usage, search
+
+    async def _refresh(self, org: str) -> None:
+        seed = self._seeds.pop(org, None)
+        if seed is not None and org not in self._entries:
+            await self._apply_seed(org, seed)
+        stale = self._stale.pop(org, set())
+        if org not in self._entries or None in stale:
+            prefixes = [Path(org)]
+        else:
+            prefixes = [Path(org) / repo for repo in stale]
+        entries = self._entries.get(org, {})
+
+        def _scan() -> Dict[Path, Tuple[int, int]]:
+            found = {}
+            for prefix in prefixes:
+                full_prefix = self.root / prefix
+                if not full_prefix.is_dir():
+                    continue
+                for ext in ("*.yml", "*.yaml"):
+                    for p in full_prefix.rglob(ext):
+                        stat = p.stat()
+                        if p.is_file():
+                            found[p.relative_to(self.root)] = (stat.st_mtime_ns, stat.st_size)
+            return found
+
+        with span("scan", org=org):
+            found = await async_safe_file_op(_scan, fds=FD_COSTS["scan"])
+            from_objects: Dict[Path, Optional[GitHubWorkflow]] = {}
+            if WORKFLOW_READ_MODE == "objects":
+                known = {path: entry.signature[1] for path, entry in entries.items() if entry.signature[0] == "blob"}
+                for prefix in prefixes:
+                    oids, workflows = await scan_object_workflows(self.root / prefix, known)
+                    found |= {path: ("blob", oid) for path, oid in oids.items()}
+                    from_objects |= workflows
+        removed = [
+            path for path in entries
+            if path not in found and any(path.is_relative_to(prefix) for prefix in prefixes)
+        ]
+        changed = [path for path, signature in found.items()
+                   if path not in entries or entries[path].signature != signature]
+        with span("parse", files=len(changed)):
+            from_disk = [path for path in changed if found[path][0] != "blob"]
+            from_disk = dict(zip(from_disk, await asyncio.gather(*[
+                load_workflow_file(self.root / path) for path in from_disk])))
+            loaded = [from_disk[path] if path in from_disk else from_objects.get(path) for path in changed]
+            search = self._search.setdefault(org, SearchIndex())
+            new_contents = {wf.content for wf in loaded if wf and not search.is_indexed(wf.content)}
+            labels, trigrams = await asyncio.to_thread(lambda: (
+                [count_runs_on_labels(wf.content) if wf else {} for wf in loaded],
+                {content: text_trigrams(content) for content in new_contents}))
+
+        usage = self._label_usage.setdefault(org, LabelUsage())
+        for path in removed + [path for path in changed if path in entries]:
+            entry = entries.pop(path)
+            if entry.workflow:
+                usage.apply(entry.workflow, entry.labels, -1)
+                search.discard(path)
+        for path, workflow, workflow_labels in zip(changed, loaded, labels):
+            entries[path] = IndexEntry(signature=found[path], workflow=workflow, labels=workflow_labels)
+            if workflow:
+                usage.apply(workflow, workflow_labels, 1)
+                search.add(path, workflow, trigrams.get(workflow.content))
+
+        self._entries[org] = entries
+        if removed or changed or org not in self._versions:
+            digest = hashlib.sha1()
+            for path, entry in sorted(entries.items()):
+                digest.update(f"{path}\0{entry.signature[0]}\0{entry.signature[1]}\n".encode())
+            self._versions[org] = digest.hexdigest()
+        orphans = search.orphans()
+        if orphans:
+            search.drop(await asyncio.to_thread(lambda: {content: text_trigrams(content) for content in orphans}))
+        logging.info(f"Workflow index of `{org}` refreshed: {len(changed)} files parsed, {len(removed)} removed")
+
+
+workflow_index = WorkflowIndex(REPO_STORAGE_PATH, shared_path=SHARED_STATE_PATH if WORKERS > 1 else None)
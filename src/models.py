@@ -60,6 +60,8 @@ class GraphQLError(Exception):
 class GitBranch:
     repo: str
     name: str
+    head: Optional[str] = field(default=None)
+    error: Optional[str] = field(default=None)
     @property
     def local_destination(self) -> Path: return Path(f"{REPO_STORAGE}/{self.repo}/{self.name}")
 
@@ -71,10 +73,23 @@ class GitHubRepo:
     owner: str
     owner_id: int
     private: bool
+    default_branch: Optional[str] = field(default=None)
     @property
     def full_name(self) -> str: return f"{self.owner}/{self.name}"
 
 
+def storage_path(path: Path | str) -> Path:
+    """
+    `path` relative to REPO_STORAGE_PATH, raising ValueError if it is empty or leads out of the storage,
+    e.g. when absolute or with `..`.
+    """
+    full_path = (REPO_STORAGE_PATH / path).resolve()
+    if not Path(path).parts or Path(path).is_absolute() \
+            or not full_path.is_relative_to(REPO_STORAGE_PATH.resolve()) or full_path == REPO_STORAGE_PATH.resolve():
+        raise ValueError(f"Path `{path}` is not within the repo storage")
+    return Path(path)
+
+
 @dataclass(kw_only=True)
 class File:
     path: Path
@@ -91,13 +106,17 @@ class File:
 
     @classmethod
     def deserialize(cls, data: Dict) -> Self:
-        return cls(path=Path(data["path"]), content=base64.b64decode(data["content"]).decode('utf-8'))
+        return cls(path=storage_path(data["path"]), content=base64.b64decode(data["content"]).decode('utf-8'))
 
     def write(self) -> None:
         target = self.full_path
         target.parent.mkdir(parents=True, exist_ok=True)
         target.write_text(self.content)
 
+    def read_original(self) -> str:
+        target = self.full_path
+        return target.read_text() if target.exists() else ""
+
 
 @dataclass(kw_only=True)
 class GitHubWorkflow(File):
@@ -119,5 +138,15 @@ class GitHubWorkflow(File):
         return {
             "path": str(self.path),
             "content": base64.b64encode(self.content.encode('utf-8')).decode('utf-8'),
-            "runs-on": list(self.runs_on)
+            "runs-on": sorted(self.runs_on)
         }
+
+
+@dataclass(kw_only=True)
+class WorkflowDiff:
+    path: str
+    repo: str
+    branch: str
+    diff: str
+    additions: int
+    deletions: int
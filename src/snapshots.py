@@ -0,0 +1,140 @@
+import asyncio
+import hashlib
+import logging
+import functools
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+
+from env import *
+from src.models import GitHubWorkflow
+from src.common import pack_snapshot, unpack_snapshot, count_runs_on_labels
+from src.index import workflow_index, IndexEntry
+from src.utils.files import async_safe_file_op
+from src.utils.resources import FD_COSTS
+from src.utils.github import known_branch_heads, remember_branch_heads, restore_snapshot_checkout
+from src.utils.objects import object_store_path, list_store_branches
+from src.utils.concurrency import branch_lock, file_lock
+from src.utils.tracing import span
+
+
+async def export_snapshot(org: str) -> bytes:
+    """
+    Pack the fetched workflows of `org`, their `runs-on` labels and the heads of its branches into a single
+    snapshot, storing every distinct file content once however many branches hold it.
+    """
+    entries = await workflow_index.entries(org)
+    heads = known_branch_heads(REPO_STORAGE_PATH / org)
+
+    def _pack() -> bytes:
+        branches: Dict[Tuple[str, str], Dict] = {}
+        for path, head in heads.items():
+            parts = path.relative_to(REPO_STORAGE_PATH / org).parts
+            if len(parts) >= 2:
+                branches[(parts[0], "/".join(parts[1:]))] = {"head": head, "files": {}}
+        contents, labels = {}, {}
+        for path, entry in sorted(entries.items()):
+            wf = entry.workflow
+            if not wf:
+                continue
+            digest = hashlib.sha1(wf.content.encode()).hexdigest()
+            contents[digest], labels[digest] = wf.content, entry.labels
+            branch = branches.setdefault((path.parts[1], wf.branch), {"head": None, "files": {}})
+            branch["files"][str(wf.full_path.relative_to(wf.branch_full_path))] = digest
+        return pack_snapshot({
+            "org": org,
+            "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "contents": contents,
+            "labels": labels,
+            "branches": [{"repo": repo, "branch": branch} | info for (repo, branch), info in sorted(branches.items())],
+        })
+
+    with span("export", org=org, files=len(entries)):
+        return await asyncio.to_thread(_pack)
+
+
+async def import_snapshot(data: bytes, org: str = None, only_new: bool = False) -> Dict:
+    """
+    Restore the branches of a snapshot as snapshot directories: the workflow files and the head they were read at,
+    without a git repository. They are served, searched and diffed like fetched branches until the branch
+    is fetched again, and are replaced by a checkout before being edited. Only snapshot directories are replaced:
+    branches which are checked out or kept in an object store, and any other directory, are left alone.
+    The workflow index is seeded with the labels of the snapshot.
+    With `only_new`, nothing is restored if anything of the org has been fetched already.
+    Raises ValueError for an invalid snapshot, or one of another org than `org`.
+    """
+    snapshot = await asyncio.to_thread(unpack_snapshot, data)
+    if org and snapshot["org"] != org:
+        raise ValueError(f"The snapshot is of `{snapshot['org']}`, not of `{org}`")
+    org = snapshot["org"]
+    contents, labels, branches = snapshot["contents"], snapshot.get("labels", {}), snapshot["branches"]
+    summary = {"org": org, "created_at": snapshot.get("created_at"), "branches": len(branches), "restored": 0,
+               "skipped": 0, "failed": 0, "contents": len(contents)}
+
+    def _store_branches() -> Optional[Dict[str, Set[str]]]:
+        if only_new and ((REPO_STORAGE_PATH / org).exists() or (OBJECT_STORE_PATH / org).exists()):
+            return None
+        return {repo: set(list_store_branches(object_store_path(f"{org}/{repo}")))
+                for repo in set(branch["repo"] for branch in branches)}
+
+    store_branches = await async_safe_file_op(_store_branches, fds=FD_COSTS["scan"])
+    if store_branches is None:
+        return summary | {"skipped": len(branches)}
+
+    async def _restore(branch: Dict) -> Optional[Dict[str, Tuple[int, int]]]:
+        if branch["branch"] in store_branches[branch["repo"]]:
+            return None
+        dest = REPO_STORAGE_PATH / org / branch["repo"] / branch["branch"]
+        files = {path: contents[digest] for path, digest in branch["files"].items()}
+        async with branch_lock(dest):
+            return await async_safe_file_op(
+                functools.partial(restore_snapshot_checkout, dest, files, branch["head"]), fds=FD_COSTS["scan"])
+
+    with span("restore", org=org, branches=len(branches)):
+        results = await asyncio.gather(*[_restore(branch) for branch in branches], return_exceptions=True)
+
+    def _entries() -> Dict[Path, IndexEntry]:
+        entries = {}
+        for branch, signatures in zip(branches, results):
+            if not isinstance(signatures, dict):
+                continue
+            for path, digest in branch["files"].items():
+                full_path = Path(org) / branch["repo"] / branch["branch"] / path
+                entries[full_path] = IndexEntry(
+                    signature=signatures[path], workflow=GitHubWorkflow(path=full_path, content=contents[digest]),
+                    labels=labels[digest] if digest in labels else count_runs_on_labels(contents[digest]))
+        return entries
+
+    heads = {}
+    for branch, res in zip(branches, results):
+        if isinstance(res, Exception):
+            logging.error(f"Could not restore branch `{branch['branch']}` of `{org}/{branch['repo']}`: {res}")
+            summary["failed"] += 1
+        elif res is None:
+            summary["skipped"] += 1
+        else:
+            summary["restored"] += 1
+            if branch["head"]:
+                heads[REPO_STORAGE_PATH / org / branch["repo"] / branch["branch"]] = branch["head"]
+    remember_branch_heads(heads)
+    with span("seed"):
+        await workflow_index.seed(org, await asyncio.to_thread(_entries))
+        summary["workflows"] = len(await workflow_index.get(org))
+    logging.info(f"Snapshot of `{org}` imported: {summary['restored']} branches restored, "
+                 f"{summary['skipped']} skipped, {summary['failed']} failed")
+    return summary
+
+
+async def restore_snapshots(paths: List[str]) -> List[Dict]:
+    """
+    Import the snapshot files at `paths`, e.g. baked into the image, for the orgs which have nothing fetched yet.
+    """
+    summaries = []
+    async with file_lock("restore-snapshots"):
+        for path in paths:
+            try:
+                data = await async_safe_file_op(Path(path).read_bytes)
+                summaries.append(await import_snapshot(data, only_new=True))
+            except (OSError, ValueError) as e:
+                logging.error(f"Could not restore snapshot `{path}`: {e}")
+    return summaries
@@ -0,0 +1,59 @@
+import random
+import asyncio
+import logging
+import functools
+
+from env import *
+from src.index import workflow_index
+from src.snapshots import restore_snapshots
+from src.token_provider import get_github_token
+from src.utils.github import github_sync_workflows, warm_branch_heads
+from src.utils.concurrency import single_flight, try_hold_file_lock
+from src.utils.files import async_safe_file_op
+
+
+async def sync_org(org_name: str) -> None:
+    token = await get_github_token(org_name)
+    fetched = await single_flight(
+        (org_name, None, "sync"), lambda: github_sync_workflows(token, org_name, SYNC_CONCURRENCY_LIMIT))
+    if fetched:
+        for repo in set(branch.repo.split("/", 1)[1] for branch in fetched):
+            await workflow_index.invalidate(org_name, repo)
+        await workflow_index.get(org_name)
+    logging.info(f"`{org_name}` synced: {len(fetched)} branches fetched")
+
+
+async def warm_caches() -> None:
+    if RESTORE_SNAPSHOTS:
+        await restore_snapshots(RESTORE_SNAPSHOTS)
+    # Only org directories are walked, REPO_STORAGE may well be shared with other things
+    orgs = SYNC_ORGS or await workflow_index.stored_orgs()
+    heads = sum(await asyncio.gather(*[warm_branch_heads(REPO_STORAGE_PATH / org) for org in orgs]))
+    orgs = await workflow_index.warm(orgs)
+    logging.info(f"Caches warmed up from disk: {heads} branch heads, {len(orgs)} orgs indexed")
+
+
+async def sync_workflows_periodically() -> None:
+    """
+    Warm up the caches from what is on disk, then keep SYNC_ORGS in sync with GitHub in the background.
+    """
+    if WARM_CACHES_ON_STARTUP:
+        try:
+            await warm_caches()
+        except Exception as e:
+            logging.error(f"Could not warm up caches: {e}")
+    if not SYNC_ORGS:
+        return
+
+    # Spread the first sync, so several instances started together don't hit GitHub at once
+    await asyncio.sleep(random.uniform(0, SYNC_INTERVAL * SYNC_JITTER))
+    while True:
+        # With several workers, only the one holding the lock keeps the orgs in sync. The others try to take it
+        # on every tick, so one of them takes over if the leader goes away.
+        if WORKERS == 1 or await async_safe_file_op(functools.partial(try_hold_file_lock, "sync-leader")):
+            for org_name in SYNC_ORGS:
+                try:
+                    await sync_org(org_name)
+                except Exception as e:
+                    logging.error(f"Could not sync `{org_name}`: {e}")
+        await asyncio.sleep(SYNC_INTERVAL * random.uniform(1 - SYNC_JITTER, 1 + SYNC_JITTER))
@@ -1,30 +1,216 @@
+import os
+import json
+import asyncio
+import logging
 from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
 
 from env import *
 from src.utils.http import *
-from src.models import Token
+from src.utils.concurrency import single_flight, file_lock
+from src.models import RESTAPIError, Token
 
 
-_TOKENS: Dict[int, Token] = {}
+_GITHUB_HEADERS = {"Accept": "application/vnd.github+json", "X-GitHub-Api-Version": "2022-11-28"}
+
+
+class TokenManager:
+    """
+    Caches installation tokens per installation, coalesces concurrent refreshes into a single provider request
+    and renews tokens in the background before they expire, so requests don't wait on token minting.
+    The installation of an org is looked up once via `GET /orgs/{org}/installation` and cached.
+    With `shared_path`, minted tokens are shared between workers through files readable by the owner only.
+    """
+    def __init__(self, renew_margin: int, default_lifetime: int = 3000, shared_path: Path = None):
+        self.renew_margin = renew_margin
+        self.default_lifetime = default_lifetime
+        self.shared_path = shared_path
+        self._tokens: Dict[int, Token] = {}
+        self._installation_ids: Dict[str, int] = {}
+        self._app_jwt: Optional[Tuple[str, float]] = None
+        # Background refreshes are referenced until done, so they are not garbage collected while running
+        self._background_refreshes: Dict[int, asyncio.Task] = {}
+        self._stats = {"hits": 0, "misses": 0, "refreshes": 0, "background_refreshes": 0, "failures": 0,
+                       "installation_lookups": 0}
+
+    async def installation_id(self, org_name: str) -> int:
+        if not org_name:
+            raise PermissionError("GitHub App installation tokens are issued per org, but no org was given")
+        org = org_name.lower()
+        if org not in self._installation_ids:
+            self._installation_ids[org] = await single_flight(
+                ("installation", org), lambda: self._lookup_installation_id(org))
+        return self._installation_ids[org]
+
+    async def installed_orgs(self, per_page: int = 100) -> List[str]:
+        """
+        Orgs the GitHub App is installed on, via `GET /app/installations`. Their installations are cached.
+        """
+        app_jwt = await single_flight("app-jwt", self._get_app_jwt)
+        orgs, page = [], 1
+        while True:
+            installations = await rest_api_request(
+                HTTPMethod.GET, f"{GITHUB_API_URL}/app/installations?per_page={per_page}&page={page}",
+                {"Authorization": f"Bearer {app_jwt}"}, "GitHub", default_headers=_GITHUB_HEADERS)
+            for installation in installations:
+                org = installation["account"]["login"]
+                self._installation_ids[org.lower()] = int(installation["id"])
+                orgs.append(org)
+            if len(installations) < per_page:
+                return orgs
+            page += 1
+
+    async def get(self, org_name: str = None) -> Token:
+        installation_id = await self.installation_id(org_name)
+        now = datetime.now().timestamp()
+        token = self._tokens.get(installation_id)
+        if token and token.expires_at > now:
+            self._stats["hits"] += 1
+            if token.expires_at - now < self.renew_margin:
+                self._refresh_in_background(installation_id)
+        else:
+            self._stats["misses"] += 1
+            try:
+                token = await self.refresh(installation_id)
+            except RESTAPIError as e:
+                if e.status == 404:
+                    # The app was uninstalled, or reinstalled under another installation ID
+                    self._installation_ids.pop(org_name.lower(), None)
+                raise
+        return Token(installation_id=installation_id, org=org_name, value=token.value, expires_at=token.expires_at)
+
+    async def refresh(self, installation_id: int) -> Token:
+        return await single_flight(("token", installation_id), lambda: self._mint(installation_id))
+
+    async def renew_expiring(self) -> None:
+        now = datetime.now().timestamp()
+        await asyncio.gather(*[
+            self._background_refresh(installation_id) for installation_id, token in list(self._tokens.items())
+            if token.expires_at - now < self.renew_margin
+        ])
+
+    def stats(self) -> Dict:
+        now = datetime.now().timestamp()
+        return self._stats | {
+            "cached": len(self._tokens),
+            "expires_in": {str(i): int(t.expires_at - now) for i, t in self._tokens.items()},
+            "installations": dict(self._installation_ids),
+        }
+
+    def _refresh_in_background(self, installation_id: int) -> None:
+        if installation_id in self._background_refreshes:
+            return
+        task = asyncio.create_task(self._background_refresh(installation_id))
+        self._background_refreshes[installation_id] = task
+
+        def _done(done: asyncio.Task) -> None:
+            self._background_refreshes.pop(installation_id, None)
+            if not done.cancelled() and done.exception():
+                logging.error(f"Background renewal of installation token {installation_id} failed: "
+                              f"{done.exception()}")
+
+        task.add_done_callback(_done)
+
+    async def _background_refresh(self, installation_id: int) -> None:
+        self._stats["background_refreshes"] += 1
+        try:
+            await self.refresh(installation_id)
+        except Exception as e:
+            logging.warning(f"Could not renew installation token {installation_id}: {e}")
+
+    async def _get_app_jwt(self) -> str:
+        if self._app_jwt and self._app_jwt[1] - datetime.now().timestamp() > 60:
+            return self._app_jwt[0]
+        response = await rest_api_request(
+            HTTPMethod.GET, f"{GITHUB_INSTALLATION_TOKEN_PROVIDER}/get-app-jwt?github_api_url={GITHUB_API_URL}",
+            {"Authorization": f"Bearer {GITHUB_INSTALLATION_TOKEN_PROVIDER_SECRET}"},
+            "GitHub Installation JWT Provider", log_response_body=False)
+        # App JWTs are valid for 10 minutes at most
+        expires_at = datetime.now().timestamp() + 540
+        if response.get("expires_at"):
+            expires_at = datetime.fromisoformat(response["expires_at"].replace("Z", "+00:00")).timestamp()
+        self._app_jwt = (response["token"], expires_at)
+        return self._app_jwt[0]
+
+    async def _lookup_installation_id(self, org: str) -> int:
+        self._stats["installation_lookups"] += 1
+        app_jwt = await single_flight("app-jwt", self._get_app_jwt)
+        response = await rest_api_request(
+            HTTPMethod.GET, f"{GITHUB_API_URL}/orgs/{org}/installation", {"Authorization": f"Bearer {app_jwt}"},
+            "GitHub", default_headers=_GITHUB_HEADERS, accept_codes=[404])
+        if response.get("status") == 404:
+            raise PermissionError(f"The GitHub App is not installed on `{org}`")
+        logging.info(f"GitHub App installation of `{org}`: {response['id']}")
+        return int(response["id"])
+
+    def _shared_token_path(self, installation_id: int) -> Path:
+        return self.shared_path / "tokens" / f"{installation_id}.json"
+
+    def _read_shared_token(self, installation_id: int) -> Optional[Token]:
+        try:
+            data = json.loads(self._shared_token_path(installation_id).read_text())
+        except (FileNotFoundError, ValueError):
+            return None
+        if data.get("expires_at", 0) - datetime.now().timestamp() < self.renew_margin:
+            return None
+        return Token(installation_id=installation_id, value=data["value"], expires_at=data["expires_at"])
+
+    def _write_shared_token(self, token: Token) -> None:
+        path = self._shared_token_path(token.installation_id)
+        path.parent.mkdir(parents=True, exist_ok=True, mode=0o700)
+        tmp_path = path.with_name(f".{path.name}.{os.getpid()}")
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump({"value": token.value, "expires_at": token.expires_at}, f)
+        tmp_path.replace(path)
+
+    async def _mint(self, installation_id: int) -> Token:
+        if not self.shared_path:
+            return await self._mint_installation_token(installation_id)
+        # One worker mints, the others pick its token up from disk
+        async with file_lock(f"token-{installation_id}"):
+            token = await asyncio.to_thread(self._read_shared_token, installation_id)
+            if token:
+                self._tokens[installation_id] = token
+                return token
+            token = await self._mint_installation_token(installation_id)
+            await asyncio.to_thread(self._write_shared_token, token)
+            return token
+
+    async def _mint_installation_token(self, installation_id: int) -> Token:
+        self._stats["refreshes"] += 1
+        try:
+            oauth_response = await rest_api_request(
+                HTTPMethod.GET,
+                f"{GITHUB_INSTALLATION_TOKEN_PROVIDER}/get-installation-token?"
+                f"github_api_url={GITHUB_API_URL}&installation_id={installation_id}",
+                {"Authorization": f"Bearer {GITHUB_INSTALLATION_TOKEN_PROVIDER_SECRET}"},
+                "GitHub Installation JWT Provider")
+        except Exception:
+            self._stats["failures"] += 1
+            raise
+        expires_at = int(datetime.now().timestamp()) + self.default_lifetime
+        if oauth_response.get("expires_at"):
+            expires_at = int(datetime.fromisoformat(oauth_response["expires_at"].replace("Z", "+00:00")).timestamp())
+        self._tokens[installation_id] = \
+            Token(installation_id=installation_id, value=oauth_response["access_token"], expires_at=expires_at)
+        return self._tokens[installation_id]
+
+
+token_manager = TokenManager(
+    renew_margin=TOKEN_RENEW_MARGIN, shared_path=SHARED_STATE_PATH if WORKERS > 1 else None)
+
 
 async def get_github_token(org_name: str = None) -> Token:
     if GITHUB_PERSONAL_ACCESS_TOKEN:
         return Token(value=GITHUB_PERSONAL_ACCESS_TOKEN, org=org_name)
+    return await token_manager.get(org_name)
+
 
-    # ToDo [ASAP]: We have to get installation id by org here
-    # FixMe: We must use user token here
-    installation_id = 66728515
-    
-    if installation_id in _TOKENS and _TOKENS[installation_id].expires_at > datetime.now().timestamp():
-        return _TOKENS[installation_id]
-    
-    oauth_response = await rest_api_request(
-        HTTPMethod.GET, 
-        f"{GITHUB_INSTALLATION_TOKEN_PROVIDER}/get-installation-token?"
-        f"github_api_url={GITHUB_API_URL}&installation_id={installation_id}",
-        {"Authorization": f"Bearer {GITHUB_INSTALLATION_TOKEN_PROVIDER_SECRET}"},
-        "GitHub Installation JWT Provider")
-    access_token = oauth_response["access_token"]
-    _TOKENS[installation_id] = \
-        Token(installation_id=installation_id, value=access_token, expires_at=int(datetime.now().timestamp()) + 3000)
-    return _TOKENS[installation_id]
+async def renew_tokens_periodically(interval: int = 60) -> None:
+    if GITHUB_PERSONAL_ACCESS_TOKEN:
+        return
+    while True:
+        await asyncio.sleep(interval)
+        await token_manager.renew_expiring()
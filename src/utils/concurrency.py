@@ -0,0 +1,184 @@
+import os
+import time
+import fcntl
+import random
+import asyncio
+import hashlib
+import weakref
+from contextlib import asynccontextmanager, contextmanager, AsyncExitStack
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Hashable, Iterator, List, Optional, TypeVar
+
+from env import *
+from .resources import governor
+
+T = TypeVar("T")
+
+_in_flight: Dict[Hashable, asyncio.Future] = {}
+_in_flight_waiters: Dict[asyncio.Future, int] = {}
+_branch_locks: "weakref.WeakValueDictionary[Path, asyncio.Lock]" = weakref.WeakValueDictionary()
+_held_file_locks: Dict[str, int] = {}
+
+
+async def single_flight(key: Hashable, factory: Callable[[], Awaitable[T]]) -> T:
+    """
+    Run the awaitable produced by `factory` unless an operation with the same key is already in flight,
+    in which case attach to it and share its result.
+    """
+    task = _in_flight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(factory())
+        _in_flight[key] = task
+
+        def _forget(done: asyncio.Future) -> None:
+            if _in_flight.get(key) is done:
+                del _in_flight[key]
+
+        task.add_done_callback(_forget)
+
+    # A caller going away must not cancel the operation the other callers are waiting for,
+    # but once every caller is gone there is no one to deliver the result to.
+    _in_flight_waiters[task] = _in_flight_waiters.get(task, 0) + 1
+    try:
+        return await asyncio.shield(task)
+    finally:
+        _in_flight_waiters[task] -= 1
+        if not _in_flight_waiters[task]:
+            del _in_flight_waiters[task]
+            task.cancel()
+
+
+def _branch_lock(path: Path) -> asyncio.Lock:
+    lock = _branch_locks.get(path)
+    if lock is None:
+        lock = asyncio.Lock()
+        _branch_locks[path] = lock
+    return lock
+
+
+@asynccontextmanager
+async def file_lock(name: str) -> AsyncIterator[None]:
+    """
+    Cross-process exclusive lock backed by `flock` on a file under SHARED_STATE_PATH.
+    """
+    def _open() -> int:
+        path = SHARED_STATE_PATH / "locks" / f"{hashlib.sha1(name.encode()).hexdigest()}.lock"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        return os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+
+    async with governor.slot("lock"):
+        fd = await asyncio.to_thread(_open)
+        try:
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    await asyncio.sleep(random.uniform(0.02, 0.1))
+            yield
+        finally:
+            # Closing the descriptor releases the lock
+            os.close(fd)
+
+
+def try_hold_file_lock(name: str) -> bool:
+    """
+    Try to take a cross-process lock for the rest of the process lifetime, e.g. to elect a single worker
+    for background jobs. Returns False if another process holds it.
+    """
+    if name in _held_file_locks:
+        return True
+    path = SHARED_STATE_PATH / "locks" / f"{hashlib.sha1(name.encode()).hexdigest()}.lock"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return False
+    _held_file_locks[name] = fd
+    return True
+
+
+@asynccontextmanager
+async def branch_lock(path: Path) -> AsyncIterator[None]:
+    """
+    Guard a branch checkout directory, so clone, refetch and commit never run on it at once.
+    With several workers, the lock is held across processes as well.
+    """
+    path = Path(path)
+    async with _branch_lock(path):
+        if WORKERS > 1:
+            async with file_lock(str(path)):
+                yield
+        else:
+            yield
+
+
+@asynccontextmanager
+async def branch_locks(*paths: Path) -> AsyncIterator[None]:
+    # Always acquire in the same order to avoid deadlocks between multi-branch operations
+    async with AsyncExitStack() as stack:
+        for path in sorted(set(Path(p) for p in paths)):
+            await stack.enter_async_context(branch_lock(path))
+        yield
+
+
+class DeadlineExceeded(asyncio.TimeoutError):
+    """Raised when the deadline budget of the current request has run out."""
+    pass
+
+
+_deadline: ContextVar[Optional[float]] = ContextVar("deadline", default=None)
+
+
+@contextmanager
+def deadline(seconds: Optional[float]) -> Iterator[None]:
+    """
+    Set a deadline budget for everything awaited within the block, including tasks created from it.
+    Nested deadlines can only shorten the budget.
+    """
+    if not seconds:
+        yield
+        return
+    at, current = time.monotonic() + seconds, _deadline.get()
+    token = _deadline.set(min(at, current) if current else at)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining_time() -> Optional[float]:
+    at = _deadline.get()
+    return None if at is None else max(at - time.monotonic(), 0.0)
+
+
+def check_deadline() -> None:
+    if remaining_time() == 0.0:
+        raise DeadlineExceeded("Request deadline exceeded")
+
+
+async def gather_within_deadline(*aws: Awaitable) -> List[Any]:
+    """
+    Like `asyncio.gather(..., return_exceptions=True)`, but awaitables still running when the deadline
+    expires are cancelled and reported as `DeadlineExceeded`. Cancelling the caller cancels all of them.
+    """
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    if not tasks:
+        return []
+    try:
+        _, pending = await asyncio.wait(tasks, timeout=remaining_time())
+    except asyncio.CancelledError:
+        for task in tasks:
+            task.cancel()
+        raise
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    return [
+        DeadlineExceeded("Request deadline exceeded") if task in pending or task.cancelled()
+        else task.exception() or task.result()
+        for task in tasks
+    ]
@@ -1,33 +1,57 @@
-import time
+import os
+import stat
 import errno
 import asyncio
-import random
-import functools
-from typing import Callable, Any
+import threading
+from contextlib import suppress
+from typing import Callable, Any, List, Union
 
-from env import FS_CONCURRENCY_LIMIT
 from src.models import File
-
-_file_semaphore = asyncio.Semaphore(FS_CONCURRENCY_LIMIT)
-
-
-def safe_file_op(func: Callable) -> Any:
-    result = None
-    while True:
+from src.utils.resources import governor
+
+
+async def async_safe_file_op(func: Callable, kind: str = "file", fds: int = None) -> Any:
+    """
+    Run the blocking file operation `func` in a worker thread once the resource governor has a slot for it.
+    Operations hitting EMFILE anyway are retried after some descriptors are released.
+    """
+    async with governor.slot(kind, fds):
+        while True:
+            try:
+                return await asyncio.to_thread(func)
+            except OSError as e:
+                if e.errno != errno.EMFILE:
+                    raise
+                await governor.exhausted(kind)
+
+
+def write_files_atomically(files: List[File]) -> List[Union[bool, Exception]]:
+    """
+    Write each file to a temporary file renamed over the target, so readers never see it half written,
+    skipping files which already hold the same bytes. Returns, per file, whether it was changed,
+    or the error writing it failed with.
+    """
+    results: List[Union[bool, Exception]] = []
+    for f in files:
+        target, data = f.full_path, f.content.encode()
+        tmp = target.with_name(f".{target.name}.{os.getpid()}.{threading.get_ident()}.tmp")
         try:
-            result = func()
-            break
-        except OSError as e:
-            if e.errno == errno.EMFILE:
-                time.sleep(random.randint(200, 600) / 1000)
+            try:
+                st = target.stat()
+            except FileNotFoundError:
+                st = None
+            if st and st.st_size == len(data) and target.read_bytes() == data:
+                results.append(False)
                 continue
-            raise
-    return result
-
-
-async def async_safe_file_op(func: Callable) -> Any:
-    async with _file_semaphore:
-        return await asyncio.to_thread(func)
-
-
-async def write_file(f: File) -> None: await asyncio.to_thread(functools.partial(safe_file_op, f.write))
+            target.parent.mkdir(parents=True, exist_ok=True)
+            with open(tmp, "wb") as out:
+                out.write(data)
+            if st:
+                os.chmod(tmp, stat.S_IMODE(st.st_mode))
+            os.replace(tmp, target)
+            results.append(True)
+        except OSError as e:
+            with suppress(OSError):
+                os.unlink(tmp)
+            results.append(e)
+    return results
@@ -1,53 +1,77 @@
-import random
+import os
 import time
 import logging
 import functools
 import asyncio
 import errno
+import signal
+from contextlib import suppress
 from shlex import quote
 from pathlib import Path
-from typing import List, Optional, Callable
+from typing import Awaitable, Dict, List, Optional, Callable, Tuple
 
 from .files import *
+from .concurrency import DeadlineExceeded, check_deadline, remaining_time
+from .metrics import GIT_COMMANDS, GIT_COMMAND_DURATION, git_subcommand
+from .resources import governor, FD_COSTS
+from .tracing import record_span
 from src.models import GitError, GitConflictError, GitNotFoundError, GitBranch
 from env import *
 from src.common import *
 
-_shell_semaphore = asyncio.Semaphore(SHELL_CONCURRENCY_LIMIT)
-
-
 async def _git(args: List[str], cwd: Optional[Path] = None) -> str:
     try:
         return await _shell("git", args=args, cwd=cwd)
+    except DeadlineExceeded:
+        raise
     except Exception as e:
         raise GitError(f"git {' '.join(args)} failed: {e}")
 
 
 async def _shell(cmd: str, args: List[str] = None, cwd: Optional[Path] = None) -> str:
+    returncode, stdout, stderr = await _run_shell(cmd, args, cwd)
+    if returncode != 0:
+        raise Exception(f"Shell command failed: {stderr or stdout}")
+    return stdout
+
+
+async def _run_shell(cmd: str, args: List[str] = None, cwd: Optional[Path] = None) -> Tuple[int, str, str]:
     args = args or []
     out, err, proc = "", None, None
-    while True:
-        try:
-            async with _shell_semaphore:
+    command = git_subcommand(cmd, args)
+    async with governor.slot("shell"):
+        while True:
+            check_deadline()
+            started_at, started_ns = time.monotonic(), time.time_ns()
+            try:
                 proc = await asyncio.create_subprocess_shell(
                     " ".join([cmd] + args),
                     cwd=str(cwd) if cwd else None,
                     stdout=asyncio.subprocess.PIPE,
-                    stderr=asyncio.subprocess.PIPE)
-                out, err = await proc.communicate()
-                break
-        except OSError as e:
-            if e.errno == errno.EMFILE:
-                await asyncio.sleep(random.randint(200, 600) / 1000)
+                    stderr=asyncio.subprocess.PIPE,
+                    start_new_session=True)
+            except OSError as e:
+                if e.errno != errno.EMFILE:
+                    raise
+                await governor.exhausted("shell")
                 continue
-            raise
-        except Exception as e:
-            raise
-    stdout = out.decode().strip()
-    stderr = err.decode().strip()
-    if proc.returncode != 0:
-        raise Exception(f"Shell command failed: {stderr or stdout}")
-    return stdout
+            try:
+                out, err = await asyncio.wait_for(proc.communicate(), timeout=remaining_time())
+            except (asyncio.CancelledError, asyncio.TimeoutError) as e:
+                # Kill the whole process group, so git children of the shell go away as well
+                with suppress(ProcessLookupError):
+                    os.killpg(proc.pid, signal.SIGKILL)
+                await asyncio.shield(proc.wait())
+                GIT_COMMANDS.inc(command=command, result="killed")
+                record_span(f"git.{command}", started_ns, error="killed")
+                if isinstance(e, asyncio.TimeoutError):
+                    raise DeadlineExceeded("Shell command was killed on deadline")
+                raise
+            GIT_COMMAND_DURATION.observe(time.monotonic() - started_at, command=command)
+            GIT_COMMANDS.inc(command=command, result="ok" if proc.returncode == 0 else "error")
+            record_span(f"git.{command}", started_ns, returncode=proc.returncode)
+            break
+    return proc.returncode, out.decode().strip(), err.decode().strip()
 
 
 async def git_clone_shallow(repo_url: str, dest: Path, branch: str, clone_repo_path: str) -> None:
@@ -112,38 +136,222 @@ async def git_push(repo_path: Path, branch: str, origin: str) -> None:
         raise
 
 
-async def git_commit_and_push(repo_path: Path, message: str, branch: str, origin: str, email: str, author: str) -> None:
+def _git_add_command(paths: Optional[List[str]]) -> str:
+    """
+    Stage only `paths` if they are known, so git doesn't have to scan the whole checkout, or everything otherwise.
+    """
+    return "git add -- " + " ".join(quote(path) for path in paths) if paths else "git add ."
+
+
+async def git_commit_and_push(
+        repo_path: Path, message: str, branch: str, origin: str, email: str, author: str, max_attempts: int = 3,
+        can_rebase: Optional[Callable[[str, str, List[str]], Awaitable[bool]]] = None,
+        paths: Optional[List[str]] = None) -> None:
+    """
+    Commit the changes to `paths`, or all the changes in the checkout, and push them. When the remote branch
+    has moved on, `can_rebase` is asked whether any of the locally edited paths changed between our base and
+    the new remote head; if they did not, local changes are moved on top of the new head without a full refetch.
+    """
     cmd = f"""
     cd {quote(str(repo_path))} && \
-    git add . && \
+    {_git_add_command(paths)} && \
     git -c user.name={quote(author)} -c user.email={quote(email)} commit -m {quote(message)} || true && \
     git push {quote(origin)} {quote(branch)}
     """
-    while True:
+    for attempt in range(1, max_attempts + 1):
         try:
             await _shell(cmd)
-            break
+            return
         except Exception as e:
             if "your branch is ahead of" in str(e).lower() \
                     or "tip of your current branch is behind" in str(e).lower() \
-                    or "to merge the remote branch into yours" in str(e).lower():
-                await git_force_refetch_shallow(repo_path, branch, origin)
-                await asyncio.sleep(1)
+                    or "to merge the remote branch into yours" in str(e).lower() \
+                    or "fetch first" in str(e).lower():
+                if attempt == max_attempts:
+                    raise GitConflictError(str(e))
+                await git_catch_up(repo_path, branch, origin, can_rebase)
                 continue
             raise
 
 
-async def find_changed_files(repo_path: Path) -> List[str]:
+async def git_catch_up(
+        repo_path: Path, branch: str, origin: str,
+        can_rebase: Optional[Callable[[str, str, List[str]], Awaitable[bool]]] = None) -> None:
+    """
+    Bring a checkout whose push was rejected up to the new remote head: rebase the local changes
+    if `can_rebase` allows it, or refetch the branch otherwise.
+    """
+    if can_rebase:
+        base, edited_paths = await git_base_and_edited_paths(repo_path)
+        remote_head = await get_remote_head(repo_path, branch, origin)
+        if base and await can_rebase(base, remote_head, edited_paths):
+            await git_rebase_shallow(repo_path, branch, origin, edited_paths)
+            return
+    await git_force_refetch_shallow(repo_path, branch, origin)
+    await asyncio.sleep(1)
+
+
+async def git_base_and_edited_paths(repo_path: Path) -> Tuple[Optional[str], List[str]]:
+    """
+    Return the remote commit the shallow checkout is based on, and the paths changed locally since then.
+    """
+    def _read_shallow() -> List[str]:
+        shallow = repo_path / ".git" / "shallow"
+        return shallow.read_text().split() if shallow.exists() else []
+
+    shallow_commits = set(await async_safe_file_op(_read_shallow))
+    if not shallow_commits:
+        return None, []
+    history = (await _git(["-C", quote(str(repo_path)), "rev-list", "HEAD"])).split()
+    base = next((sha for sha in history if sha in shallow_commits), None)
+    if not base:
+        return None, []
+    committed = await _git(["-C", quote(str(repo_path)), "diff", "--name-only", base, "HEAD"])
+    return base, [path for path in committed.splitlines() if path]
+
+
+async def git_rebase_shallow(repo_path: Path, branch: str, origin: str, edited_paths: List[str]) -> None:
+    """
+    Move the edited files on top of the current remote head: fetch only the new head commit,
+    point the branch at it, and restore any other file in the sparse checkout to its remote version.
+    """
+    repo = quote(str(repo_path))
+    await _git(["-C", repo, "fetch", "-q", "--depth", "1", quote(origin), quote(branch)])
+    await _git(["-C", repo, "reset", "-q", "--mixed", "FETCH_HEAD"])
+    dirty = (await _git(["-C", repo, "diff", "--name-only"])).splitlines()
+    stale = [quote(path) for path in dirty if path and path not in edited_paths]
+    if stale:
+        await _git(["-C", repo, "checkout", "--"] + stale)
+
+
+async def git_commit_and_push_many(
+        staging_path: Path, branches: Dict[str, Path], message: str, origin: str, email: str, author: str,
+        atomic: bool = False, paths: Optional[Dict[str, List[str]]] = None, max_attempts: int = 3,
+        can_rebase: Optional[Callable[[str, str, List[str]], Awaitable[bool]]] = None) \
+        -> Dict[str, Optional[Exception]]:
     """
-    Return a list of changed file paths in the given repo directory.
+    Commit every branch checkout and push all of them with a single `git push` from a staging repository,
+    which borrows objects from the checkouts via alternates. Only `paths` of a branch are staged if given.
+    Branches rejected because their remote head moved on are caught up like in `git_commit_and_push`
+    and pushed again, up to `max_attempts` pushes. Returns an error (or None) per branch.
+    """
+    async def _commit(branch: str, repo_path: Path) -> str:
+        cmd = f"""
+        cd {quote(str(repo_path))} && \
+        {_git_add_command((paths or {}).get(branch))} && \
+        git -c user.name={quote(author)} -c user.email={quote(email)} commit -q -m {quote(message)} || true && \
+        git rev-parse HEAD
+        """
+        return (await _shell(cmd)).splitlines()[-1]
+
+    results: Dict[str, Optional[Exception]] = {}
+    pending = dict(branches)
+    for attempt in range(1, max_attempts + 1):
+        heads: Dict[str, str] = {}
+        commit_results = await asyncio.gather(*[_commit(branch, path) for branch, path in pending.items()],
+                                              return_exceptions=True)
+        for branch, res in zip(pending, commit_results):
+            if isinstance(res, Exception):
+                results[branch] = GitError(f"git commit failed: {res}")
+            else:
+                heads[branch] = res
+        if not heads:
+            break
+
+        # With an atomic push, a rejected branch fails the others too, so they are pushed again with it
+        rejected: List[str] = []
+        held_back: Dict[str, Exception] = {}
+        for branch, res in (await _git_push_staged(staging_path, branches, heads, origin, atomic)).items():
+            if attempt < max_attempts and isinstance(res, GitConflictError):
+                rejected.append(branch)
+            elif attempt < max_attempts and atomic and res is not None and "atomic push failed" in str(res):
+                held_back[branch] = res
+            else:
+                results[branch] = res
+        if not rejected:
+            results |= held_back
+            break
+
+        logging.info(f"git push of {len(rejected)} branches from `{staging_path}` rejected, "
+                     f"catching up and retrying...")
+        catch_up_results = await asyncio.gather(
+            *[git_catch_up(branches[branch], branch, origin, can_rebase) for branch in rejected],
+            return_exceptions=True)
+        pending = {branch: branches[branch] for branch in held_back}
+        for branch, res in zip(rejected, catch_up_results):
+            if isinstance(res, Exception):
+                results[branch] = res
+            else:
+                pending[branch] = branches[branch]
+        if not pending:
+            break
+    return results
+
+
+async def _git_push_staged(
+        staging_path: Path, branches: Dict[str, Path], heads: Dict[str, str], origin: str, atomic: bool) \
+        -> Dict[str, Optional[Exception]]:
+    def _prepare_staging() -> None:
+        git_dirs = [branches[branch] / ".git" for branch in heads]
+        alternates = staging_path / "objects" / "info" / "alternates"
+        alternates.parent.mkdir(parents=True, exist_ok=True)
+        alternates.write_text("".join(f"{d / 'objects'}\n" for d in git_dirs))
+        shallow = set()
+        for d in git_dirs:
+            if (d / "shallow").exists():
+                shallow.update((d / "shallow").read_text().split())
+        (staging_path / "shallow").write_text("".join(f"{sha}\n" for sha in sorted(shallow)))
+
+    if not await asyncio.to_thread((staging_path / "HEAD").exists):
+        await _git(["init", "--bare", "-q", quote(str(staging_path))])
+    # Checkouts are partial clones, so the staging repo must be able to lazily fetch missing objects as well
+    for key, value in [("core.repositoryformatversion", "1"), ("extensions.partialclone", "origin"),
+                       ("remote.origin.url", origin), ("remote.origin.promisor", "true")]:
+        await _git(["-C", quote(str(staging_path)), "config", key, quote(value)])
+    await async_safe_file_op(_prepare_staging)
+    ref_updates = "".join(f"update refs/heads/{branch} {sha}\n" for branch, sha in heads.items())
+    await _shell(f"printf %s {quote(ref_updates)} | git -C {quote(str(staging_path))} update-ref --stdin")
+
+    refspecs = [quote(f"refs/heads/{branch}:refs/heads/{branch}") for branch in heads]
+    logging.info(f"git pushing {len(refspecs)} branches from `{staging_path}`...")
+    returncode, stdout, stderr = await _run_shell(
+        "git", ["-C", quote(str(staging_path)), "push", "--porcelain"] + (["--atomic"] if atomic else [])
+        + ["origin"] + refspecs)
+
+    # Porcelain lines look like `<flag>\t<src>:<dst>\t<summary>`
+    ref_status: Dict[str, Tuple[str, str]] = {}
+    for line in stdout.splitlines():
+        parts = line.split("\t")
+        if len(parts) == 3 and ":refs/heads/" in parts[1]:
+            ref_status[parts[1].split(":refs/heads/", 1)[1]] = (parts[0], parts[2])
+
+    results: Dict[str, Optional[Exception]] = {}
+    for branch in heads:
+        flag, summary = ref_status.get(branch, ("!", stderr or stdout))
+        if flag != "!":
+            results[branch] = None
+        elif "non-fast-forward" in summary or "fetch first" in summary:
+            results[branch] = GitConflictError(f"git push of `{branch}` rejected: {summary}")
+        else:
+            results[branch] = GitError(f"git push of `{branch}` failed: {summary}")
+    if returncode != 0:
+        logging.warning(f"git push from `{staging_path}` finished with errors: {stderr}")
+    return results
+
+
+async def find_changed_files(repo_path: Path, paths: Optional[List[str]] = None) -> List[str]:
+    """
+    Return a list of changed file paths in the given repo directory, only among `paths` if given.
     Includes modified (M), added (A), and untracked (??) files.
     """
     # Run `git status --porcelain` in the specified directory
-    output = await _git(["status", "--porcelain"], cwd=repo_path)
+    pathspecs = ["--"] + [quote(path) for path in paths] if paths else []
+    output = await _git(["status", "--porcelain"] + pathspecs, cwd=repo_path)
     paths: List[str] = []
     for line in output.splitlines():
-        status = line[:2].strip()
-        path = line[len(status)+1:]
+        # The output is stripped, so the first line may have lost the leading space of its status
+        status, _, path = line.strip().partition(" ")
+        path = path.strip()
         if status in ("M", "A", "??"):
             paths.append(path)
     return paths
@@ -161,6 +369,13 @@ async def get_remote_head(repo_path: Path, branch: str, origin: str) -> str:
 
 
 async def get_all_branches(repo_url: str) -> List[str]:
+    return list((await get_all_branch_heads(repo_url)).keys())
+
+
+async def get_all_branch_heads(repo_url: str) -> Dict[str, str]:
+    """
+    Return the head commit SHA of every branch in the remote repository.
+    """
     try:
         output = await _git(["ls-remote", "--heads", repo_url])
     except GitError as e:
@@ -171,14 +386,70 @@ async def get_all_branches(repo_url: str) -> List[str]:
             raise GitNotFoundError(f"Repository {repo_url} not found: {e}")
         raise
 
-    branches: List[str] = []
+    branches: Dict[str, str] = {}
     for line in output.splitlines():
         parts = line.split()
         if len(parts) == 2 and parts[1].startswith("refs/heads/"):
-            branches.append(parts[1].split("refs/heads/")[1])
+            branches[parts[1].split("refs/heads/")[1]] = parts[0]
     return branches
 
 
+def read_local_head(repo_path: Path) -> Optional[str]:
+    """
+    Resolve HEAD of a checkout by reading `.git` files directly, without spawning git.
+    """
+    git_dir = repo_path / ".git"
+    head = (git_dir / "HEAD").read_text().strip()
+    if not head.startswith("ref:"):
+        return head or None
+    return _read_ref(git_dir, head.split(":", 1)[1].strip())
+
+
+def read_remote_head(repo_path: Path) -> Optional[str]:
+    """
+    Resolve the remote head a checkout was last fetched at, by reading `.git` files directly: FETCH_HEAD
+    of the latest fetch, or the remote-tracking ref written by the clone. Unlike HEAD, it is never
+    a local commit which has not been pushed.
+    """
+    git_dir = repo_path / ".git"
+    fetch_head = git_dir / "FETCH_HEAD"
+    if fetch_head.is_file():
+        for line in fetch_head.read_text().splitlines():
+            parts = line.split("\t")
+            if len(parts) >= 2 and parts[1] != "not-for-merge":
+                return parts[0]
+    head = (git_dir / "HEAD").read_text().strip()
+    if not head.startswith("ref: refs/heads/"):
+        return None
+    return _read_ref(git_dir, "refs/remotes/origin/" + head[len("ref: refs/heads/"):])
+
+
+def _read_ref(git_dir: Path, ref: str) -> Optional[str]:
+    if (git_dir / ref).is_file():
+        return (git_dir / ref).read_text().strip()
+    packed_refs = git_dir / "packed-refs"
+    if packed_refs.is_file():
+        for line in packed_refs.read_text().splitlines():
+            parts = line.split()
+            if len(parts) == 2 and parts[1] == ref:
+                return parts[0]
+    return None
+
+
+def find_local_checkouts(*args: Path | str) -> List[Path]:
+    """
+    Return all checkout directories (the ones containing `.git`) under the given paths,
+    without descending into the checkouts themselves.
+    """
+    checkouts = []
+    for root in args:
+        for dirpath, dirnames, _ in os.walk(root):
+            if ".git" in dirnames:
+                checkouts.append(Path(dirpath))
+                dirnames.clear()
+    return checkouts
+
+
 async def find_all_local_branches_in_orgs(*args: Path | str) -> List[Path]:
     """
     Return a list of paths for all branch-level
@@ -191,4 +462,4 @@ async def find_all_local_branches_in_orgs(*args: Path | str) -> List[Path]:
             dirs += [p for p in org_dir.rglob('*') if p.is_dir() and len(p.relative_to(org_dir).parts) == 2]
         return dirs
 
-    return await asyncio.to_thread(functools.partial(safe_file_op, _scan_candidates))
+    return await async_safe_file_op(_scan_candidates, fds=FD_COSTS["scan"])
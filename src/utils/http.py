@@ -1,3 +1,4 @@
+import time
 import asyncio
 import logging
 from typing import Any, Dict, List, Optional, Callable, Union
@@ -6,6 +7,20 @@ from http import HTTPMethod
 import aiohttp
 
 from src.models import RESTAPIError, GraphQLError
+from src.utils.concurrency import remaining_time, check_deadline
+from src.utils.metrics import UPSTREAM_REQUESTS, UPSTREAM_REQUEST_DURATION, RATE_LIMIT_REMAINING
+from src.utils.tracing import record_span
+from src.utils.resources import governor
+
+
+def record_upstream_response(api_name: str, kind: str, status: Any, started_at: float, headers=None) -> None:
+    duration = time.monotonic() - started_at
+    UPSTREAM_REQUESTS.inc(api=api_name, kind=kind, status=str(status))
+    UPSTREAM_REQUEST_DURATION.observe(duration, api=api_name, kind=kind)
+    record_span(f"http.{kind}", time.time_ns() - int(duration * 1e9), api=api_name, status=status)
+    remaining = (headers or {}).get("X-RateLimit-Remaining")
+    if remaining is not None:
+        RATE_LIMIT_REMAINING.set(float(remaining), resource=headers.get("X-RateLimit-Resource", "core"))
 
 
 async def rest_api_request(
@@ -29,12 +44,20 @@ async def rest_api_request(
     extra_log = {"API": api_name, "endpoint": endpoint, "method": method, "data": data if log_data else None}
     logging.debug(f"Requesting {api_name} API", extra=extra_log)
     try:
-        async with aiohttp.ClientSession(
-                timeout=aiohttp.ClientTimeout(total=(retry_timeout+5)*max_attempts)) as session:
+        check_deadline()
+        total_timeout = (retry_timeout + 5) * max_attempts
+        remaining = remaining_time()
+        if remaining is not None:
+            # aiohttp treats a zero timeout as no timeout at all
+            total_timeout = max(min(total_timeout, remaining), 0.001)
+        async with governor.slot("http"), \
+                aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=total_timeout)) as session:
             attempt = 0
             while attempt < max_attempts:
                 attempt += 1
+                started_at = time.monotonic()
                 async with session.request(method, endpoint, headers=headers, json=data) as response:
+                    record_upstream_response(api_name, "rest", response.status, started_at, response.headers)
                     if response.status == 204:
                         return {}
 
@@ -81,6 +104,7 @@ async def rest_api_request(
                         logging.debug("API request has been processed", extra=extra_log)
                     break
     except aiohttp.ClientConnectorError as exc:
+        UPSTREAM_REQUESTS.inc(api=api_name, kind="rest", status="connection_error")
         logging.error("API request failed", extra=extra_log | {"error": str(exc), "attempt": attempt})
         raise RESTAPIError(400, "HTTP connection has been broken unexpectedly.", "")
 
@@ -95,12 +119,13 @@ async def graphql_query(
     log_success: bool = False,
     api_name: Optional[str] = "GitHub",
     unsecure: bool = False,
-    timeout: int = 30
+    timeout: int = 30,
+    raise_on_errors: bool = True
 ) -> Dict:
     """
     Perform a GraphQL query or mutation.
 
-    :param endpoint: Host and path of the GraphQL endpoint (e.g., "api.github.com/graphql").
+    :param endpoint: Host and path of the GraphQL endpoint (e.g., "api.github.com/graphql"), or a full URL.
     :param query_or_mutation: The GraphQL query or mutation string.
     :param variables: A dict of variables for the GraphQL operation.
     :param headers: HTTP headers to include in the request.
@@ -108,21 +133,32 @@ async def graphql_query(
     :param api_name: Friendly name for logging; defaults to endpoint.
     :param unsecure: If True, use HTTP rather than HTTPS.
     :param timeout: Total request timeout in seconds.
+    :param raise_on_errors: If False, return partial data along with the `errors` list instead of raising.
     :return: Parsed JSON data from the GraphQL response.
     :raises QueryError: For network or HTTP errors.
     """
-    url = f'{"http" if unsecure else "https"}://{endpoint}'
+    if endpoint.startswith(("http://", "https://")):
+        url = endpoint
+    else:
+        url = f'{"http" if unsecure else "https"}://{endpoint}'
     api_name = api_name or endpoint
     variables = variables or {}
     headers = headers or {"Content-Type": "application/json"}
 
     payload = {"query": query_or_mutation, "variables": variables}
+    check_deadline()
+    remaining = remaining_time()
+    if remaining is not None:
+        # aiohttp treats a zero timeout as no timeout at all
+        timeout = max(min(timeout, remaining), 0.001)
     client_timeout = aiohttp.ClientTimeout(total=timeout)
     log_extra = {"API": api_name, "endpoint": endpoint, "query": query_or_mutation, "variables": variables}
     try:
-        async with aiohttp.ClientSession(timeout=client_timeout) as session:
+        async with governor.slot("http"), aiohttp.ClientSession(timeout=client_timeout) as session:
             logging.debug("Performing GraphQL request", extra={"API": api_name, "endpoint": endpoint})
+            started_at = time.monotonic()
             async with session.post(url, json=payload, headers=headers) as resp:
+                record_upstream_response(api_name, "graphql", resp.status, started_at, resp.headers)
                 text = await resp.text()
                 if resp.status != 200:
                     msg = "HTTP error during GraphQL request"
@@ -136,8 +172,10 @@ async def graphql_query(
         raise
 
     if "errors" in data:
+        UPSTREAM_REQUESTS.inc(api=api_name, kind="graphql", status="graphql_error")
         logging.error("GraphQL returned errors", extra=log_extra | {"response": data})
-        raise GraphQLError(data["errors"])
+        if raise_on_errors:
+            raise GraphQLError(data["errors"])
 
     if log_success:
         logging.info("GraphQL request succeeded", extra=log_extra | {"response": data})
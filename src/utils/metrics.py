@@ -0,0 +1,163 @@
+import time
+import bisect
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Sequence, Tuple
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+LabelValues = Tuple[str, ...]
+
+
+class Metric(ABC):
+    """
+    Base of the in-process metrics rendered in the Prometheus text exposition format.
+    Metrics are kept per worker process.
+    """
+    type_name = "untyped"
+
+    def __init__(self, name: str, description: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        registry.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def _format_labels(self, values: LabelValues, extra: Dict[str, str] = None) -> str:
+        pairs = list(zip(self.label_names, values)) + list((extra or {}).items())
+        if not pairs:
+            return ""
+        escaped = [(k, v.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')) for k, v in pairs]
+        return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+    @abstractmethod
+    def samples(self) -> List[str]:
+        ...
+
+    def render(self) -> str:
+        return "\n".join(
+            [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.type_name}"] + self.samples())
+
+
+class Counter(Metric):
+    type_name = "counter"
+
+    def __init__(self, name: str, description: str, label_names: Sequence[str] = ()):
+        super().__init__(name, description, label_names)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def by_label(self, label: str) -> Dict[str, float]:
+        """
+        Values summed up per value of `label`.
+        """
+        i, totals = self.label_names.index(label), {}
+        for key, value in self._values.items():
+            totals[key[i]] = totals.get(key[i], 0) + value
+        return totals
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{self._format_labels(key)} {value}" for key, value in self._values.items()]
+
+
+class Gauge(Counter):
+    type_name = "gauge"
+
+    def set(self, value: float, **labels: str) -> None:
+        self._values[self._key(labels)] = value
+
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    type_name = "histogram"
+
+    def __init__(self, name: str, description: str, label_names: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, description, label_names)
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: counts per bucket (non-cumulative, the last one is +Inf), sum
+        self._values: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        if key not in self._values:
+            self._values[key] = ([0] * (len(self.buckets) + 1), [0.0])
+        counts, total = self._values[key]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        total[0] += value
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        started_at = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started_at, **labels)
+
+    def samples(self) -> List[str]:
+        lines = []
+        for key, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(list(self.buckets) + ["+Inf"], counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{self._format_labels(key, {'le': str(bound)})} {cumulative}")
+            lines.append(f"{self.name}_sum{self._format_labels(key)} {total[0]}")
+            lines.append(f"{self.name}_count{self._format_labels(key)} {cumulative}")
+        return lines
+
+
+registry: List[Metric] = []
+
+
+def render_metrics() -> str:
+    return "\n".join(metric.render() for metric in registry) + "\n"
+
+
+#
+# Metrics shared across modules
+HTTP_REQUESTS = Counter("gwa_http_requests_total", "API requests served", ["method", "route", "status"])
+HTTP_REQUEST_DURATION = Histogram(
+    "gwa_http_request_duration_seconds", "API request handling time", ["method", "route"])
+HTTP_RESPONSE_BYTES = Counter("gwa_http_response_bytes_total", "Response body bytes served", ["route"])
+
+GIT_COMMANDS = Counter("gwa_git_commands_total", "Git subprocesses run", ["command", "result"])
+GIT_COMMAND_DURATION = Histogram("gwa_git_command_duration_seconds", "Git subprocess run time", ["command"])
+
+SEMAPHORE_WAIT = Histogram("gwa_semaphore_wait_seconds", "Time spent waiting for a concurrency slot", ["semaphore"])
+SEMAPHORE_IN_USE = Gauge("gwa_semaphore_in_use", "Concurrency slots currently taken", ["semaphore"])
+SEMAPHORE_WAITING = Gauge("gwa_semaphore_waiting", "Tasks currently waiting for a concurrency slot", ["semaphore"])
+
+UPSTREAM_REQUESTS = Counter("gwa_upstream_requests_total", "Outgoing API calls", ["api", "kind", "status"])
+UPSTREAM_REQUEST_DURATION = Histogram(
+    "gwa_upstream_request_duration_seconds", "Outgoing API call time", ["api", "kind"])
+RATE_LIMIT_REMAINING = Gauge(
+    "gwa_github_rate_limit_remaining", "Requests left in the current GitHub rate limit window", ["resource"])
+
+WORKFLOW_FILES_SCANNED = Counter("gwa_workflow_files_scanned_total", "YAML files read from checkouts")
+WORKFLOW_FILES_PARSED = Counter("gwa_workflow_files_parsed_total", "YAML files recognized as workflows")
+
+
+def git_subcommand(cmd: str, args: List[str]) -> str:
+    """
+    Name of the git subcommand for metric labels, e.g. `clone` for `git -C path clone ...`.
+    Compound shell scripts are labelled by their first git subcommand.
+    """
+    words = (" ".join([cmd] + (args or []))).split()
+    for i, word in enumerate(words):
+        if word != "git" and not word.endswith("/git"):
+            continue
+        rest = words[i + 1:]
+        while rest and rest[0].startswith("-"):
+            # Skip global options, including those taking a value
+            option = rest.pop(0)
+            if option in ("-C", "-c") and rest:
+                rest.pop(0)
+        return rest[0] if rest else "git"
+    return "shell"
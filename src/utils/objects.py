@@ -0,0 +1,186 @@
+import os
+import time
+import asyncio
+from shlex import quote
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from .git import _git, _shell
+from .metrics import GIT_COMMANDS
+from .resources import governor, FD_COSTS
+from .tracing import record_span
+from src.models import GitError
+from env import *
+from src.common import *
+
+# Refspecs and object ids passed to a single git command
+_FETCH_CHUNK_SIZE = 500
+
+
+def object_store_path(repo: str) -> Path:
+    return OBJECT_STORE_PATH / f"{repo}.git"
+
+
+class CatFileBatch:
+    """
+    A long-lived `git cat-file --batch` process of a repository, for reading many objects with a single process.
+    It takes one shell concurrency slot, and the descriptors of its pipes, while it runs.
+    """
+    def __init__(self, repo_path: Path):
+        self.repo_path = repo_path
+        self._proc: Optional[asyncio.subprocess.Process] = None
+        self._lock = asyncio.Lock()
+        self._slot = governor.slot("shell", FD_COSTS["cat-file"])
+        self._started_ns = 0
+
+    async def __aenter__(self) -> "CatFileBatch":
+        await self._slot.__aenter__()
+        try:
+            self._started_ns = time.time_ns()
+            self._proc = await asyncio.create_subprocess_exec(
+                "git", "-C", str(self.repo_path), "cat-file", "--batch",
+                stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+        except BaseException:
+            await self._slot.__aexit__(None, None, None)
+            raise
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        try:
+            if self._proc.returncode is None:
+                self._proc.stdin.close()
+                try:
+                    await asyncio.wait_for(self._proc.wait(), timeout=5)
+                except asyncio.TimeoutError:
+                    self._proc.kill()
+                    await self._proc.wait()
+            GIT_COMMANDS.inc(command="cat-file", result="ok" if self._proc.returncode == 0 else "error")
+            record_span("git.cat-file", self._started_ns, returncode=self._proc.returncode)
+        finally:
+            await self._slot.__aexit__(*exc_info)
+
+    async def read(self, rev: str) -> Optional[Tuple[str, str, bytes]]:
+        """
+        (oid, type, content) of the object named by `rev`, or None if there's no such object.
+        """
+        async with self._lock:
+            self._proc.stdin.write(f"{rev}\n".encode())
+            await self._proc.stdin.drain()
+            header = (await self._proc.stdout.readline()).decode().split()
+            if not header:
+                raise GitError(f"git cat-file exited in `{self.repo_path}`")
+            if len(header) != 3:
+                # `<rev> missing` or `<rev> ambiguous`
+                return None
+            oid, kind, size = header
+            content = await self._proc.stdout.readexactly(int(size) + 1)
+            return oid, kind, content[:-1]
+
+
+def parse_tree(content: bytes) -> List[Tuple[str, str, str]]:
+    """
+    (mode, name, oid) entries of a raw tree object.
+    """
+    entries, pos = [], 0
+    while pos < len(content):
+        space = content.index(b" ", pos)
+        nul = content.index(b"\0", space)
+        mode, name = content[pos:space].decode(), content[space + 1:nul].decode(errors="surrogateescape")
+        entries.append((mode, name, content[nul + 1:nul + 21].hex()))
+        pos = nul + 21
+    return entries
+
+
+async def list_workflow_blobs(batch: CatFileBatch, branches: List[str], subdir: str = WORKFLOW_DIR) \
+        -> Tuple[Dict[str, Dict[str, str]], List[str]]:
+    """
+    Blob ids of the YAML files under `subdir` of each branch, as {branch: {path in repo: oid}},
+    and the ids of the `subdir` trees they were found in. Trees are always local in the object stores.
+    """
+    blobs: Dict[str, Dict[str, str]] = {}
+    trees: List[str] = []
+
+    async def _walk(branch: str, rev: str, prefix: str) -> None:
+        obj = await batch.read(rev)
+        if not obj or obj[1] != "tree":
+            return
+        if prefix == subdir:
+            trees.append(obj[0])
+        for mode, name, oid in parse_tree(obj[2]):
+            if mode == "40000":
+                await _walk(branch, oid, f"{prefix}/{name}")
+            elif mode.startswith("100") and name.endswith((".yml", ".yaml")):
+                blobs.setdefault(branch, {})[f"{prefix}/{name}"] = oid
+
+    for branch in branches:
+        await _walk(branch, f"refs/heads/{branch}:{subdir}", subdir)
+    return blobs, trees
+
+
+async def read_blobs(batch: CatFileBatch, oids: List[str]) -> Dict[str, bytes]:
+    blobs = {}
+    for oid in oids:
+        obj = await batch.read(oid)
+        if obj and obj[1] == "blob":
+            blobs[oid] = obj[2]
+    return blobs
+
+
+def list_store_branches(store: Path) -> Dict[str, str]:
+    """
+    Branch heads of an object store, read from the ref files without spawning git.
+    """
+    heads = {}
+    packed_refs = store / "packed-refs"
+    if packed_refs.is_file():
+        for line in packed_refs.read_text().splitlines():
+            parts = line.split()
+            if len(parts) == 2 and parts[1].startswith("refs/heads/"):
+                heads[parts[1][len("refs/heads/"):]] = parts[0]
+    refs_root = store / "refs" / "heads"
+    for dirpath, _, filenames in os.walk(refs_root):
+        for filename in filenames:
+            ref_path = Path(dirpath) / filename
+            heads[str(ref_path.relative_to(refs_root))] = ref_path.read_text().strip()
+    return heads
+
+
+async def git_fetch_objects(repo_url: str, store: Path, branches: List[str]) -> None:
+    """
+    Fetch the head commits and trees of `branches` into the bare partial clone `store`, with a single
+    `git fetch` per chunk of branches, then the workflow blobs which are not in the store yet.
+    No working tree is written.
+    """
+    store_arg = quote(str(store))
+    if not await asyncio.to_thread((store / "HEAD").is_file):
+        await asyncio.to_thread(lambda: store.mkdir(parents=True, exist_ok=True))
+        await _git(["init", "-q", "--bare", store_arg])
+        await _git(["-C", store_arg, "config", "remote.origin.promisor", "true"])
+        await _git(["-C", store_arg, "config", "remote.origin.partialclonefilter", "blob:none"])
+    # The URL may carry a token, so it's refreshed on every fetch
+    await _git(["-C", store_arg, "config", "remote.origin.url", quote(repo_url)])
+
+    for offset in range(0, len(branches), _FETCH_CHUNK_SIZE):
+        refspecs = [quote(f"+refs/heads/{branch}:refs/heads/{branch}")
+                    for branch in branches[offset:offset + _FETCH_CHUNK_SIZE]]
+        await _git(["-C", store_arg, "fetch", "-q", "--depth", "1", "--filter=blob:none", "--no-tags",
+                    "--no-write-fetch-head", "origin"] + refspecs)
+
+    async with CatFileBatch(store) as batch:
+        _, trees = await list_workflow_blobs(batch, branches)
+    if not trees:
+        return
+    # Lazy fetching would download every missing blob with a separate `git fetch`
+    try:
+        listing = await _shell("GIT_NO_LAZY_FETCH=1 git", args=[
+            "-C", store_arg, "rev-list", "--objects", "--missing=print"] + sorted(set(trees)))
+    except Exception as e:
+        raise GitError(f"Could not list missing workflow blobs in `{store}`: {e}")
+    missing = [line[1:] for line in listing.splitlines() if line.startswith("?")]
+    for offset in range(0, len(missing), _FETCH_CHUNK_SIZE):
+        await _git(["-C", store_arg, "-c", "fetch.negotiationAlgorithm=noop", "fetch", "-q", "--filter=blob:none",
+                    "--no-tags", "--no-write-fetch-head", "origin"] + missing[offset:offset + _FETCH_CHUNK_SIZE])
+
+
+async def git_delete_store_branch(store: Path, branch: str) -> None:
+    await _git(["-C", quote(str(store)), "update-ref", "-d", quote(f"refs/heads/{branch}")])
@@ -0,0 +1,194 @@
+import os
+import time
+import asyncio
+import itertools
+import resource
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Deque, Dict, List, Optional, Tuple
+
+from env import *
+from .metrics import Counter, Gauge, SEMAPHORE_WAIT, SEMAPHORE_IN_USE, SEMAPHORE_WAITING
+
+# Descriptors the process holds at most while one operation runs
+FD_COSTS = {
+    # stdout and stderr pipes of the child plus the exec error pipe, both ends of each while spawning
+    "shell": 6,
+    # stdin and stdout pipes of a `git cat-file --batch` process, the exec error pipe and /dev/null for stderr
+    "cat-file": 7,
+    # a single open file
+    "file": 1,
+    # directory handles of a tree walk
+    "scan": 4,
+    # `flock`ed lock files are held open for as long as the lock is
+    "lock": 1,
+    # the connection socket of a client session and the one of the DNS lookup
+    "http": 2,
+}
+
+# A descriptor budget never gets below this, whatever the limit and the reserve
+_MIN_BUDGET = 16
+# How long to wait for a release after hitting EMFILE before trying again anyway
+_EXHAUSTED_WAIT = 1.0
+
+FD_BUDGET = Gauge("gwa_fd_budget", "File descriptors the resource governor hands out")
+FD_RESERVED = Gauge("gwa_fd_reserved", "File descriptors currently reserved by running operations", ["kind"])
+FD_EXHAUSTED = Counter("gwa_fd_exhausted_total", "Operations which hit EMFILE despite the budget", ["kind"])
+
+
+def nofile_limits() -> Tuple[int, int]:
+    """
+    Soft and hard RLIMIT_NOFILE of the process, after raising the soft limit up to the hard one if allowed.
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if RAISE_NOFILE_LIMIT and soft != hard:
+        target = hard if hard != resource.RLIM_INFINITY else max(soft, 65536)
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+            soft = target
+        except (ValueError, OSError):
+            pass
+    return soft, hard
+
+
+def count_open_fds() -> Optional[int]:
+    try:
+        return len(os.listdir("/proc/self/fd"))
+    except OSError:
+        return None
+
+
+class ResourceGovernor:
+    """
+    Hands out file descriptors to git subprocesses, file operations and upstream connections from one budget,
+    derived from RLIMIT_NOFILE, so that heavy fan-outs wait for a slot instead of failing with EMFILE.
+
+    Every kind of operation may also have a cap on the number of operations running at once. Waiters are served
+    in arrival order; a waiter held back by the cap of its kind does not hold back the others, but one which
+    does not fit into the descriptor budget does, so that expensive operations are not starved by cheap ones.
+    """
+    def __init__(self, budget: int, limits: Dict[str, int]):
+        self.budget = max(budget, _MIN_BUDGET)
+        # Max operations at once per kind, kinds which are not listed are only bound by the budget
+        self.limits = limits
+        self.nofile: Optional[Dict[str, Optional[int]]] = None
+        self._reserved = 0
+        self._running: Dict[str, int] = {}
+        self._fds: Dict[str, int] = {}
+        self._waiters: Dict[str, Deque[Tuple[int, int, asyncio.Future]]] = {}
+        self._releases: List[asyncio.Future] = []
+        self._seq = itertools.count()
+        self._stats = {"granted": 0, "waited": 0, "exhausted": 0}
+        FD_BUDGET.set(self.budget)
+
+    @classmethod
+    def from_rlimit(cls, limits: Dict[str, int]) -> "ResourceGovernor":
+        soft, hard = nofile_limits()
+        governor = cls(soft - FD_RESERVE - (count_open_fds() or 0), limits)
+        governor.nofile = {"soft": soft, "hard": hard if hard != resource.RLIM_INFINITY else None}
+        return governor
+
+    def _blocked_by_limit(self, kind: str) -> bool:
+        limit = self.limits.get(kind)
+        return bool(limit) and self._running.get(kind, 0) >= limit
+
+    def _take(self, kind: str, fds: int) -> None:
+        self._reserved += fds
+        self._running[kind] = self._running.get(kind, 0) + 1
+        self._fds[kind] = self._fds.get(kind, 0) + fds
+        self._stats["granted"] += 1
+        FD_RESERVED.set(self._fds[kind], kind=kind)
+        SEMAPHORE_IN_USE.inc(semaphore=kind)
+
+    def _release(self, kind: str, fds: int) -> None:
+        self._reserved -= fds
+        self._running[kind] -= 1
+        self._fds[kind] -= fds
+        FD_RESERVED.set(self._fds[kind], kind=kind)
+        SEMAPHORE_IN_USE.dec(semaphore=kind)
+        releases, self._releases = self._releases, []
+        for fut in releases:
+            if not fut.done():
+                fut.set_result(None)
+        self._wake()
+
+    def _wake(self) -> None:
+        while True:
+            head = None
+            for kind, queue in self._waiters.items():
+                while queue and queue[0][2].done():
+                    queue.popleft()
+                if queue and not self._blocked_by_limit(kind) and (head is None or queue[0][0] < head[1][0]):
+                    head = (kind, queue[0])
+            if head is None:
+                return
+            kind, (_, fds, fut) = head
+            if self._reserved + fds > self.budget:
+                return
+            self._waiters[kind].popleft()
+            self._take(kind, fds)
+            fut.set_result(None)
+
+    @asynccontextmanager
+    async def slot(self, kind: str, fds: Optional[int] = None) -> AsyncIterator[None]:
+        """
+        Hold `fds` descriptors, FD_COSTS[kind] by default, and one of the operation slots of `kind`.
+        """
+        fds = min(FD_COSTS.get(kind, 1) if fds is None else fds, self.budget)
+        started_at = time.monotonic()
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(kind, deque()).append((next(self._seq), fds, fut))
+        self._wake()
+        if not fut.done():
+            self._stats["waited"] += 1
+            SEMAPHORE_WAITING.inc(semaphore=kind)
+            try:
+                await fut
+            except BaseException:
+                if fut.done() and not fut.cancelled():
+                    # Granted while being cancelled
+                    self._release(kind, fds)
+                else:
+                    fut.cancel()
+                    self._wake()
+                raise
+            finally:
+                SEMAPHORE_WAITING.dec(semaphore=kind)
+        SEMAPHORE_WAIT.observe(time.monotonic() - started_at, semaphore=kind)
+        try:
+            yield
+        finally:
+            self._release(kind, fds)
+
+    async def exhausted(self, kind: str) -> None:
+        """
+        Called by an operation which got EMFILE anyway, e.g. because of descriptors opened outside the governor
+        like incoming connections. Waits for the next release, or a bit, before the operation is retried.
+        """
+        self._stats["exhausted"] += 1
+        FD_EXHAUSTED.inc(kind=kind)
+        fut = asyncio.get_running_loop().create_future()
+        self._releases.append(fut)
+        try:
+            await asyncio.wait_for(fut, timeout=_EXHAUSTED_WAIT)
+        except asyncio.TimeoutError:
+            pass
+
+    def stats(self) -> Dict:
+        kinds = set(self.limits) | set(self._running) | set(self._waiters)
+        return self._stats | {
+            "nofile_limit": self.nofile,
+            "reserve": FD_RESERVE,
+            "budget": self.budget,
+            "reserved": self._reserved,
+            "open": count_open_fds(),
+            "kinds": {kind: {
+                "limit": self.limits.get(kind) or None,
+                "running": self._running.get(kind, 0),
+                "fds": self._fds.get(kind, 0),
+                "waiting": len([w for w in self._waiters.get(kind, ()) if not w[2].done()]),
+            } for kind in sorted(kinds)},
+        }
+
+
+governor = ResourceGovernor.from_rlimit({"shell": SHELL_CONCURRENCY_LIMIT, "file": FS_CONCURRENCY_LIMIT})
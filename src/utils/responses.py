@@ -0,0 +1,90 @@
+import gzip
+import asyncio
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from src.utils.concurrency import single_flight
+from src.utils.tracing import span
+
+# Bodies smaller than this are sent as is, compressing them costs more than it saves
+MIN_COMPRESS_SIZE = 1024
+
+
+def available_encodings() -> List[str]:
+    """
+    Content codings we can produce, in order of preference.
+    """
+    return (["br"] if brotli else []) + ["gzip"]
+
+
+def encode_body(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=5)
+    if encoding == "gzip":
+        # No timestamp in the header: every worker must produce the same bytes for a given ETag
+        return gzip.compress(body, compresslevel=6, mtime=0)
+    return body
+
+
+class EncodedBodyCache:
+    """
+    Keeps serialized and compressed response bodies per key and content coding until the version of the
+    underlying data changes. Concurrent requests for the same missing body share a single encoding run.
+    """
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._bodies: OrderedDict[Tuple[Hashable, str], Tuple[str, bytes]] = OrderedDict()
+        self._stats = {"hits": 0, "misses": 0}
+
+    async def get(self, key: Hashable, version: str, encoding: str, serialize: Callable[[], Awaitable[bytes]]) \
+            -> Tuple[bytes, str]:
+        """
+        Return the body for `key` at `version`, encoded with `encoding` unless it is too small,
+        and the encoding actually applied.
+        """
+        cached = self._bodies.get((key, encoding))
+        if cached and cached[0] == version:
+            self._stats["hits"] += 1
+            self._bodies.move_to_end((key, encoding))
+            body = cached[1]
+        else:
+            self._stats["misses"] += 1
+            body = await single_flight(
+                ("encoded_body", key, version, encoding), lambda: self._encode(key, version, encoding, serialize))
+        if body is None:
+            # Too small to be worth compressing
+            body, _ = await self.get(key, version, "identity", serialize)
+            return body, "identity"
+        return body, encoding
+
+    async def _encode(self, key: Hashable, version: str, encoding: str, serialize: Callable[[], Awaitable[bytes]]) \
+            -> Optional[bytes]:
+        identity = self._bodies.get((key, "identity"))
+        if identity and identity[0] == version:
+            raw = identity[1]
+        else:
+            with span("serialize"):
+                raw = await serialize()
+            self._store(key, version, "identity", raw)
+        if encoding == "identity":
+            return raw
+        if len(raw) < MIN_COMPRESS_SIZE:
+            return None
+        with span("compress", encoding=encoding, size=len(raw)):
+            body = await asyncio.to_thread(encode_body, raw, encoding)
+        self._store(key, version, encoding, body)
+        return body
+
+    def _store(self, key: Hashable, version: str, encoding: str, body: bytes) -> None:
+        self._bodies[(key, encoding)] = (version, body)
+        self._bodies.move_to_end((key, encoding))
+        while len(self._bodies) > self.max_entries:
+            self._bodies.popitem(last=False)
+
+    def stats(self) -> Dict:
+        return self._stats | {"entries": len(self._bodies), "bytes": sum(len(b) for _, b in self._bodies.values())}
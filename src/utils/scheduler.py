@@ -0,0 +1,172 @@
+import time
+import asyncio
+import contextvars
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Set
+
+from env import *
+from src.models import Token
+
+
+@dataclass(kw_only=True)
+class CommitJob:
+    org: str
+    # Branch checkouts the job commits, mapped to their repositories
+    branches: Dict[Path, str]
+    token_key: str
+    factory: Callable[[], Awaitable]
+    future: asyncio.Future
+    enqueued_at: float = field(default_factory=time.monotonic)
+    # Jobs run in the context of their submitter, so request deadlines apply to them
+    context: contextvars.Context = field(default_factory=contextvars.copy_context)
+    task: Optional[asyncio.Task] = field(default=None)
+
+
+class CommitScheduler:
+    """
+    Runs commit jobs with per-branch serialization, bounded concurrency per repository, per token and overall,
+    and round-robin fairness across organizations. A job may commit several branches of one or more repositories:
+    it waits until none of its branches is being committed, and counts once against each repository it touches.
+    Jobs are not retried here: the commit functions themselves catch up with a moved remote head and commit again,
+    up to `COMMIT_MAX_ATTEMPTS` times.
+    """
+    def __init__(self, concurrency: int, repo_concurrency: int, token_concurrency: int):
+        self.concurrency = concurrency
+        self.repo_concurrency = repo_concurrency
+        self.token_concurrency = token_concurrency
+
+        self._queues: OrderedDict[str, Deque[CommitJob]] = OrderedDict()
+        self._running_branches: Set[Path] = set()
+        self._running_by_repo: Dict[str, int] = {}
+        self._running_by_token: Dict[str, int] = {}
+        self._running = 0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._counters = {"submitted": 0, "succeeded": 0, "failed": 0, "cancelled": 0}
+        self._wait_total, self._wait_max, self._started = 0.0, 0.0, 0
+
+    async def submit(self, org: str, repo: str, branch_path: Path, token: Token, factory: Callable[[], Awaitable]) \
+            -> Any:
+        """
+        Queue a commit job and wait for its result. `factory` is called once the job may run.
+        """
+        return await self.submit_group(org, {branch_path: repo}, token, factory)
+
+    async def submit_group(self, org: str, branches: Dict[Path, str], token: Token,
+                           factory: Callable[[], Awaitable]) -> Any:
+        """
+        Queue a job committing several branch checkouts, mapped to their repositories, and wait for its result.
+        """
+        self._ensure_dispatcher()
+        job = CommitJob(org=org, branches=dict(branches), token_key=token.value, factory=factory,
+                        future=asyncio.get_running_loop().create_future())
+        self._counters["submitted"] += 1
+        self._enqueue(job)
+        try:
+            return await job.future
+        except asyncio.CancelledError:
+            self._cancel(job)
+            raise
+
+    def stats(self) -> Dict:
+        return {
+            "queued": sum(len(q) for q in self._queues.values()),
+            "queued_by_org": {org: len(q) for org, q in self._queues.items() if q},
+            "running": self._running,
+            "running_by_repo": {repo: n for repo, n in self._running_by_repo.items() if n},
+            "wait_seconds_avg": round(self._wait_total / self._started, 3) if self._started else 0.0,
+            "wait_seconds_max": round(self._wait_max, 3),
+            "oldest_wait_seconds": round(max(
+                [time.monotonic() - q[0].enqueued_at for q in self._queues.values() if q], default=0.0), 3),
+        } | self._counters
+
+    def _ensure_dispatcher(self) -> None:
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch(), context=contextvars.Context())
+
+    def _cancel(self, job: CommitJob) -> None:
+        job.future.cancel()
+        queue = self._queues.get(job.org)
+        if queue and job in queue:
+            queue.remove(job)
+            self._counters["cancelled"] += 1
+        elif job.task:
+            job.task.cancel()
+
+    def _enqueue(self, job: CommitJob) -> None:
+        if job.future.done():
+            return
+        self._queues.setdefault(job.org, deque()).append(job)
+        self._wakeup.set()
+
+    def _can_run(self, job: CommitJob) -> bool:
+        return self._running_branches.isdisjoint(job.branches) \
+            and all(self._running_by_repo.get(repo, 0) < self.repo_concurrency for repo in job.branches.values()) \
+            and self._running_by_token.get(job.token_key, 0) < self.token_concurrency
+
+    def _next_job(self) -> Optional[CommitJob]:
+        if self._running >= self.concurrency:
+            return None
+        for org in list(self._queues):
+            queue = self._queues[org]
+            for job in queue:
+                if self._can_run(job):
+                    queue.remove(job)
+                    # Rotate the org to the end, so the next pick starts from another org
+                    self._queues.move_to_end(org)
+                    if not queue:
+                        del self._queues[org]
+                    return job
+        return None
+
+    async def _dispatch(self) -> None:
+        while True:
+            job = self._next_job()
+            if job is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            wait = time.monotonic() - job.enqueued_at
+            self._wait_total += wait
+            self._wait_max = max(self._wait_max, wait)
+            self._started += 1
+
+            self._running += 1
+            self._running_branches.update(job.branches)
+            for repo in set(job.branches.values()):
+                self._running_by_repo[repo] = self._running_by_repo.get(repo, 0) + 1
+            self._running_by_token[job.token_key] = self._running_by_token.get(job.token_key, 0) + 1
+            job.task = asyncio.create_task(self._run(job), context=job.context)
+
+    async def _run(self, job: CommitJob) -> None:
+        try:
+            result = await job.factory()
+        except asyncio.CancelledError:
+            self._counters["cancelled"] += 1
+            job.future.cancel()
+            raise
+        except Exception as e:
+            self._counters["failed"] += 1
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            self._counters["succeeded"] += 1
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            self._running -= 1
+            self._running_branches.difference_update(job.branches)
+            for repo in set(job.branches.values()):
+                self._running_by_repo[repo] -= 1
+            self._running_by_token[job.token_key] -= 1
+            self._wakeup.set()
+
+
+commit_scheduler = CommitScheduler(
+    concurrency=COMMIT_CONCURRENCY_LIMIT, repo_concurrency=COMMIT_REPO_CONCURRENCY_LIMIT,
+    token_concurrency=COMMIT_TOKEN_CONCURRENCY_LIMIT)
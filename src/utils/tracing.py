@@ -0,0 +1,217 @@
+import os
+import time
+import asyncio
+import cProfile
+import io
+import pstats
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Deque, Dict, Iterator, List, Optional
+
+TRACE_SERVICE_NAME = "github-workflow-assistant"
+
+
+@dataclass(kw_only=True)
+class Span:
+    name: str
+    span_id: str = field(default_factory=lambda: os.urandom(8).hex())
+    parent_id: Optional[str] = field(default=None)
+    start_ns: int = field(default_factory=time.time_ns)
+    end_ns: Optional[int] = field(default=None)
+    attributes: Dict[str, Any] = field(default_factory=dict)
+    error: Optional[str] = field(default=None)
+
+    @property
+    def duration_ms(self) -> float:
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e6
+
+
+@dataclass(kw_only=True)
+class Trace:
+    name: str
+    trace_id: str = field(default_factory=lambda: os.urandom(16).hex())
+    spans: List[Span] = field(default_factory=list)
+    max_spans: int = field(default=1000)
+    dropped_spans: int = field(default=0)
+
+    def add(self, span: Span) -> bool:
+        if len(self.spans) >= self.max_spans:
+            self.dropped_spans += 1
+            return False
+        self.spans.append(span)
+        return True
+
+    def server_timing(self, max_entries: int = 20) -> str:
+        """
+        Total time per span name as a `Server-Timing` header value. Concurrent spans of the same name
+        are summed up, so the values may exceed the request duration.
+        """
+        totals: Dict[str, List[float]] = {}
+        for span in self.spans:
+            total = totals.setdefault(span.name, [0.0, 0])
+            total[0] += span.duration_ms
+            total[1] += 1
+        entries = sorted(totals.items(), key=lambda item: -item[1][0])[:max_entries]
+        return ", ".join(
+            f'{name};dur={duration:.1f};desc="{count}x"' for name, (duration, count) in entries)
+
+    def to_otlp(self) -> Dict:
+        """
+        The trace as an OTLP/JSON `ExportTraceServiceRequest`.
+        """
+        def _value(v: Any) -> Dict:
+            if isinstance(v, bool):
+                return {"boolValue": v}
+            if isinstance(v, int):
+                return {"intValue": str(v)}
+            if isinstance(v, float):
+                return {"doubleValue": v}
+            return {"stringValue": str(v)}
+
+        return {"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": TRACE_SERVICE_NAME}}]},
+            "scopeSpans": [{
+                "scope": {"name": TRACE_SERVICE_NAME},
+                "spans": [{
+                    "traceId": self.trace_id,
+                    "spanId": span.span_id,
+                    "parentSpanId": span.parent_id or "",
+                    "name": span.name,
+                    # SPAN_KIND_SERVER for the root span, SPAN_KIND_INTERNAL for the others
+                    "kind": 2 if span.parent_id is None else 1,
+                    "startTimeUnixNano": str(span.start_ns),
+                    "endTimeUnixNano": str(span.end_ns or time.time_ns()),
+                    "attributes": [{"key": k, "value": _value(v)} for k, v in span.attributes.items()],
+                    "status": {"code": 2, "message": span.error} if span.error else {"code": 1},
+                } for span in self.spans],
+            }],
+        }]}
+
+
+_current_trace: ContextVar[Optional[Trace]] = ContextVar("current_trace", default=None)
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+# Recently finished traces, newest last
+recent_traces: Deque[Trace] = deque(maxlen=50)
+
+
+@contextmanager
+def start_trace(name: str, **attributes: Any) -> Iterator[Trace]:
+    """
+    Start a trace with a root span. Spans opened within the block, including in tasks created from it,
+    are recorded in this trace.
+    """
+    trace = Trace(name=name)
+    trace_token = _current_trace.set(trace)
+    try:
+        with span(name, **attributes):
+            yield trace
+    finally:
+        _current_trace.reset(trace_token)
+        recent_traces.append(trace)
+
+
+@contextmanager
+def span(name: str, **attributes: Any) -> Iterator[Optional[Span]]:
+    """
+    Record a span in the current trace, if any. Outside of a trace this costs next to nothing.
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        yield None
+        return
+    parent = _current_span.get()
+    current = Span(name=name, parent_id=parent.span_id if parent else None, attributes=attributes)
+    if not trace.add(current):
+        yield None
+        return
+    span_token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = f"{e.__class__.__name__}: {e}"
+        raise
+    finally:
+        current.end_ns = time.time_ns()
+        _current_span.reset(span_token)
+
+
+def record_span(name: str, start_ns: int, error: str = None, **attributes: Any) -> None:
+    """
+    Record a span which started at `start_ns` and ends now, for code where a `with` block doesn't fit.
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        return
+    parent = _current_span.get()
+    trace.add(Span(name=name, parent_id=parent.span_id if parent else None, start_ns=start_ns,
+                   end_ns=time.time_ns(), attributes=attributes, error=error))
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+#
+# On-demand profiling
+_profile_lock = asyncio.Lock()
+
+
+async def profile_cpu(seconds: float, limit: int = 50, sort_by: str = "cumulative") -> str:
+    """
+    Profile the event loop thread for `seconds` and return the `pstats` report of the top `limit` functions.
+    Only one profile can run at a time.
+    """
+    if sort_by not in {key.value for key in pstats.SortKey}:
+        raise ValueError(f"Invalid sort key `{sort_by}`")
+    if _profile_lock.locked():
+        raise RuntimeError("Another profile is already running")
+    async with _profile_lock:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.disable()
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats(sort_by).print_stats(limit)
+    return out.getvalue()
+
+
+async def profile_memory(seconds: float, limit: int = 50, group_by: str = "lineno") -> Dict:
+    """
+    Take a `tracemalloc` snapshot. If tracing was off, it's on for `seconds`, so the snapshot shows
+    allocations made during that window only.
+    """
+    if _profile_lock.locked():
+        raise RuntimeError("Another profile is already running")
+    async with _profile_lock:
+        started_here = not tracemalloc.is_tracing()
+        if started_here:
+            tracemalloc.start(25)
+        try:
+            await asyncio.sleep(seconds)
+            snapshot = tracemalloc.take_snapshot()
+            traced_current, traced_peak = tracemalloc.get_traced_memory()
+        finally:
+            if started_here:
+                tracemalloc.stop()
+
+    snapshot = snapshot.filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ])
+    stats = snapshot.statistics(group_by)
+    return {
+        "traced_bytes": traced_current,
+        "traced_peak_bytes": traced_peak,
+        "total_bytes": sum(stat.size for stat in stats),
+        "top": [{
+            "location": str(stat.traceback[0]) if stat.traceback else "",
+            "size_bytes": stat.size,
+            "count": stat.count,
+        } for stat in stats[:limit]],
+    }
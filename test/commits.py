@@ -0,0 +1,32 @@
+import unittest
+import unittest.mock
+from pathlib import Path
+
+from src.commits import graphql_batches
+from src.models import File, GitHubWorkflow
+
+
+class TestGraphQLBatches(unittest.TestCase):
+    def setUp(self):
+        patcher = unittest.mock.patch.object(File, "root", Path("/storage"))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _workflows(self, repo: str, count: int):
+        return [GitHubWorkflow(path=Path(f"org/{repo}/b{i}/.github/workflows/ci.yml"), content="")
+                for i in range(count)]
+
+    def test_across_repos(self):
+        workflows = [wf for i in range(25) for wf in self._workflows(f"repo-{i}", 1)]
+        batches = graphql_batches(workflows, batch_size=10, repo_limit=4)
+        self.assertEqual([len(batch) for batch in batches], [10, 10, 5])
+        self.assertEqual([wf for batch in batches for wf in batch], workflows)
+
+    def test_repo_limit(self):
+        workflows = self._workflows("big", 9) + self._workflows("small", 2)
+        batches = graphql_batches(workflows, batch_size=10, repo_limit=4)
+        self.assertEqual(sorted(wf.branch for batch in batches for wf in batch), sorted(wf.branch for wf in workflows))
+        for batch in batches:
+            self.assertLessEqual(len(batch), 10)
+            self.assertLessEqual(len([wf for wf in batch if wf.repo == "org/big"]), 4)
+        self.assertEqual(len(batches), 3)
@@ -1,6 +1,16 @@
+import hmac
+import json
+import hashlib
 import unittest
+import unittest.mock
+from pathlib import Path
 
-from src.common import extract_runs_on_labels, git_branch_by_full_path
+from src.common import extract_runs_on_labels, git_branch_by_full_path, replace_runs_on_labels, \
+    unified_workflow_diff, plan_webhook_event, verify_webhook_signature, WebhookAction, negotiate_encoding, \
+    etag_matches, count_runs_on_labels, BranchPolicy, select_branches, text_trigrams, regex_literals, search_lines, \
+    pack_snapshot, unpack_snapshot
+
+WEBHOOK_FIXTURES = Path(__file__).parent / "fixtures" / "webhooks"
 
 
 class TestExtractRunsOnLabels(unittest.TestCase):
@@ -147,6 +157,91 @@ class TestExtractRunsOnLabels(unittest.TestCase):
         expected = {"macos-15"}
         self.assertEqual(extract_runs_on_labels(content), expected)
 
+    def test_count_jobs_per_label(self):
+        content = """
+        jobs:
+          build:
+            runs-on: [ubuntu-20.04, self-hosted, ubuntu-20.04]
+          test:
+            runs-on:
+              - ubuntu-20.04
+          lint:
+            runs-on: ubuntu-latest
+        """
+        expected = {"ubuntu-20.04": 2, "self-hosted": 1, "ubuntu-latest": 1}
+        self.assertEqual(count_runs_on_labels(content), expected)
+
+
+class TestReplaceRunsOnLabels(unittest.TestCase):
+    def test_single_value_with_comment(self):
+        content = """
+        jobs:
+          build:
+            runs-on: ubuntu-20.04 # legacy
+        """
+        expected = """
+        jobs:
+          build:
+            runs-on: puzl-ubuntu-latest # legacy
+        """
+        self.assertEqual(replace_runs_on_labels(content, ["ubuntu-20.04"], "puzl-ubuntu-latest"), expected)
+
+    def test_bracket_list_keeps_order(self):
+        content = "jobs:\n  test:\n    runs-on: [self-hosted, ubuntu-20.04, 'ubuntu-22.04']\n"
+        expected = "jobs:\n  test:\n    runs-on: [self-hosted, puzl-any]\n"
+        self.assertEqual(replace_runs_on_labels(content, ["ubuntu-20.04", "ubuntu-22.04"], "puzl-any"), expected)
+
+    def test_multiline_list(self):
+        content = """
+        jobs:
+          deploy:
+            runs-on:
+              - ubuntu-20.04
+              - self-hosted
+              - ubuntu-22.04
+            steps: []
+        """
+        expected = """
+        jobs:
+          deploy:
+            runs-on:
+              - puzl-any
+              - self-hosted
+            steps: []
+        """
+        self.assertEqual(replace_runs_on_labels(content, ["ubuntu-20.04", "ubuntu-22.04"], "puzl-any"), expected)
+
+    def test_untouched(self):
+        content = "jobs:\n  build:\n    runs-on: ${{ matrix.os }}\n"
+        self.assertEqual(replace_runs_on_labels(content, ["ubuntu-20.04"], "puzl-any"), content)
+
+    def test_only_jobs(self):
+        content = """
+        on:
+          workflow_call:
+            inputs:
+              runs-on:
+                default: ubuntu-20.04
+        runs-on: ubuntu-20.04
+        jobs:
+          build:
+            runs-on: ubuntu-20.04
+        """
+        updated = replace_runs_on_labels(content, ["ubuntu-20.04"], "puzl-any")
+        self.assertEqual(updated.count("puzl-any"), 1)
+        self.assertEqual(extract_runs_on_labels(updated), {"puzl-any"})
+
+
+class TestUnifiedWorkflowDiff(unittest.TestCase):
+    def test_counts(self):
+        diff, additions, deletions = unified_workflow_diff(
+            "org/repo/main/.github/workflows/ci.yaml", "a\nb\nc\n", "a\nB\nc\nd\n")
+        self.assertEqual((additions, deletions), (2, 1))
+        self.assertIn("+++ b/org/repo/main/.github/workflows/ci.yaml", diff)
+
+    def test_no_changes(self):
+        self.assertEqual(unified_workflow_diff("f", "a\n", "a\n"), ("", 0, 0))
+
 
 class TestGitBranchByPath(unittest.TestCase):
     def test_basic_extraction(self):
@@ -171,3 +266,133 @@ class TestGitBranchByPath(unittest.TestCase):
         with self.assertRaises(ValueError) as cm1:
             git_branch_by_full_path("/invalid/path", "/repo", "prefix")
         self.assertIn("is not in the subpath", str(cm1.exception))
+
+
+class TestWebhooks(unittest.TestCase):
+    @staticmethod
+    def load(name: str) -> dict:
+        return json.loads((WEBHOOK_FIXTURES / f"{name}.json").read_text())
+
+    def test_signature(self):
+        body = (WEBHOOK_FIXTURES / "push_other_files.json").read_bytes()
+        signature = "sha256=" + hmac.new(b"secret", body, hashlib.sha256).hexdigest()
+        self.assertTrue(verify_webhook_signature("secret", body, signature))
+        self.assertFalse(verify_webhook_signature("other", body, signature))
+        self.assertFalse(verify_webhook_signature("secret", body, None))
+
+    def test_push_touching_workflows_refetches(self):
+        action = plan_webhook_event("push", self.load("push_workflow_changed"), lambda repo, branch: True)
+        self.assertEqual(action, WebhookAction(
+            kind="refetch", repo="puzl-cloud/demo", branch="feature/ci",
+            head="0d1a26e67d8f5eaf1f6ba5c57fc3c7d91ac0fd1c"))
+
+    def test_push_other_files_updates_head(self):
+        action = plan_webhook_event("push", self.load("push_other_files"), lambda repo, branch: True)
+        self.assertEqual(action.kind, "update_head")
+
+    def test_push_untracked_branch_ignored(self):
+        self.assertIsNone(plan_webhook_event("push", self.load("push_workflow_changed"), lambda repo, branch: False))
+
+    def test_create_and_delete(self):
+        tracked = lambda repo, branch: branch is None or branch.startswith("dependabot/")
+        self.assertEqual(plan_webhook_event("create", self.load("create_branch"), tracked).kind, "refetch")
+        self.assertEqual(plan_webhook_event("delete", self.load("delete_branch"), tracked).kind, "drop")
+        self.assertIsNone(plan_webhook_event("delete", self.load("delete_branch"), lambda repo, branch: False))
+
+
+class TestContentNegotiation(unittest.TestCase):
+    def test_negotiate_encoding(self):
+        self.assertEqual(negotiate_encoding("gzip, deflate, br", ["br", "gzip"]), "br")
+        self.assertEqual(negotiate_encoding("gzip, deflate, br", ["gzip"]), "gzip")
+        self.assertEqual(negotiate_encoding("br;q=0, gzip;q=0.5", ["br", "gzip"]), "gzip")
+        self.assertEqual(negotiate_encoding("*", ["br", "gzip"]), "br")
+        self.assertEqual(negotiate_encoding(None, ["br", "gzip"]), "identity")
+        self.assertEqual(negotiate_encoding("identity", ["br", "gzip"]), "identity")
+
+    def test_etag_matches(self):
+        self.assertTrue(etag_matches('"v1-gzip"', '"v1-gzip"'))
+        self.assertTrue(etag_matches('"v0", W/"v1-gzip"', '"v1-gzip"'))
+        self.assertTrue(etag_matches("*", '"v1-gzip"'))
+        self.assertFalse(etag_matches('"v1-br"', '"v1-gzip"'))
+        self.assertFalse(etag_matches(None, '"v1-gzip"'))
+
+
+class TestSelectBranches(unittest.TestCase):
+    branches = ["main", "feature/a", "feature/b", "dependabot/npm/x", "release-1"]
+    committed_at = {"main": 100.0, "feature/a": 1000.0, "feature/b": 500.0, "dependabot/npm/x": 900.0}
+
+    def test_no_policy(self):
+        self.assertEqual(set(select_branches(self.branches, "main", BranchPolicy())), set(self.branches))
+
+    def test_default_only(self):
+        self.assertEqual(select_branches(self.branches, "main", BranchPolicy(default_only=True)), ["main"])
+
+    def test_globs(self):
+        policy = BranchPolicy(include=["feature/*", "dependabot/*"], exclude=["dependabot/*"])
+        self.assertEqual(select_branches(self.branches, "main", policy), ["main", "feature/a", "feature/b"])
+        self.assertNotIn("main", select_branches(self.branches, "main", BranchPolicy(exclude=["main"])))
+
+    def test_recent_and_max(self):
+        policy = BranchPolicy(recent_days=600 / 86400)
+        # `release-1` has no known commit date, so it's kept
+        self.assertEqual(select_branches(self.branches, "main", policy, self.committed_at, now=1200.0),
+                         ["main", "feature/a", "dependabot/npm/x", "release-1"])
+        policy = BranchPolicy(max_per_repo=3)
+        self.assertEqual(select_branches(self.branches, "main", policy, self.committed_at),
+                         ["main", "feature/a", "dependabot/npm/x"])
+
+
+class TestSearchHelpers(unittest.TestCase):
+    def test_text_trigrams(self):
+        self.assertEqual(text_trigrams("uses: A"), {"use", "ses", "es:", "s: ", ": a"})
+        self.assertEqual(text_trigrams("ab"), set())
+
+    def test_regex_literals(self):
+        self.assertEqual(regex_literals(r"actions/checkout@v[34]"), ["actions/checkout@v"])
+        self.assertEqual(regex_literals(r"secrets\.(NPM|PYPI)_TOKEN"), ["secrets.", "_TOKEN"])
+        self.assertEqual(regex_literals(r"(uses: )+docker://\S+"), ["uses: ", "docker://"])
+        self.assertEqual(regex_literals(r"node(-version)?: 1[68]"), ["node", ": 1"])
+        self.assertEqual(regex_literals(r"foo|bar"), [])
+        self.assertEqual(regex_literals(r"a++b"), ["a", "b"])
+
+    def test_regex_literals_without_parser(self):
+        with unittest.mock.patch("src.common.sre_parse", None):
+            self.assertEqual(regex_literals(r"actions/checkout@v[34]"), [])
+
+    def test_search_lines(self):
+        text = "a\nb\nuses: x\nc\nd"
+        self.assertEqual(search_lines(text, lambda line: "uses" in line, context=1),
+                         [{"line": 3, "text": "uses: x", "before": ["b"], "after": ["c"]}])
+        self.assertEqual(search_lines(text, lambda line: True, limit=2)[-1]["line"], 2)
+
+
+class TestSnapshots(unittest.TestCase):
+    def snapshot(self, **overrides) -> dict:
+        return {
+            "org": "org", "contents": {"a1": "on: push\n"}, "labels": {"a1": {}},
+            "branches": [{"repo": "repo", "branch": "feature/x", "head": "f00",
+                          "files": {".github/workflows/ci.yml": "a1"}}],
+        } | overrides
+
+    def test_roundtrip(self):
+        snapshot = unpack_snapshot(pack_snapshot(self.snapshot()))
+        self.assertEqual(snapshot["format"], "gwa-snapshot")
+        self.assertEqual(snapshot["branches"][0]["files"], {".github/workflows/ci.yml": "a1"})
+        self.assertEqual(pack_snapshot(self.snapshot()), pack_snapshot(self.snapshot()))
+
+    def test_not_a_snapshot(self):
+        for data in (b"", b"{}", pack_snapshot({})[:-4]):
+            with self.assertRaises(ValueError):
+                unpack_snapshot(data)
+        with self.assertRaises(ValueError):
+            unpack_snapshot(pack_snapshot(self.snapshot(version=2)))
+
+    def test_paths_stay_in_branches(self):
+        branch = self.snapshot()["branches"][0]
+        for invalid in ({"repo": "../other"}, {"repo": "a/b"}, {"repo": ".objects"}, {"branch": "x/../../y"},
+                        {"branch": "/abs"}, {"files": {".github/workflows/../../x.yml": "a1"}},
+                        {"files": {"src/x.yml": "a1"}}, {"files": {".github/workflows/ci.yml": "missing"}}):
+            with self.assertRaises(ValueError, msg=invalid):
+                unpack_snapshot(pack_snapshot(self.snapshot(branches=[branch | invalid])))
+        with self.assertRaises(ValueError):
+            unpack_snapshot(pack_snapshot(self.snapshot(org="..")))
@@ -0,0 +1,111 @@
+import asyncio
+import unittest
+import unittest.mock
+
+from src.utils import http
+from src.utils.concurrency import deadline, remaining_time, check_deadline, gather_within_deadline, \
+    DeadlineExceeded
+
+
+class TestDeadline(unittest.IsolatedAsyncioTestCase):
+    def test_no_deadline(self):
+        self.assertIsNone(remaining_time())
+        with deadline(None):
+            self.assertIsNone(remaining_time())
+            check_deadline()
+
+    def test_nested_only_shortens(self):
+        with deadline(10):
+            with deadline(60):
+                self.assertLessEqual(remaining_time(), 10)
+            with deadline(1):
+                self.assertLessEqual(remaining_time(), 1)
+        self.assertIsNone(remaining_time())
+
+    async def test_expired(self):
+        with deadline(0.01):
+            await asyncio.sleep(0.02)
+            self.assertEqual(remaining_time(), 0.0)
+            with self.assertRaises(DeadlineExceeded):
+                check_deadline()
+
+    async def test_propagated_to_tasks(self):
+        async def _remaining():
+            return remaining_time()
+
+        with deadline(5):
+            task = asyncio.create_task(_remaining())
+        self.assertIsNotNone(await task)
+        self.assertLessEqual(await task, 5)
+        self.assertIsNone(await asyncio.create_task(_remaining()))
+
+
+class TestGatherWithinDeadline(unittest.IsolatedAsyncioTestCase):
+    async def test_results_and_errors(self):
+        async def _fail():
+            raise ValueError("failed")
+
+        async def _value():
+            return 1
+
+        results = await gather_within_deadline(_value(), _fail())
+        self.assertEqual(results[0], 1)
+        self.assertIsInstance(results[1], ValueError)
+
+    async def test_late_work_cancelled(self):
+        cancelled = asyncio.Event()
+
+        async def _slow():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        async def _fast():
+            return "done"
+
+        with deadline(0.05):
+            results = await gather_within_deadline(_fast(), _slow())
+        self.assertEqual(results[0], "done")
+        self.assertIsInstance(results[1], DeadlineExceeded)
+        self.assertTrue(cancelled.is_set())
+
+    async def test_caller_cancelled(self):
+        started, cancelled = asyncio.Event(), asyncio.Event()
+
+        async def _slow():
+            started.set()
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        caller = asyncio.create_task(gather_within_deadline(_slow()))
+        await started.wait()
+        caller.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await caller
+        await asyncio.sleep(0)
+        self.assertTrue(cancelled.is_set())
+
+
+class TestHTTPDeadline(unittest.IsolatedAsyncioTestCase):
+    async def test_expired_not_requested(self):
+        with unittest.mock.patch("aiohttp.ClientSession") as session, deadline(0.01):
+            await asyncio.sleep(0.02)
+            with self.assertRaises(DeadlineExceeded):
+                await http.rest_api_request("GET", "https://api.github.com/user", {}, "GitHub")
+            with self.assertRaises(DeadlineExceeded):
+                await http.graphql_query("https://api.github.com/graphql", "query { viewer { login } }")
+        session.assert_not_called()
+
+    async def test_timeout_bounded_by_deadline(self):
+        with unittest.mock.patch("aiohttp.ClientSession", side_effect=RuntimeError("stop")) as session, \
+                deadline(2):
+            with self.assertRaises(RuntimeError), self.assertLogs(level="ERROR"):
+                await http.graphql_query("https://api.github.com/graphql", "query { viewer { login } }")
+        timeout = session.call_args.kwargs["timeout"].total
+        self.assertGreater(timeout, 0)
+        self.assertLessEqual(timeout, 2)
@@ -0,0 +1,71 @@
+import os
+import tempfile
+import unittest
+import unittest.mock
+from pathlib import Path
+
+from src.models import File
+from src.utils.files import write_files_atomically
+
+
+class TestWriteFilesAtomically(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self._tmp.name)
+        patcher = unittest.mock.patch.object(File, "root", self.root)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.target = self.root / "org" / "repo" / "main" / ".github" / "workflows" / "ci.yml"
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def _file(self, content: str) -> File:
+        return File(path=self.target.relative_to(self.root), content=content)
+
+    def _leftovers(self) -> list:
+        return [p.name for p in self.target.parent.iterdir() if p.name.endswith(".tmp")]
+
+    def test_new_file(self):
+        self.assertEqual(write_files_atomically([self._file("runs-on: puzl-cloud\n")]), [True])
+        self.assertEqual(self.target.read_text(), "runs-on: puzl-cloud\n")
+        self.assertEqual(self._leftovers(), [])
+
+    def test_identical_content_skipped(self):
+        write_files_atomically([self._file("runs-on: puzl-cloud\n")])
+        before = self.target.stat()
+        self.assertEqual(write_files_atomically([self._file("runs-on: puzl-cloud\n")]), [False])
+        after = self.target.stat()
+        self.assertEqual((before.st_ino, before.st_mtime_ns), (after.st_ino, after.st_mtime_ns))
+
+    def test_same_size_different_content(self):
+        write_files_atomically([self._file("runs-on: a\n")])
+        self.assertEqual(write_files_atomically([self._file("runs-on: b\n")]), [True])
+        self.assertEqual(self.target.read_text(), "runs-on: b\n")
+
+    def test_mode_preserved(self):
+        write_files_atomically([self._file("runs-on: ubuntu-latest\n")])
+        os.chmod(self.target, 0o750)
+        write_files_atomically([self._file("runs-on: puzl-cloud\n")])
+        self.assertEqual(self.target.stat().st_mode & 0o777, 0o750)
+
+    def test_renamed_over_target(self):
+        write_files_atomically([self._file("runs-on: ubuntu-latest\n")])
+        inode = self.target.stat().st_ino
+        with open(self.target) as reader:
+            self.assertEqual(write_files_atomically([self._file("runs-on: puzl-cloud\n")]), [True])
+            # A reader of the old file keeps seeing it whole
+            self.assertEqual(reader.read(), "runs-on: ubuntu-latest\n")
+        self.assertNotEqual(self.target.stat().st_ino, inode)
+        self.assertEqual(self.target.read_text(), "runs-on: puzl-cloud\n")
+        self.assertEqual(self._leftovers(), [])
+
+    def test_error_per_file(self):
+        self.target.parent.mkdir(parents=True)
+        blocker = self.target.parent / "blocked"
+        blocker.write_text("")
+        files = [File(path=(blocker / "ci.yml").relative_to(self.root), content="x"), self._file("y")]
+        results = write_files_atomically(files)
+        self.assertIsInstance(results[0], OSError)
+        self.assertEqual(results[1], True)
+        self.assertEqual(self._leftovers(), [])
@@ -0,0 +1,128 @@
+import tempfile
+import unittest
+import subprocess
+from pathlib import Path
+
+from src.models import GitConflictError
+from src.utils.git import git_commit_and_push, git_commit_and_push_many, read_local_head, read_remote_head
+
+
+def _run(*args: str, cwd: Path = None) -> str:
+    return subprocess.run(args, cwd=cwd, check=True, capture_output=True, text=True).stdout
+
+
+def _git(repo: Path, *args: str) -> str:
+    return _run("git", "-C", str(repo), "-c", "user.name=test", "-c", "user.email=test@example.com", *args)
+
+
+class LocalRemoteTestCase(unittest.IsolatedAsyncioTestCase):
+    """
+    A local bare repository with `main` and `feature` branches, and shallow checkouts of them.
+    """
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self._tmp.name)
+        self.remote = self.root / "remote.git"
+        self.origin = f"file://{self.remote}"
+        seed = self.root / "seed"
+        _run("git", "init", "-q", "--bare", "-b", "main", str(self.remote))
+        _run("git", "init", "-q", "-b", "main", str(seed))
+        (seed / ".github" / "workflows").mkdir(parents=True)
+        (seed / ".github" / "workflows" / "ci.yml").write_text("runs-on: ubuntu-latest\n")
+        (seed / "README.md").write_text("readme\n")
+        _git(seed, "add", ".")
+        _git(seed, "commit", "-q", "-m", "init")
+        _git(seed, "push", "-q", str(self.remote), "main", "main:feature")
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def _checkout(self, branch: str) -> Path:
+        path = self.root / "checkouts" / branch
+        _run("git", "clone", "-q", "--depth", "1", "-b", branch, self.origin, str(path))
+        return path
+
+    def _remote_edit(self, branch: str, path: str, text: str) -> None:
+        work = self.root / f"work-{branch}"
+        _run("git", "clone", "-q", "-b", branch, str(self.remote), str(work))
+        with open(work / path, "a") as f:
+            f.write(text)
+        _git(work, "commit", "-q", "-am", "remote edit")
+        _git(work, "push", "-q", "origin", branch)
+        _run("rm", "-rf", str(work))
+
+    def _remote_file(self, branch: str, path: str) -> str:
+        return _git(self.remote, "show", f"{branch}:{path}")
+
+
+class TestReadRemoteHead(LocalRemoteTestCase):
+    def _remote_head(self, branch: str) -> str:
+        return _git(self.remote, "rev-parse", branch).strip()
+
+    def test_unpushed_commit(self):
+        checkout = self._checkout("main")
+        (checkout / "README.md").write_text("local\n")
+        _git(checkout, "commit", "-q", "-am", "local edit")
+        self.assertEqual(read_remote_head(checkout), self._remote_head("main"))
+        self.assertNotEqual(read_local_head(checkout), self._remote_head("main"))
+
+    def test_fetched_later(self):
+        checkout = self._checkout("feature")
+        self._remote_edit("feature", "README.md", "remote\n")
+        _git(checkout, "fetch", "-q", "--depth", "1", self.origin, "feature")
+        self.assertEqual(read_remote_head(checkout), self._remote_head("feature"))
+
+
+class TestCommitAndPushRetries(LocalRemoteTestCase):
+    """
+    Pushes to a local bare repository whose branches move on between the checkout and the push.
+    """
+
+    async def test_rebased_when_edited_paths_unchanged(self):
+        checkout = self._checkout("main")
+        (checkout / ".github" / "workflows" / "ci.yml").write_text("runs-on: puzl-cloud\n")
+        self._remote_edit("main", "README.md", "remote\n")
+
+        async def _can_rebase(base, remote_head, edited_paths):
+            return edited_paths == [".github/workflows/ci.yml"]
+
+        await git_commit_and_push(checkout, "update", "main", self.origin, "test@example.com", "test",
+                                  can_rebase=_can_rebase)
+        self.assertEqual(self._remote_file("main", ".github/workflows/ci.yml"), "runs-on: puzl-cloud\n")
+        self.assertEqual(self._remote_file("main", "README.md"), "readme\nremote\n")
+
+    async def test_conflict_after_max_attempts(self):
+        checkout = self._checkout("main")
+        (checkout / ".github" / "workflows" / "ci.yml").write_text("runs-on: puzl-cloud\n")
+        self._remote_edit("main", ".github/workflows/ci.yml", "remote\n")
+
+        with self.assertRaises(GitConflictError):
+            await git_commit_and_push(checkout, "update", "main", self.origin, "test@example.com", "test",
+                                      max_attempts=1)
+        self.assertEqual(self._remote_file("main", ".github/workflows/ci.yml"), "runs-on: ubuntu-latest\nremote\n")
+
+    async def test_many_retries_rejected_branch(self):
+        checkouts = {branch: self._checkout(branch) for branch in ["main", "feature"]}
+        for checkout in checkouts.values():
+            (checkout / ".github" / "workflows" / "ci.yml").write_text("runs-on: puzl-cloud\n")
+        self._remote_edit("feature", "README.md", "remote\n")
+
+        async def _can_rebase(base, remote_head, edited_paths):
+            return True
+
+        results = await git_commit_and_push_many(
+            self.root / "staging.git", checkouts, "update", self.origin, "test@example.com", "test",
+            can_rebase=_can_rebase)
+        self.assertEqual(results, {"main": None, "feature": None})
+        for branch in checkouts:
+            self.assertEqual(self._remote_file(branch, ".github/workflows/ci.yml"), "runs-on: puzl-cloud\n")
+        self.assertEqual(self._remote_file("feature", "README.md"), "readme\nremote\n")
+
+    async def test_many_reports_conflict_after_max_attempts(self):
+        checkouts = {"feature": self._checkout("feature")}
+        (checkouts["feature"] / ".github" / "workflows" / "ci.yml").write_text("runs-on: puzl-cloud\n")
+        self._remote_edit("feature", "README.md", "remote\n")
+
+        results = await git_commit_and_push_many(
+            self.root / "staging.git", checkouts, "update", self.origin, "test@example.com", "test", max_attempts=1)
+        self.assertIsInstance(results["feature"], GitConflictError)
@@ -0,0 +1,136 @@
+import os
+import re
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+from pathlib import Path
+
+from src.index import LabelUsage, WorkflowIndex
+from src.models import File, GitHubWorkflow
+
+WORKFLOW = """name: {name}
+on: push
+jobs:
+  build:
+    runs-on: {build}
+  test:
+    runs-on: [{test}]
+    steps:
+      - run: make test-{name}
+      - uses: actions/checkout@v4
+"""
+
+
+def _workflow(name: str, build: str = "ubuntu-latest", test: str = "self-hosted, puzl-cloud") -> str:
+    return WORKFLOW.format(name=name, build=build, test=test)
+
+
+class TestLabelUsage(unittest.TestCase):
+    def test_apply_and_subtract(self):
+        with unittest.mock.patch.object(File, "root", Path("/storage")):
+            main = GitHubWorkflow(path=Path("org/repo/main/.github/workflows/ci.yml"), content="")
+            dev = GitHubWorkflow(path=Path("org/repo/dev/.github/workflows/ci.yml"), content="")
+        usage = LabelUsage()
+        usage.apply(main, {"puzl-cloud": 2, "linux": 1}, 1)
+        usage.apply(dev, {"puzl-cloud": 1}, 1)
+        self.assertEqual(usage.totals, {"puzl-cloud": [2, 3], "linux": [1, 1]})
+        self.assertEqual(usage.branches["puzl-cloud"]["org/repo"], {"main": [1, 2], "dev": [1, 1]})
+
+        usage.apply(main, {"puzl-cloud": 2, "linux": 1}, -1)
+        self.assertEqual(usage.totals, {"puzl-cloud": [1, 1]})
+        self.assertEqual(usage.repos, {"puzl-cloud": {"org/repo": [1, 1]}})
+        usage.apply(dev, {"puzl-cloud": 1}, -1)
+        self.assertEqual((usage.totals, usage.repos, usage.branches), ({}, {}, {}))
+        self.assertEqual(usage.report(), [])
+
+
+class WorkflowIndexTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self._tmp.name)
+        for patcher in (unittest.mock.patch.object(File, "root", self.root),
+                        unittest.mock.patch("src.utils.github.REPO_STORAGE_PATH", self.root)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.index = WorkflowIndex(self.root)
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def _write(self, repo: str, branch: str, name: str, content: str) -> Path:
+        path = self.root / "org" / repo / branch / ".github" / "workflows" / f"{name}.yml"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(content)
+        # Make sure a rewrite within the same mtime tick is noticed
+        stat = path.stat()
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+        return path
+
+
+class TestIncrementalLabelUsage(WorkflowIndexTestCase):
+    async def test_apply_rewrite_remove(self):
+        self._write("repo", "main", "ci", _workflow("ci"))
+        self._write("repo", "dev", "ci", _workflow("ci"))
+        usage = {u["label"]: (u["workflows"], u["jobs"]) for u in await self.index.label_usage("org")}
+        self.assertEqual(usage, {"ubuntu-latest": (2, 2), "self-hosted": (2, 2), "puzl-cloud": (2, 2)})
+
+        self._write("repo", "main", "ci", _workflow("ci", build="puzl-cloud", test="puzl-cloud"))
+        await self.index.invalidate("org", "repo")
+        usage = {u["label"]: (u["workflows"], u["jobs"]) for u in await self.index.label_usage("org")}
+        self.assertEqual(usage, {"ubuntu-latest": (1, 1), "self-hosted": (1, 1), "puzl-cloud": (2, 3)})
+
+        shutil.rmtree(self.root / "org" / "repo" / "main")
+        shutil.rmtree(self.root / "org" / "repo" / "dev")
+        await self.index.invalidate("org", "repo")
+        self.assertEqual(await self.index.label_usage("org"), [])
+        self.assertEqual(await self.index.get("org"), [])
+        self.assertEqual((await self.index.search("org", "puzl"))["index"],
+                         {"contents": 0, "workflows": 0, "trigrams": 0, "candidates": 0})
+
+
+class TestSearchPrefilter(WorkflowIndexTestCase):
+    QUERIES = [
+        ("puzl-cloud", False, False), ("PUZL", False, True), ("make test-a", False, False), ("ub", False, False),
+        ("checkout@v4", False, False), ("missing", False, False), ("runs-on: [", False, False),
+        (r"puzl-(cloud|linux)", True, False), (r"test-(alpha|beta)\b", True, False), (r"ubuntu-\w+", True, False),
+        (r"(?:self|other)-hosted", True, False), (r"make\s+test", True, False), (r"UBUNTU", True, True),
+        (r"colou?r", True, False), (r"x{0}puzl", True, False), (r"[pq]uzl", True, False), (r"^on: push$", True, False),
+        (r"check(out)?@v\d", True, False), (r"a|puzl", True, False), (r".*", True, False), (r"(?i)Make", True, False),
+        (r"test-\w*a", True, False), (r"ubuntu-lat(e|a)st|missing", True, False), (r"[^\n]+-cloud", True, False),
+    ]
+
+    async def test_matches_full_scan(self):
+        contents = {}
+        for i, (name, build, test) in enumerate([
+                ("alpha", "ubuntu-latest", "self-hosted, puzl-cloud"), ("beta", "puzl-linux", "puzl-cloud"),
+                ("gamma", "windows-latest", "other-hosted"), ("a", "ubuntu-22.04", "colour, color")]):
+            for branch in ("main", f"feature/{i}"):
+                path = self._write(f"repo-{i % 2}", branch, name, _workflow(name, build, test))
+                contents[str(path.relative_to(self.root))] = path.read_text()
+
+        for query, regex, ignore_case in self.QUERIES:
+            with self.subTest(query=query, regex=regex, ignore_case=ignore_case):
+                if regex:
+                    pattern = re.compile(query, re.IGNORECASE if ignore_case else 0)
+                    matches = lambda line: pattern.search(line) is not None
+                elif ignore_case:
+                    matches = lambda line: query.lower() in line.lower()
+                else:
+                    matches = lambda line: query in line
+                expected = sorted(path for path, content in contents.items()
+                                  if any(matches(line) for line in content.splitlines()))
+                result = await self.index.search("org", query, regex=regex, ignore_case=ignore_case, limit=1000)
+                self.assertEqual([r["path"] for r in result["results"]], expected)
+
+        # The prefilter does narrow the contents read
+        result = await self.index.search("org", "windows-latest")
+        self.assertEqual((result["index"]["contents"], result["index"]["candidates"]), (4, 1))
+
+    async def test_filtered(self):
+        self._write("repo-0", "main", "ci", _workflow("ci"))
+        self._write("repo-1", "main", "ci", _workflow("ci"))
+        result = await self.index.search("org", "puzl-cloud", repo="org/repo-1")
+        self.assertEqual([r["repo"] for r in result["results"]], ["org/repo-1"])
+        # The same content in both repositories is indexed once
+        self.assertEqual(result["index"]["contents"], 1)
@@ -0,0 +1,116 @@
+import tempfile
+import unittest
+import subprocess
+from pathlib import Path
+
+from src.utils.objects import CatFileBatch, parse_tree, list_store_branches, list_workflow_blobs, read_blobs, \
+    git_fetch_objects
+
+
+def _git(repo: Path, *args: str, input: bytes = None) -> bytes:
+    return subprocess.run(
+        ["git", "-C", str(repo), "-c", "user.name=test", "-c", "user.email=test@example.com", *args],
+        input=input, check=True, capture_output=True).stdout
+
+
+class TestParseTree(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.repo = Path(self._tmp.name)
+        _git(self.repo, "init", "-q")
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def _tree(self, entries: str) -> str:
+        return _git(self.repo, "mktree", input=entries.encode()).decode().strip()
+
+    def test_matches_ls_tree(self):
+        blob = _git(self.repo, "hash-object", "-w", "--stdin", input=b"on: push\n").decode().strip()
+        subtree = self._tree(f"100644 blob {blob}\tci.yml\n")
+        tree = self._tree(f"100644 blob {blob}\tfile with spaces.yml\n"
+                          f"100755 blob {blob}\trun.sh\n"
+                          f"040000 tree {subtree}\tworkflows\n")
+        content = _git(self.repo, "cat-file", "tree", tree)
+        expected = []
+        for line in _git(self.repo, "ls-tree", tree).decode().splitlines():
+            meta, name = line.split("\t", 1)
+            mode, _, oid = meta.split()
+            expected.append((mode.lstrip("0"), name, oid))
+        self.assertEqual(parse_tree(content), expected)
+        self.assertIn(("40000", "workflows", subtree), parse_tree(content))
+
+    def test_empty(self):
+        self.assertEqual(parse_tree(b""), [])
+
+
+class TestListStoreBranches(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.store = Path(self._tmp.name)
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def test_packed_and_loose(self):
+        (self.store / "packed-refs").write_text(
+            "# pack-refs with: peeled fully-peeled sorted \n"
+            f"{'a' * 40} refs/heads/main\n"
+            f"{'b' * 40} refs/heads/feature/old\n"
+            f"{'c' * 40} refs/tags/v1\n"
+            f"^{'d' * 40}\n")
+        loose = self.store / "refs" / "heads" / "feature"
+        loose.mkdir(parents=True)
+        (loose / "old").write_text(f"{'e' * 40}\n")
+        (loose / "new").write_text(f"{'f' * 40}\n")
+        self.assertEqual(list_store_branches(self.store), {
+            "main": "a" * 40, "feature/old": "e" * 40, "feature/new": "f" * 40})
+
+    def test_empty_store(self):
+        self.assertEqual(list_store_branches(self.store), {})
+
+
+class TestObjectStoreRoundTrip(unittest.IsolatedAsyncioTestCase):
+    """
+    Fetches branches of a local bare repository into an object store and reads their workflows back.
+    """
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        root = Path(self._tmp.name)
+        self.remote, self.store, seed = root / "remote.git", root / "store.git", root / "seed"
+        _git(root, "init", "-q", "--bare", str(self.remote))
+        _git(self.remote, "config", "uploadpack.allowFilter", "true")
+        _git(self.remote, "config", "uploadpack.allowAnySHA1InWant", "true")
+        _git(root, "init", "-q", "-b", "main", str(seed))
+        (seed / ".github" / "workflows" / "nested").mkdir(parents=True)
+        (seed / ".github" / "workflows" / "ci.yml").write_text("runs-on: ubuntu-latest\n")
+        (seed / ".github" / "workflows" / "nested" / "deploy.yaml").write_text("runs-on: puzl-cloud\n")
+        (seed / ".github" / "workflows" / "notes.txt").write_text("not a workflow\n")
+        (seed / "README.md").write_text("readme\n")
+        _git(seed, "add", ".")
+        _git(seed, "commit", "-q", "-m", "init")
+        _git(seed, "checkout", "-q", "-b", "feature/x")
+        (seed / ".github" / "workflows" / "ci.yml").write_text("runs-on: puzl-cloud\n")
+        _git(seed, "commit", "-q", "-am", "feature")
+        _git(seed, "push", "-q", str(self.remote), "main", "feature/x")
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    async def test_round_trip(self):
+        branches = ["main", "feature/x"]
+        await git_fetch_objects(f"file://{self.remote}", self.store, branches)
+
+        remote_heads = {branch: _git(self.remote, "rev-parse", branch).decode().strip() for branch in branches}
+        self.assertEqual(list_store_branches(self.store), remote_heads)
+
+        async with CatFileBatch(self.store) as batch:
+            blobs, trees = await list_workflow_blobs(batch, branches)
+            self.assertEqual(len(trees), 2)
+            self.assertEqual(set(blobs["main"]), {".github/workflows/ci.yml", ".github/workflows/nested/deploy.yaml"})
+            contents = await read_blobs(batch, list(blobs["main"].values()) + list(blobs["feature/x"].values()))
+            self.assertIsNone(await batch.read("refs/heads/missing"))
+
+        self.assertEqual(contents[blobs["main"][".github/workflows/ci.yml"]], b"runs-on: ubuntu-latest\n")
+        self.assertEqual(contents[blobs["feature/x"][".github/workflows/ci.yml"]], b"runs-on: puzl-cloud\n")
+        self.assertEqual(contents[blobs["main"][".github/workflows/nested/deploy.yaml"]], b"runs-on: puzl-cloud\n")
@@ -0,0 +1,96 @@
+import asyncio
+import resource
+import unittest
+import unittest.mock
+
+from src.utils import resources
+from src.utils.resources import ResourceGovernor, FD_COSTS
+
+
+class TestResourceGovernor(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.running, self.max_running, self.order = {}, {}, []
+
+    def _work(self, governor: ResourceGovernor, kind: str, name: str, fds: int = None, delay: float = 0.02):
+        async def _run():
+            async with governor.slot(kind, fds):
+                self.order.append(name)
+                self.running[kind] = self.running.get(kind, 0) + 1
+                self.max_running[kind] = max(self.max_running.get(kind, 0), self.running[kind])
+                await asyncio.sleep(delay)
+                self.running[kind] -= 1
+
+        return _run()
+
+    def test_budget_from_rlimit(self):
+        with unittest.mock.patch.object(resource, "getrlimit", return_value=(1024, 1024)), \
+                unittest.mock.patch.object(resources, "count_open_fds", return_value=24), \
+                unittest.mock.patch.object(resources, "FD_RESERVE", 256):
+            governor = ResourceGovernor.from_rlimit({})
+        self.assertEqual(governor.budget, 1024 - 256 - 24)
+        self.assertEqual(governor.nofile, {"soft": 1024, "hard": 1024})
+
+    def test_min_budget(self):
+        with unittest.mock.patch.object(resource, "getrlimit", return_value=(64, 64)), \
+                unittest.mock.patch.object(resources, "count_open_fds", return_value=10):
+            governor = ResourceGovernor.from_rlimit({})
+        self.assertEqual(governor.budget, resources._MIN_BUDGET)
+
+    async def test_budget(self):
+        governor = ResourceGovernor(budget=20, limits={})
+        await asyncio.gather(*[self._work(governor, "shell", f"s{i}") for i in range(10)])
+        # Six descriptors per git process
+        self.assertEqual(self.max_running["shell"], 20 // FD_COSTS["shell"])
+        self.assertEqual(governor.stats()["reserved"], 0)
+
+    async def test_kind_limit(self):
+        governor = ResourceGovernor(budget=1000, limits={"file": 2})
+        await asyncio.gather(*[self._work(governor, "file", f"f{i}") for i in range(5)],
+                             *[self._work(governor, "http", f"h{i}") for i in range(5)])
+        self.assertEqual(self.max_running, {"file": 2, "http": 5})
+
+    async def test_limited_kind_does_not_block_others(self):
+        governor = ResourceGovernor(budget=1000, limits={"file": 1})
+        await asyncio.gather(self._work(governor, "file", "f0"), self._work(governor, "file", "f1"),
+                             self._work(governor, "http", "h0"))
+        self.assertEqual(self.order, ["f0", "h0", "f1"])
+
+    async def test_expensive_not_starved(self):
+        governor = ResourceGovernor(budget=16, limits={})
+        await asyncio.gather(self._work(governor, "file", "f0", fds=10), self._work(governor, "shell", "big", fds=16),
+                             self._work(governor, "file", "f1", fds=1))
+        # `f1` would fit next to `f0`, but `big` came first
+        self.assertEqual(self.order, ["f0", "big", "f1"])
+
+    async def test_fds_clamped_to_budget(self):
+        governor = ResourceGovernor(budget=16, limits={})
+        async with governor.slot("shell", fds=100):
+            self.assertEqual(governor.stats()["reserved"], 16)
+
+    async def test_cancelled_while_running(self):
+        governor = ResourceGovernor(budget=16, limits={"shell": 1})
+        running = asyncio.create_task(self._work(governor, "shell", "s0", delay=10))
+        await asyncio.sleep(0.01)
+        self.assertEqual(governor.stats()["kinds"]["shell"]["running"], 1)
+        running.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await running
+        self.assertEqual(governor.stats()["reserved"], 0)
+        self.assertEqual(governor.stats()["kinds"]["shell"]["running"], 0)
+        await self._work(governor, "shell", "s1")
+        self.assertEqual(self.order, ["s0", "s1"])
+
+    async def test_cancelled_while_waiting(self):
+        governor = ResourceGovernor(budget=16, limits={"shell": 1})
+        first = asyncio.create_task(self._work(governor, "shell", "s0", delay=0.05))
+        waiting = asyncio.create_task(self._work(governor, "shell", "s1"))
+        await asyncio.sleep(0.01)
+        self.assertEqual(governor.stats()["kinds"]["shell"]["waiting"], 1)
+        waiting.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await waiting
+        await first
+        await self._work(governor, "shell", "s2")
+        self.assertEqual(self.order, ["s0", "s2"])
+        stats = governor.stats()
+        self.assertEqual((stats["reserved"], stats["kinds"]["shell"]["waiting"]), (0, 0))
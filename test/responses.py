@@ -0,0 +1,118 @@
+import gzip
+import json
+import unittest
+import unittest.mock
+from pathlib import Path
+from types import SimpleNamespace
+
+from src import api
+from src.models import File, GitHubWorkflow
+from src.utils.responses import EncodedBodyCache, encode_body, MIN_COMPRESS_SIZE
+
+WORKFLOW = """
+jobs:
+  build:
+    runs-on: [self-hosted, puzl-cloud, linux, x64]
+"""
+
+
+class TestEncodeBody(unittest.TestCase):
+    def test_gzip_stable(self):
+        body = b"runs-on: puzl-cloud\n" * 100
+        with unittest.mock.patch("time.time", side_effect=[1000.0, 2000.0]):
+            first, second = encode_body(body, "gzip"), encode_body(body, "gzip")
+        self.assertEqual(first, second)
+        self.assertEqual(gzip.decompress(first), body)
+
+    def test_identity(self):
+        self.assertEqual(encode_body(b"body", "identity"), b"body")
+
+
+class TestWorkflowSerialize(unittest.TestCase):
+    def test_labels_sorted(self):
+        with unittest.mock.patch.object(File, "root", Path("/storage")):
+            wf = GitHubWorkflow(path=Path("org/repo/main/.github/workflows/ci.yml"), content=WORKFLOW)
+        self.assertEqual(wf.serialize()["runs-on"], ["linux", "puzl-cloud", "self-hosted", "x64"])
+
+
+class TestEncodedBodyCache(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.calls = 0
+
+    def _serializer(self, body: bytes):
+        async def _serialize() -> bytes:
+            self.calls += 1
+            return body
+
+        return _serialize
+
+    async def test_serialized_once_per_version(self):
+        cache, raw = EncodedBodyCache(max_entries=10), b"x" * MIN_COMPRESS_SIZE
+        body, encoding = await cache.get("key", "v1", "gzip", self._serializer(raw))
+        self.assertEqual((gzip.decompress(body), encoding), (raw, "gzip"))
+        self.assertEqual(await cache.get("key", "v1", "gzip", self._serializer(raw)), (body, "gzip"))
+        self.assertEqual(await cache.get("key", "v1", "identity", self._serializer(raw)), (raw, "identity"))
+        self.assertEqual(self.calls, 1)
+
+        await cache.get("key", "v2", "gzip", self._serializer(raw))
+        self.assertEqual(self.calls, 2)
+
+    async def test_small_body_sent_as_is(self):
+        cache = EncodedBodyCache(max_entries=10)
+        self.assertEqual(await cache.get("key", "v1", "gzip", self._serializer(b"[]")), (b"[]", "identity"))
+
+    async def test_evicted(self):
+        cache = EncodedBodyCache(max_entries=1)
+        await cache.get("a", "v1", "identity", self._serializer(b"a"))
+        await cache.get("b", "v1", "identity", self._serializer(b"b"))
+        await cache.get("a", "v1", "identity", self._serializer(b"a"))
+        self.assertEqual(self.calls, 3)
+        self.assertEqual(cache.stats()["entries"], 1)
+
+
+class TestGetWorkflows(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        with unittest.mock.patch.object(File, "root", Path("/storage")):
+            self.workflows = [
+                GitHubWorkflow(path=Path(f"org/repo/main/.github/workflows/{name}.yml"), content=WORKFLOW * 20)
+                for name in ["b", "a"]]
+        index = unittest.mock.patch.multiple(
+            api.workflow_index, get=unittest.mock.AsyncMock(return_value=self.workflows),
+            version=unittest.mock.Mock(return_value="v1"))
+        index.start()
+        self.addCleanup(index.stop)
+        cache = unittest.mock.patch.object(api, "workflows_body_cache", EncodedBodyCache(max_entries=10))
+        cache.start()
+        self.addCleanup(cache.stop)
+
+    async def _get(self, **headers):
+        request = SimpleNamespace(path="/api/orgs/org/workflows", headers=headers)
+        return await api.get_workflows(request, "org")
+
+    async def test_not_modified(self):
+        response = await self._get(**{"Accept-Encoding": "gzip"})
+        self.assertEqual(response.status, 200)
+        etag = response.headers["ETag"]
+        self.assertEqual(etag, '"v1-gzip"')
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+
+        with unittest.mock.patch.object(GitHubWorkflow, "serialize") as serialize:
+            response = await self._get(**{"Accept-Encoding": "gzip", "If-None-Match": etag})
+        self.assertEqual(response.status, 304)
+        self.assertEqual(response.headers["ETag"], etag)
+        self.assertFalse(response.body)
+        serialize.assert_not_called()
+
+    async def test_other_coding_not_matched(self):
+        response = await self._get(**{"Accept-Encoding": "identity", "If-None-Match": '"v1-gzip"'})
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.headers["ETag"], '"v1-identity"')
+
+    async def test_body_stable(self):
+        first = await self._get(**{"Accept-Encoding": "gzip"})
+        self.workflows.reverse()
+        with unittest.mock.patch.object(api, "workflows_body_cache", EncodedBodyCache(max_entries=10)):
+            second = await self._get(**{"Accept-Encoding": "gzip"})
+        self.assertEqual(first.body, second.body)
+        paths = [wf["path"] for wf in json.loads(gzip.decompress(first.body))]
+        self.assertEqual(paths, sorted(paths))
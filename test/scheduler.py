@@ -0,0 +1,111 @@
+import asyncio
+import unittest
+from pathlib import Path
+
+from src.models import GitConflictError, Token
+from src.utils.scheduler import CommitScheduler
+
+
+class TestCommitScheduler(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.token = Token(value="github_pat_test")
+        self.running, self.max_running, self.order = 0, 0, []
+
+    def _job(self, name: str, delay: float = 0.01):
+        async def _commit():
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+            self.order.append(name)
+            await asyncio.sleep(delay)
+            self.running -= 1
+            return name
+
+        return _commit
+
+    async def test_result(self):
+        scheduler = CommitScheduler(concurrency=2, repo_concurrency=2, token_concurrency=2)
+        result = await scheduler.submit("org", "org/repo", Path("org/repo/main"), self.token, self._job("main"))
+        self.assertEqual(result, "main")
+        self.assertEqual(scheduler.stats()["succeeded"], 1)
+
+    async def test_branch_serialized(self):
+        scheduler = CommitScheduler(concurrency=10, repo_concurrency=10, token_concurrency=10)
+        await asyncio.gather(*[
+            scheduler.submit("org", "org/repo", Path("org/repo/main"), self.token, self._job(f"main-{i}"))
+            for i in range(3)])
+        self.assertEqual(self.max_running, 1)
+
+    async def test_group_serialized_with_branch(self):
+        scheduler = CommitScheduler(concurrency=10, repo_concurrency=10, token_concurrency=10)
+        branches = {Path("org/a/main"): "org/a", Path("org/b/main"): "org/b"}
+        await asyncio.gather(
+            scheduler.submit_group("org", branches, self.token, self._job("group")),
+            scheduler.submit("org", "org/b", Path("org/b/main"), self.token, self._job("b")),
+            scheduler.submit("org", "org/c", Path("org/c/main"), self.token, self._job("c")))
+        self.assertEqual(self.order, ["group", "c", "b"])
+
+    async def test_group_counts_against_each_repo(self):
+        scheduler = CommitScheduler(concurrency=10, repo_concurrency=1, token_concurrency=10)
+        await asyncio.gather(
+            scheduler.submit_group(
+                "org", {Path("org/a/main"): "org/a", Path("org/b/main"): "org/b"}, self.token, self._job("group")),
+            scheduler.submit("org", "org/b", Path("org/b/dev"), self.token, self._job("b")))
+        self.assertEqual(self.max_running, 1)
+
+    async def test_repo_concurrency(self):
+        scheduler = CommitScheduler(concurrency=10, repo_concurrency=2, token_concurrency=10)
+        await asyncio.gather(*[
+            scheduler.submit("org", "org/repo", Path(f"org/repo/b{i}"), self.token, self._job(f"b{i}"))
+            for i in range(5)])
+        self.assertEqual(self.max_running, 2)
+
+    async def test_token_concurrency(self):
+        scheduler = CommitScheduler(concurrency=10, repo_concurrency=10, token_concurrency=3)
+        await asyncio.gather(*[
+            scheduler.submit("org", f"org/repo-{i}", Path(f"org/repo-{i}/main"), self.token, self._job(f"r{i}"))
+            for i in range(6)])
+        self.assertEqual(self.max_running, 3)
+
+    async def test_concurrency(self):
+        scheduler = CommitScheduler(concurrency=2, repo_concurrency=10, token_concurrency=10)
+        await asyncio.gather(*[
+            scheduler.submit("org", f"org/repo-{i}", Path(f"org/repo-{i}/main"), Token(value=f"github_pat_{i}"),
+                             self._job(f"r{i}"))
+            for i in range(5)])
+        self.assertEqual(self.max_running, 2)
+
+    async def test_round_robin_orgs(self):
+        scheduler = CommitScheduler(concurrency=1, repo_concurrency=10, token_concurrency=10)
+        jobs = [("a", "a1"), ("a", "a2"), ("a", "a3"), ("b", "b1")]
+        await asyncio.gather(*[
+            scheduler.submit(org, f"{org}/repo", Path(f"{org}/repo/{name}"), self.token, self._job(name))
+            for org, name in jobs])
+        self.assertEqual(self.order, ["a1", "b1", "a2", "a3"])
+
+    async def test_failure_not_retried(self):
+        scheduler = CommitScheduler(concurrency=2, repo_concurrency=2, token_concurrency=2)
+        calls = []
+
+        async def _commit():
+            calls.append(1)
+            raise GitConflictError("rejected")
+
+        with self.assertRaises(GitConflictError):
+            await scheduler.submit("org", "org/repo", Path("org/repo/main"), self.token, _commit)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(scheduler.stats()["failed"], 1)
+        self.assertEqual(scheduler.stats()["running"], 0)
+
+    async def test_cancel_queued(self):
+        scheduler = CommitScheduler(concurrency=1, repo_concurrency=10, token_concurrency=10)
+        first = asyncio.create_task(
+            scheduler.submit("org", "org/repo", Path("org/repo/a"), self.token, self._job("a", delay=0.05)))
+        second = asyncio.create_task(
+            scheduler.submit("org", "org/repo", Path("org/repo/b"), self.token, self._job("b")))
+        await asyncio.sleep(0.01)
+        second.cancel()
+        self.assertEqual(await first, "a")
+        with self.assertRaises(asyncio.CancelledError):
+            await second
+        self.assertEqual(self.order, ["a"])
+        self.assertEqual(scheduler.stats()["cancelled"], 1)
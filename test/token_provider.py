@@ -0,0 +1,108 @@
+import asyncio
+import tempfile
+import unittest
+import unittest.mock
+from datetime import datetime, timezone
+from pathlib import Path
+
+from src import token_provider
+from src.models import RESTAPIError
+from src.token_provider import TokenManager
+
+
+class FakeProvider:
+    """
+    Answers the app JWT, installation lookup and installation token requests of `TokenManager`.
+    """
+    def __init__(self, lifetime: int = 3600):
+        self.lifetime = lifetime
+        self.installations = {"org": 1, "other": 2}
+        self.minted = []
+        self.lookups = []
+        self.mint_status = None
+
+    async def __call__(self, method, endpoint, *args, **kwargs):
+        await asyncio.sleep(0.01)
+        if "/get-app-jwt" in endpoint:
+            return {"token": "app-jwt"}
+        if "/installation" in endpoint and "/orgs/" in endpoint:
+            org = endpoint.split("/orgs/")[1].split("/")[0]
+            self.lookups.append(org)
+            if org not in self.installations:
+                return {"error": "Not Found", "status": 404}
+            return {"id": self.installations[org]}
+        if "/get-installation-token" in endpoint:
+            if self.mint_status:
+                raise RESTAPIError(self.mint_status, "Mint failed", "")
+            installation_id = int(endpoint.split("installation_id=")[1])
+            self.minted.append(installation_id)
+            expires_at = datetime.fromtimestamp(datetime.now().timestamp() + self.lifetime, timezone.utc)
+            return {"access_token": f"ghs_{installation_id}_{len(self.minted)}",
+                    "expires_at": expires_at.isoformat().replace("+00:00", "Z")}
+        raise AssertionError(f"Unexpected request to {endpoint}")
+
+
+class TestTokenManager(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.provider = FakeProvider()
+        patcher = unittest.mock.patch.object(token_provider, "rest_api_request", self.provider)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_single_flight(self):
+        manager = TokenManager(renew_margin=60)
+        tokens = await asyncio.gather(*[manager.get("org") for _ in range(10)])
+        self.assertEqual({token.value for token in tokens}, {"ghs_1_1"})
+        self.assertEqual(self.provider.minted, [1])
+        self.assertEqual(self.provider.lookups, ["org"])
+
+    async def test_installation_per_org(self):
+        manager = TokenManager(renew_margin=60)
+        org, other = await asyncio.gather(manager.get("Org"), manager.get("other"))
+        self.assertEqual((org.installation_id, other.installation_id), (1, 2))
+        await manager.get("org")
+        self.assertEqual(sorted(self.provider.lookups), ["org", "other"])
+        self.assertEqual(sorted(self.provider.minted), [1, 2])
+
+    async def test_not_installed(self):
+        manager = TokenManager(renew_margin=60)
+        with self.assertRaises(PermissionError):
+            await manager.get("missing")
+
+    async def test_renewed_before_expiry(self):
+        self.provider.lifetime = 30
+        manager = TokenManager(renew_margin=60)
+        first = await manager.get("org")
+        # Still valid, so it is returned right away while a new one is minted in the background
+        self.assertEqual((await manager.get("org")).value, first.value)
+        await asyncio.sleep(0.05)
+        self.assertEqual(self.provider.minted, [1, 1])
+        self.assertEqual(manager.stats()["background_refreshes"], 1)
+
+    async def test_renew_expiring(self):
+        self.provider.lifetime = 30
+        manager = TokenManager(renew_margin=60)
+        await manager.get("org")
+        await manager.renew_expiring()
+        self.assertEqual((await manager.get("org")).value, "ghs_1_2")
+
+    async def test_uninstalled_dropped(self):
+        self.provider.lifetime = -1
+        manager = TokenManager(renew_margin=60)
+        await manager.get("org")
+        self.provider.mint_status = 404
+        self.provider.installations["org"] = 3
+        with self.assertRaises(RESTAPIError):
+            await manager.get("org")
+        self.provider.mint_status = None
+        self.assertEqual((await manager.get("org")).installation_id, 3)
+        self.assertEqual(self.provider.lookups, ["org", "org"])
+
+    async def test_shared_between_workers(self):
+        with tempfile.TemporaryDirectory() as shared:
+            workers = [TokenManager(renew_margin=60, shared_path=Path(shared)) for _ in range(3)]
+            tokens = await asyncio.gather(*[worker.get("org") for worker in workers])
+            self.assertEqual({token.value for token in tokens}, {"ghs_1_1"})
+            self.assertEqual(self.provider.minted, [1])
+            token_file = Path(shared) / "tokens" / "1.json"
+            self.assertEqual(token_file.stat().st_mode & 0o777, 0o600)